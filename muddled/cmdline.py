@@ -11,12 +11,15 @@ for help on how to use it.
 import errno
 import os
 import subprocess
+import sys
 
 import muddled.commands as commands
 import muddled.utils as utils
 import muddled.mechanics as mechanics
+import muddled.version_control as version_control
 
 from muddled.depend import Label
+from muddled.vcs import git_mirrors, git_objects, weld
 from muddled.utils import LabelType, LabelTag, DirType
 from muddled.withdir import Directory
 
@@ -76,11 +79,13 @@ def find_and_load(specified_root, muddle_binary):
     """Find our .muddle root, and then load our builder, and return it.
     """
     try:
-        (build_root, build_domain) = utils.find_root_and_domain(specified_root)
+        with utils.phase_times.phase('root discovery'):
+            (build_root, build_domain) = utils.find_root_and_domain(specified_root)
         if build_root:
-            builder = mechanics.load_builder(build_root, muddle_binary,
-                                             #default_domain = build_domain)
-                                             default_domain = None) # 'cos it's the toplevel
+            with utils.phase_times.phase('build description load'):
+                builder = mechanics.load_builder(build_root, muddle_binary,
+                                                 #default_domain = build_domain)
+                                                 default_domain = None) # 'cos it's the toplevel
         else:
             builder = None
         return builder
@@ -195,12 +200,9 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
     The actual command line, with no safety net...
     """
 
-    guess_what_to_do = False
-    command_name = ""
-
-    command = None
     command_options = { }
     specified_root = current_dir
+    profile = None
 
     while args:
         word = args[0]
@@ -215,6 +217,12 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
             return
         elif word in ('-n', "--just-print"):
             command_options["no_operation"] = True
+        elif word == '--profile':
+            profile = ''
+        elif word.startswith('--profile='):
+            profile = word[len('--profile='):]
+            if not profile:
+                raise utils.GiveUp('No filename given in "%s"'%word)
         elif word[0] == '-':
             raise utils.GiveUp, 'Unexpected command line option %s - see "muddle help"'%word
         else:
@@ -222,6 +230,47 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
 
         args = args[1:]
 
+    if profile is None:
+        _obey_command(args, current_dir, original_env, muddle_binary,
+                      command_options, specified_root)
+    else:
+        _profile_command(profile, args, current_dir, original_env,
+                         muddle_binary, command_options, specified_root)
+
+def _profile_command(profile_file, *args):
+    """
+    Obey the command (as _obey_command), but under the Python profiler.
+
+    Afterwards, report the time spent in each phase of the command, and
+    either write the profile statistics to 'profile_file' or, if that is
+    '', print out a summary of them.
+    """
+    import cProfile
+    import pstats
+
+    utils.phase_times.enable()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(_obey_command, *args)
+    finally:
+        sys.stdout.flush()
+        print
+        if profile_file:
+            profiler.dump_stats(profile_file)
+            print 'Profile statistics written to %s'%profile_file
+        else:
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(30)
+        print utils.phase_times.report()
+
+def _obey_command(args, current_dir, original_env, muddle_binary,
+                  command_options, specified_root):
+    """
+    Find the build tree (if any), and obey the command in 'args'.
+    """
+    guess_what_to_do = False
+    command_name = ""
+
     if args:
         command_name = args[0]
         args = args[1:]
@@ -247,14 +296,15 @@ def _cmdline(args, current_dir, original_env, muddle_binary):
     command.set_old_env(original_env)
 
     # And armed with that, we can try to obey it
-    if builder:
-        if builder.is_release_build() and not command.allowed_in_release_build():
-            raise utils.GiveUp("Command %s is not allowed in a release build"%command_name)
-        command.with_build_tree(builder, current_dir, args)
-    else:
-        if command.requires_build_tree():
-            raise utils.GiveUp("Command %s requires a build tree."%(command_name))
-        command.without_build_tree(muddle_binary, current_dir, args)
+    with utils.phase_times.phase('planning and execution'):
+        if builder:
+            if builder.is_release_build() and not command.allowed_in_release_build():
+                raise utils.GiveUp("Command %s is not allowed in a release build"%command_name)
+            command.with_build_tree(builder, current_dir, args)
+        else:
+            if command.requires_build_tree():
+                raise utils.GiveUp("Command %s requires a build tree."%(command_name))
+            command.without_build_tree(muddle_binary, current_dir, args)
 
 def cmdline(args, muddle_binary=None):
     """
@@ -288,6 +338,10 @@ def cmdline(args, muddle_binary=None):
         os.chdir(original_dir)          # In case we set it to shell_dir
         _cmdline(args, original_dir, original_env, muddle_binary)
     finally:
+        git_objects.close_all()
+        weld.forget_revisions()
+        git_mirrors.forget_shared_stores()
+        version_control.forget_prefetches()
         os.chdir(original_dir)          # Should not really be necessary...
         os.environ = original_env
 
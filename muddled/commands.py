@@ -34,12 +34,14 @@ from urlparse import urlparse
 
 import muddled.depend as depend
 import muddled.env_store as env_store
+import muddled.fetchd as fetchd
 import muddled.instr as instr
 import muddled.mechanics as mechanics
 import muddled.pkg as pkg
 import muddled.subst as subst
 import muddled.utils as utils
 import muddled.version_control as version_control
+import muddled.vcs.git_mirrors as git_mirrors
 import muddled.docreport
 
 from muddled.db import Database, InstructionFile
@@ -169,7 +171,7 @@ class Command(object):
     #
     # This mechanism is VERY primitive, and does not allow ordering
     # of switches (so it doesn't cope with a switch overriding a previous
-    # switch), or switches with arguments. Perhaps I should be using
+    # switch), and only simple switches with arguments. Perhaps I should be using
     # whatever switch mechanism Python 2.6 and above support - except
     # that getopt and optparse are both awful, and Python 2.7's argparse
     # doesn't seem much better (and, anyway, isn't in Python 2.6)
@@ -179,10 +181,18 @@ class Command(object):
     # if we encounter that switch
     allowed_switches = {}
 
+    # Similarly, switches that take a value (as the next word on the command
+    # line). The values in this dictionary are the keys under which the
+    # value given is remembered in self.switch_values
+    allowed_value_switches = {}
+
     # A list of the switches we were given, held as the first element
     # from one of the 'allowed_switches' tuples
     switches = []
 
+    # And a dictionary of the values given for any 'allowed_value_switches'
+    switch_values = {}
+
     def __init__(self):
         self.options = { }
 
@@ -235,11 +245,17 @@ class Command(object):
         switches.
         """
         self.switches = []              # In case we're called again
+        self.switch_values = {}
         while args:
             word = args[0]
             if word[0] == '-':
                 if word in self.allowed_switches:
                     self.switches.append(self.allowed_switches[word])
+                elif word in self.allowed_value_switches:
+                    if len(args) < 2:
+                        raise GiveUp('Switch "%s" needs a value'%word)
+                    self.switch_values[self.allowed_value_switches[word]] = args[1]
+                    args = args[1:]
                 else:
                     raise GiveUp('Unexpected switch "%s"'%word)
             else:
@@ -250,6 +266,39 @@ class Command(object):
             raise GiveUp('Unexpected trailing arguments "%s"'%' '.join(args))
         return args
 
+    def _jobs_from_args(self, switch, args):
+        """
+        Return the number of jobs given after 'switch', at the start of 'args'.
+
+        For use by commands that parse their own arguments. Does not alter
+        'args'.
+        """
+        if not args:
+            raise GiveUp('Switch "%s" needs a value'%switch)
+        return self._parse_jobs(args[0])
+
+    def get_jobs(self, default=1):
+        """
+        Return the number of jobs to run at once, as given by a "jobs" value
+        switch (typically "-j <N>"), or 'default' if there was none.
+        """
+        value = self.switch_values.get('jobs')
+        if value is None:
+            return default
+        return self._parse_jobs(value)
+
+    def _parse_jobs(self, value):
+        """
+        Return 'value' as a number of jobs, or GiveUp if it is not one.
+        """
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            raise GiveUp('The number of jobs must be a positive integer, not "%s"'%value)
+        return jobs
+
     def with_build_tree(self, builder, current_dir, args):
         """
         Run this command with a build tree.
@@ -351,6 +400,7 @@ class CPDCommand(Command):
     required_tag = None
     required_type = LabelType.Checkout
 
+    @utils.timed_phase('label expansion')
     def expand_labels(self, builder, args):
         if args:
             # Expand out any labels that need it
@@ -378,6 +428,7 @@ class CPDCommand(Command):
 
         self.build_these_labels(builder, labels)
 
+    @utils.timed_phase('label expansion')
     def decode_args(self, builder, args, current_dir):
         """
         Interpret 'args' as partial labels, and return a list of proper labels.
@@ -744,6 +795,7 @@ class AnyLabelCommand(Command):
 
         self.build_these_labels(builder, labels)
 
+    @utils.timed_phase('label expansion')
     def decode_args(self, builder, args, current_dir):
         """
         Turn the arguments into full labels.
@@ -900,6 +952,13 @@ Available <options> are:
                       'do something', just print out the labels for which that
                       action would be performed. For commands that "enquire"
                       (or "find out") something, this switch is ignored.
+  --profile[=<file>]  Run the command under the Python profiler. Afterwards,
+                      print out how long was spent in each phase of the
+                      command (finding the build tree, loading the build
+                      description, including subdomains, expanding labels,
+                      and doing the actual work). If <file> is given, write
+                      the profile statistics to it (for use with the Python
+                      "pstats" module), otherwise print out a summary of them.
    --version          Show the version of muddle and the directory it is
                       being run from. Note that this uses git to interrogate
                       the .git/ directory in the muddle source directory.
@@ -2628,6 +2687,58 @@ class QueryNeededBy(QueryCommand):
         else:
             print "Nothing else needs building to build %s"%label
 
+@subcommand('query', 'changed-since-build', CAT_QUERY)
+class QueryChangedSinceBuild(QueryCommand):
+    """
+    :Syntax: muddle query changed-since-build
+
+    Print the labels of the packages whose checkouts have changed since the
+    packages were built, one per line.
+
+    When a package is built, muddle remembers a "source fingerprint" for
+    each checkout that it (directly) depends on. For a git checkout, this
+    is the id of the tree for HEAD, plus a digest of the file details if
+    there are local changes. For other version control systems it is a
+    digest of the names, sizes and modification times of the files in the
+    checkout. Here we work out the fingerprints again, and report each
+    built package for which any of them is different.
+
+    No remote repositories are consulted, so this is a quick way of finding
+    out what needs rebuilding after (for instance) "muddle pull" or local
+    editing. Packages that have not been built are not reported, since they
+    will be built anyway. Packages that were built by a version of muddle
+    that did not remember fingerprints are always reported.
+
+    Packages that depend on a reported package are not reported themselves,
+    but "muddle changed" will mark them as needing rebuilding as well, so
+    one can do::
+
+        muddle changed $(muddle query changed-since-build)
+
+    If nothing has changed, nothing is printed.
+    """
+
+    def with_build_tree(self, builder, current_dir, args):
+        if args:
+            raise GiveUp("Syntax: muddle query changed-since-build")
+
+        known = {}
+        changed = []
+        for label in builder.all_package_labels():
+            if label.tag != LabelTag.Built or label.is_wildcard():
+                continue
+            if not builder.db.is_tag(label):
+                continue
+            recorded = builder.db.get_source_fingerprints(label)
+            current = builder.source_fingerprints(label, known)
+            # Checkouts that are not checked out are not remembered
+            current = dict((co, fp) for co, fp in current.items() if fp is not None)
+            if recorded != current:
+                changed.append(label)
+
+        for label in sorted(changed):
+            print label
+
 @subcommand('query', 'checkout-id', CAT_QUERY)
 class QueryCheckoutId(QueryCommand):
     """
@@ -3508,6 +3619,7 @@ class StampSave(Command):
     * -before <when> - use the (last) revision id at or before <when>
     * -f, -force - "force" a revision id
     * -h, -head - use HEAD for all checkouts
+    * -j <N>, -jobs <N> - work on up to <N> checkouts at once
     * -v <version>, -version <version>  - specify the version of stamp file
 
     These are explained more below. Switches may occur before or after
@@ -3563,6 +3675,10 @@ class StampSave(Command):
     In this case, the repository specified in the build description is used,
     and the revision id and status of each checkout is not checked.
 
+    By default, the revision ids (and branches) of the checkouts are worked
+    out one at a time. With '-j <N>' or '-jobs <N>', up to <N> checkouts are
+    done at once, each in its own process.
+
     By default, a version 2 stamp file will be created. This is equivalent
     to specifying '-version 2'. If '-version 1' is specified, then a version
     1 stamp file will be created instead. This is the version of stamp file
@@ -3583,12 +3699,16 @@ class StampSave(Command):
         filename = None
         when = None
         version = 2
+        jobs = 1
 
         while args:
             word = args.pop(0)
             if word in ('-f', '-force'):
                 force = True
                 just_use_head = False
+            elif word in ('-j', '-jobs'):
+                jobs = self._jobs_from_args(word, args)
+                args.pop(0)
             elif word in ('-h', '-head'):
                 just_use_head = True
                 force = False
@@ -3618,7 +3738,8 @@ class StampSave(Command):
         if self.no_op():
             return
 
-        stamp, problems = VersionStamp.from_builder(builder, force, just_use_head, before=when)
+        stamp, problems = VersionStamp.from_builder(builder, force, just_use_head,
+                                                    before=when, jobs=jobs)
 
         working_filename = '_temporary.stamp'
         print 'Writing to',working_filename
@@ -3693,7 +3814,8 @@ class StampVersion(Command):
     extension ".partial"), then the version stamp file will not be written.
 
     Note that '-f' is supported (although perhaps not recommended), but '-h' is
-    not.
+    not. '-j <N>' (or '-jobs <N>') may be used to say how many checkouts to
+    work on at once, as for "muddle stamp save".
 
     By default, a version 2 stamp file will be created. This is equivalent
     to specifying '-version 2'. If '-version 1' is specified, then a version
@@ -3717,12 +3839,16 @@ class StampVersion(Command):
     def with_build_tree(self, builder, current_dir, args):
         force = False
         version = 2
+        jobs = 1
 
         while args:
             word = args[0]
             args = args[1:]
             if word in ('-f', '-force'):
                 force = True
+            elif word in ('-j', '-jobs'):
+                jobs = self._jobs_from_args(word, args)
+                args = args[1:]
             elif word in ('-v', '-version'):
                 try:
                     version = int(args[0])
@@ -3745,7 +3871,8 @@ class StampVersion(Command):
             return
 
         stamp, problems = VersionStamp.from_builder(builder, force,
-                                                    just_use_head=False)
+                                                    just_use_head=False,
+                                                    jobs=jobs)
 
         if problems:
             print problems
@@ -3848,6 +3975,11 @@ class StampRelease(Command):
        This specifies how the archive will be compressed. The default is
        "gzip", and at the moment the only other alternative is "bzip2".
 
+    * -j <N>, -jobs <N>
+
+      Work out the revisions of up to <N> checkouts at once, as for
+      "muddle stamp save".
+
     See "muddle release" for using release files to build a release.
 
     Note that release files are also valid stamp files, so "muddle unstamp"
@@ -3869,6 +4001,7 @@ class StampRelease(Command):
         compression = None
         is_template = False
         guess_version = False
+        jobs = 1
 
         while args:
             word = args.pop(0)
@@ -3880,6 +4013,9 @@ class StampRelease(Command):
                 archive = args.pop(0)
             elif word == '-compression':
                 compression = args.pop(0)
+            elif word in ('-j', '-jobs'):
+                jobs = self._jobs_from_args(word, args)
+                args.pop(0)
             elif word.startswith('-'):
                 raise GiveUp("Unexpected switch '%s' for 'stamp release'"%word)
             elif name is None:
@@ -3902,7 +4038,7 @@ class StampRelease(Command):
         release = ReleaseSpec(name, version, archive, compression)
         builder.release_spec = release
 
-        stamp, problems = ReleaseStamp.from_builder(builder)
+        stamp, problems = ReleaseStamp.from_builder(builder, jobs=jobs)
 
         if problems:
             print problems
@@ -4401,14 +4537,14 @@ class UnStamp(Command):
     """
     To create a build tree from a stamp file:
 
-    :Syntax: muddle unstamp <file>
-    :or:     muddle unstamp <url>
-    :or:     muddle unstamp <vcs>+<url>
-    :or:     muddle unstamp <vcs>+<repo_url> <version_desc>
+    :Syntax: muddle unstamp [-j <N>] <file>
+    :or:     muddle unstamp [-j <N>] <url>
+    :or:     muddle unstamp [-j <N>] <vcs>+<url>
+    :or:     muddle unstamp [-j <N>] <vcs>+<repo_url> <version_desc>
 
     To update a build tree from a stamp file:
 
-    :Syntax: muddle unstamp -u[pdate] <file>
+    :Syntax: muddle unstamp -u[pdate] [-j <N>] <file>
 
     Creating a build tree from a stamp file
     ---------------------------------------
@@ -4423,6 +4559,13 @@ class UnStamp(Command):
     This form of the command cannot be used within an existing muddle build
     tree, as its intent is to create a new build tree.
 
+    By default, the checkouts are retrieved one at a time, and muddle stops
+    at the first that cannot be retrieved. With '-j <N>' (or '-jobs <N>'),
+    up to <N> checkouts are retrieved at the same time, each in its own
+    process. The output for each checkout is then shown when that checkout is
+    finished, and if any of the checkouts cannot be retrieved, the others
+    still go ahead, and the problems are all reported at the end.
+
     The file may be specified as:
 
     * The local path to a stamp file.
@@ -4493,6 +4636,9 @@ class UnStamp(Command):
     checkout". Newly cloned checkouts will not be represented in
     "_just_pulled".
 
+    As with creating a build tree, '-j <N>' says how many checkouts to
+    update at once.
+
     In the simplest case, the "unstamp -update" operation may just involve
     choosing different revisions on some checkouts.
 
@@ -4513,14 +4659,14 @@ class UnStamp(Command):
         print """
     To create a build tree:
 
-    :Syntax: muddle unstamp <file>
-    :or:     muddle unstamp <url>
-    :or:     muddle unstamp <vcs>+<url>
-    :or:     muddle unstamp <vcs>+<repo_url> <version_desc>
+    :Syntax: muddle unstamp [-j <N>] <file>
+    :or:     muddle unstamp [-j <N>] <url>
+    :or:     muddle unstamp [-j <N>] <vcs>+<url>
+    :or:     muddle unstamp [-j <N>] <vcs>+<repo_url> <version_desc>
 
     To update a build tree:
 
-    :Syntax: muddle unstamp -u[pdate] <file>
+    :Syntax: muddle unstamp -u[pdate] [-j <N>] <file>
 
     Try "muddle help unstamp" for more information."""
 
@@ -4529,6 +4675,9 @@ class UnStamp(Command):
             '-update' : 'update',
             }
 
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
+
     def requires_build_tree(self):
         return False
 
@@ -4702,6 +4851,8 @@ class UnStamp(Command):
 
         co_labels = checkouts.keys()
         co_labels.sort()
+        jobs = self.get_jobs()
+        new_labels = []
         for label in co_labels:
             co_dir, co_leaf, repo = checkouts[label]
             if label.domain:
@@ -4716,10 +4867,48 @@ class UnStamp(Command):
                 print "Unstamping checkout %s"%label.name
                 checkout_from_repo(builder, label, repo, co_dir, co_leaf)
 
-
             # Then need to mimic "muddle checkout" for it
             new_label = label.copy_with_tag(LabelTag.CheckedOut)
-            builder.build_label(new_label, silent=False)
+            if jobs < 2:
+                builder.build_label(new_label, silent=False)
+            else:
+                new_labels.append(new_label)
+
+        if new_labels:
+            self.checkout_in_parallel(builder, new_labels, jobs)
+
+    def checkout_in_parallel(self, builder, labels, jobs):
+        """Check out the checkouts in 'labels', up to 'jobs' at a time.
+
+        All of the checkouts are attempted, and then any problems are
+        reported together.
+        """
+        if len(labels) > 1:
+            print
+            print 'Checking out %d checkouts, %d at a time'%(len(labels),
+                                                            min(jobs, len(labels)))
+
+        def report(result):
+            print
+            print 'Checked out %s%s'%(labels[result.index],
+                                      '' if result.error is None else ' (FAILED)')
+            sys.stdout.write(result.output)
+
+        results = utils.run_in_parallel(_build_checkout_label,
+                                        [(builder, co, False) for co in labels],
+                                        jobs, callback=report)
+        problems = []
+        for result in results:
+            if result.error is not None:
+                problems.append((labels[result.index], result.error))
+        if problems:
+            print '\nThe following checkouts could not be checked out:'
+            for label, text in problems:
+                print
+                print '%s:'%label
+                print utils.indent(text.rstrip(), '  ')
+            raise GiveUp('Unable to restore %d of the %d checkouts in the'
+                         ' stamp file'%(len(problems), len(labels)))
 
     def update_from_stamp(self, builder, domains, checkouts):
         """
@@ -4823,7 +5012,11 @@ class UnStamp(Command):
                 # build description *and reload it* then we will lose the build
                 # tree we have lovingly created above, which rather defeats
                 # the purpose.
-                p.with_build_tree(builder, root_path, ['-noreload'] + changed_checkouts)
+                pull_args = ['-noreload']
+                jobs = self.get_jobs()
+                if jobs > 1:
+                    pull_args += ['-j', str(jobs)]
+                p.with_build_tree(builder, root_path, pull_args + changed_checkouts)
             except GiveUp as e:
                 had_problems = True
 
@@ -5743,6 +5936,195 @@ class Changed(PackageCommand):
 # -----------------------------------------------------------------------------
 # Checkout commands
 # -----------------------------------------------------------------------------
+def _build_checkout_label(builder, co_label, pulling):
+    """Build a checkout label, on behalf of a parallel pull or checkout.
+
+    This is run in a worker process (see utils.run_in_parallel), so anything
+    it changes in 'builder' is lost. Thus it returns a tuple:
+
+        (just_pulled, not_needed)
+
+    where 'just_pulled' is True if 'co_label' should be added to the
+    _just_pulled set, and 'not_needed' is the text of the Unsupported
+    exception if 'pulling' and the pull was not needed, or None.
+    """
+    try:
+        if pulling:
+            # First clear the 'pulled' tag, as Pull.pull does
+            builder.db.clear_tag(co_label)
+        builder.build_label(co_label)
+    except Unsupported as e:
+        if not pulling:
+            raise
+        print e
+        return (False, str(e))
+    return (builder.db.just_pulled.is_pulled(co_label), None)
+
+def _fetch_shared_repositories(builder, co_repos, jobs=1):
+    """Fetch each git repository that occurs more than once in 'co_repos' once.
+
+    'co_repos' is a list of (checkout label, Repository) pairs, one for each
+    checkout that we are about to clone or fetch for. Shallow and partial
+    checkouts are ignored, as they always fetch from the real repository.
+
+    Any git repository URL that occurs more than once is fetched, just the
+    once, into a shared store in the build tree (see muddled.vcs.git_mirrors),
+    up to 'jobs' at a time. The checkouts can then clone or fetch from that
+    instead of from the remote repository.
+
+    A shared store is only an optimisation, so failure to fetch into one is
+    not an error - the checkouts concerned will just use the remote
+    repository as normal.
+    """
+    counts = {}
+    for co, repo in co_repos:
+        if repo.vcs != 'git':
+            continue
+        options = builder.db.get_checkout_vcs_options(co)
+        if options.get('shallow_checkout') or options.get('partial_checkout'):
+            continue
+        counts[repo.url] = counts.get(repo.url, 0) + 1
+    urls = sorted(url for url, count in counts.items() if count > 1)
+    if not urls:
+        return
+
+    dir = builder.db.db_file_name('git-shared')
+    print
+    for url in urls:
+        print 'Fetching %s once, for %d checkouts'%(url, counts[url])
+
+    def report(result):
+        sys.stdout.write(result.output)
+
+    results = utils.run_in_parallel(git_mirrors.fetch_shared_store,
+                                    [(url, dir, True) for url in urls],
+                                    jobs, callback=report)
+    for result in results:
+        if result.error is None and result.value:
+            git_mirrors.remember_shared_store(urls[result.index], result.value)
+        elif result.error is not None:
+            print 'Unable to fetch %s into a shared store:'%urls[result.index]
+            print utils.indent(result.error.rstrip(), '  ')
+
+# How many checkouts "muddle pull" will fetch for in the background at once
+PREFETCH_JOBS = 4
+
+def _prefetch_command(builder, co_label):
+    """Return the command to fetch for 'co_label' in the background, or None.
+
+    Only checkouts that have already been checked out can be fetched for.
+    """
+    if not builder.db.is_tag(co_label.copy_with_tag(LabelTag.CheckedOut)):
+        return None
+    if not os.path.isdir(builder.db.get_checkout_path(co_label)):
+        return None
+    try:
+        vcs_handler = builder.db.get_checkout_vcs(co_label)
+        return vcs_handler.prefetch_command(builder, co_label)
+    except GiveUp:
+        # The pull itself will report on this
+        return None
+
+def _note_daemon_fetches(builder, co_labels):
+    """Tell the VCS for each checkout if "muddle fetchd" has just fetched it.
+
+    A checkout that the daemon has fetched for recently need not be fetched
+    for again by "muddle pull" or "muddle merge". Call this whilst holding
+    the fetch lock.
+
+    Returns the set of those of 'co_labels' that have been so fetched.
+    """
+    recent = fetchd.recently_fetched(builder, co_labels)
+    noted = set()
+    for co_label in co_labels:
+        if co_label.copy_with_tag(LabelTag.CheckedOut) in recent:
+            vcs_handler = builder.db.get_checkout_vcs(co_label)
+            vcs_handler.prefetched(builder, co_label, '')
+            noted.add(co_label)
+    return noted
+
+# How many checkouts whose repositories are on the same host we will talk
+# to that host about at the same time, for "muddle push" and friends
+JOBS_PER_HOST = 4
+
+def _remote_host(url):
+    """Return the name of the host for repository 'url', or '' if it is local.
+
+        >>> _remote_host('ssh://git@example.com:2222/fred.git')
+        'example.com'
+        >>> _remote_host('git@example.com:fred.git')
+        'example.com'
+        >>> _remote_host('file:///home/tibs/repos/fred')
+        ''
+        >>> _remote_host('/home/tibs/repos/fred')
+        ''
+    """
+    if '://' in url:
+        return urlparse(url).hostname or ''
+    before, colon, after = url.partition(':')
+    if colon and '/' not in before:
+        # An scp-style "[user@]host:path"
+        return before.split('@')[-1]
+    return ''
+
+def _for_each_checkout(builder, func, labels, args, jobs, per_host=None):
+    """Call func(builder, co_label, *args) for each checkout in 'labels'.
+
+    Up to 'jobs' checkouts are worked on at the same time, each in its own
+    process (see utils.run_in_parallel). The output for each checkout is
+    shown when that checkout is finished.
+
+    If 'per_host' is given, then no more than that many of the checkouts
+    whose repositories are on the same host are worked on at the same time
+    (see utils.run_in_parallel_by_group).
+
+    Returns a tuple (done, failed), where 'done' is a list of (co_label,
+    value) for each checkout for which 'func' returned 'value', and 'failed'
+    is a list of (co_label, error text) for each checkout for which it
+    raised an exception. Both lists are in the same order as 'labels'.
+
+    If 'jobs' is less than 2, the checkouts are worked on in order, in this
+    process, and any exception is raised at once - so 'failed' is always
+    empty.
+    """
+    if jobs < 2:
+        return [(co, func(builder, co, *args)) for co in labels], []
+
+    def report(result):
+        sys.stdout.write(result.output)
+
+    args_list = [(builder, co) + tuple(args) for co in labels]
+    if per_host:
+        hosts = [_remote_host(builder.db.get_checkout_repo(co).url) for co in labels]
+        results = utils.run_in_parallel_by_group(func, args_list, hosts, jobs,
+                                                 per_host, callback=report)
+    else:
+        results = utils.run_in_parallel(func, args_list, jobs, callback=report)
+    done = []
+    failed = []
+    for result in results:
+        co = labels[result.index]
+        if result.error is None:
+            done.append((co, result.value))
+        else:
+            failed.append((co, result.error))
+    return done, failed
+
+def _report_checkout_failures(failed):
+    """Report the (co_label, error text) pairs in 'failed', together.
+    """
+    print '\nThe following problems occurred:'
+    for co, text in failed:
+        print
+        print '%s:'%co
+        print utils.indent(text.rstrip(), '  ')
+
+def _push_checkout(builder, co_label):
+    """Push a checkout, on behalf of "muddle push".
+    """
+    builder.db.clear_tag(co_label)
+    builder.build_label(co_label)
+
 @command('commit', CAT_CHECKOUT)
 class Commit(CheckoutCommand):
     """
@@ -5760,21 +6142,35 @@ class Commit(CheckoutCommand):
 
     For a centralised VCS (e.g., Subversion) where the repository is remote,
     this will not do anything. See the update command.
+
+    If a checkout cannot be committed, we carry on with the others, and
+    report all of the problems at the end. The checkouts are always
+    committed one at a time, since the VCS may need to ask for a commit
+    message.
     """
 
     # XXX Is this correct?
     required_tag = LabelTag.ChangesCommitted
 
     def build_these_labels(self, builder, labels):
-        # Forcibly retract all the updated tags.
+        failed = []
         for co in labels:
-            builder.kill_label(co)
-            builder.build_label(co)
+            try:
+                # Forcibly retract all the updated tags.
+                builder.kill_label(co)
+                builder.build_label(co)
+            except GiveUp as e:
+                print e
+                failed.append((co, str(e)))
+        if failed:
+            _report_checkout_failures(failed)
+            raise GiveUp('Unable to commit %d of %d checkout%s'%(len(failed),
+                         len(labels), '' if len(labels) == 1 else 's'))
 
 @command('push', CAT_CHECKOUT)
 class Push(CheckoutCommand):
     """
-    :Syntax: muddle push [-s[top]] [ <checkout> ... ]
+    :Syntax: muddle push [-s[top]] [-j <N>] [ <checkout> ... ]
 
     Push the specified checkouts to their remote repositories.
 
@@ -5796,10 +6192,22 @@ class Push(CheckoutCommand):
     "muddle push" will refuse to push if the checkout is not on the expected
     branch, either an explicit branch from the build description, or the
     build description branch if we are "following" it, or "master".
+
+    With '-j <N>' (or '-jobs <N>'), up to <N> checkouts are pushed at the
+    same time, each in its own process, but no more than 4 at a time to the
+    same host. The output for each checkout is shown when that checkout has
+    been pushed. '-stop' cannot be used with '-j'.
+
+    With '-j', when ssh is used (by git or Subversion), all of the
+    connections to the same host share a single ssh connection (using
+    OpenSSH's "ControlMaster" connection multiplexing), unless you have set
+    GIT_SSH, GIT_SSH_COMMAND, SVN_SSH or git's "core.sshCommand" yourself.
     """
 
     required_tag = LabelTag.ChangesPushed
     allowed_switches = {'-s': 'stop', '-stop':'stop'}
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
 
     def build_these_labels(self, builder, labels):
 
@@ -5808,6 +6216,19 @@ class Push(CheckoutCommand):
         else:
             stop_on_problem = False
 
+        jobs = self.get_jobs()
+        if jobs > 1:
+            if stop_on_problem:
+                raise GiveUp('"muddle push" cannot use -stop and -j together')
+            with utils.sharing_ssh_connections():
+                done, failed = _for_each_checkout(builder, _push_checkout, labels,
+                                                  (), jobs, per_host=JOBS_PER_HOST)
+            if failed:
+                _report_checkout_failures(failed)
+                raise GiveUp('Unable to push %d of %d checkout%s'%(len(failed),
+                             len(labels), '' if len(labels) == 1 else 's'))
+            return
+
         problems = []
 
         for co in labels:
@@ -5831,7 +6252,7 @@ class Push(CheckoutCommand):
 @command('pull', CAT_CHECKOUT, ['fetch', 'update'])   # we want to settle on one command
 class Pull(CheckoutCommand):
     """
-    :Syntax: muddle pull [-s[top]] [-noreload] [ <checkout> ... ]
+    :Syntax: muddle pull [-s[top]] [-noreload] [-noprefetch] [-j <N>] [ <checkout> ... ]
 
     Pull the specified checkouts from their remote repositories. Any problems
     will be (re)reported at the end.
@@ -5865,6 +6286,30 @@ class Pull(CheckoutCommand):
     re-reporting any problems at the end. If '-s' or '-stop' is given, then
     it will instead stop at the first problem.
 
+    With '-j <N>' (or '-jobs <N>'), up to <N> checkouts are pulled at the
+    same time, each in its own process. The output for each checkout is
+    saved up and shown when that checkout has been pulled, so it does not get
+    mixed up with the output for other checkouts. Since the pulls are going on
+    at the same time, '-stop' cannot stop other pulls that have already
+    started - any problems are just reported at the end, as normal. Build
+    descriptions are still pulled first, one at a time, as described below.
+    As for "muddle push -j", connections made by ssh to the same host share
+    a single ssh connection.
+
+    If several of the checkouts come from the same git repository (for
+    instance, on different branches), then that repository is only fetched
+    once, into a shared store in .muddle/git-shared, and the checkouts then
+    fetch from there.
+
+    Without '-j', if more than one checkout is being pulled, then muddle
+    first starts fetching changes for all of them in the background, a few
+    at a time, and then works through the pulls in order, each waiting for
+    its own fetch to finish. This means that the network traffic for later
+    checkouts overlaps the merging of earlier ones. A background fetch
+    cannot ask for a password, so if it fails, the pull just fetches again,
+    as normal. Only git checkouts are fetched in the background. Use
+    '-noprefetch' to turn this off.
+
     How build descriptions are treated specially
     --------------------------------------------
     If the build description is in the list of checkouts that should be
@@ -5909,11 +6354,15 @@ class Pull(CheckoutCommand):
     required_tag = LabelTag.Pulled
     allowed_switches = {'-s': 'stop',
                         '-stop':'stop',
-                        '-noreload':'noreload'}
+                        '-noreload':'noreload',
+                        '-noprefetch':'noprefetch'}
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
 
     def build_these_labels(self, builder, labels):
 
         self.stop_on_problem = 'stop' in self.switches
+        jobs = self.get_jobs()
 
         do_build_descriptions_first = 'noreload' not in self.switches
 
@@ -5922,17 +6371,33 @@ class Pull(CheckoutCommand):
 
         builder.db.just_pulled.clear()
 
-        try:
-            # If we have a single label, we really don't care if it's a build
-            # description or not!
-            if do_build_descriptions_first and len(labels) > 1:
-                builder, labels = self.handle_build_descriptions_first(builder, labels)
-
-            for co in labels:
-                self.pull(builder, co)
-        finally:
-            # Remember to commit the 'just pulled' information, whatever happens
-            builder.db.just_pulled.commit()
+        # Don't fetch at the same time as "muddle fetchd"
+        with fetchd.fetch_lock(builder.db.root_path):
+            try:
+                # If we have a single label, we really don't care if it's a build
+                # description or not!
+                if do_build_descriptions_first and len(labels) > 1:
+                    builder, labels = self.handle_build_descriptions_first(builder, labels)
+
+                _fetch_shared_repositories(builder,
+                                           [(co, builder.db.get_checkout_repo(co))
+                                            for co in labels],
+                                           jobs)
+
+                fetched = _note_daemon_fetches(builder, labels)
+
+                if jobs > 1:
+                    self.pull_in_parallel(builder, labels, jobs)
+                elif len(labels) > 1 and 'noprefetch' not in self.switches:
+                    self.pull_with_prefetch(builder, labels, fetched)
+                else:
+                    for co in labels:
+                        self.pull(builder, co)
+            finally:
+                # Don't leave any unused fetches for a later command to trust
+                version_control.forget_prefetches()
+                # Remember to commit the 'just pulled' information, whatever happens
+                builder.db.just_pulled.commit()
 
         just_pulled = builder.db.just_pulled.get_from_disk()
         if just_pulled:
@@ -6082,6 +6547,68 @@ class Pull(CheckoutCommand):
                 print e
                 self.problems.append(e)
 
+    def pull_with_prefetch(self, builder, labels, fetched):
+        """Pull the checkouts in 'labels', fetching for them in the background.
+
+        Checkouts in 'fetched' have already been fetched for, and so are not
+        fetched for again.
+        """
+        labels = sorted(labels)
+        with utils.BackgroundCommands(PREFETCH_JOBS) as background:
+            for co in labels:
+                if co in fetched:
+                    continue
+                cmd = _prefetch_command(builder, co)
+                if cmd:
+                    background.add(co, cmd, builder.db.get_checkout_path(co))
+
+            try:
+                for co in labels:
+                    result = background.wait_for(co)
+                    if result:
+                        retcode, output = result
+                        if retcode == 0:
+                            vcs_handler = builder.db.get_checkout_vcs(co)
+                            vcs_handler.prefetched(builder, co, output)
+                        else:
+                            print
+                            print 'Fetching for %s in the background failed:'%co
+                            print utils.indent(output.rstrip(), '  ')
+                    self.pull(builder, co)
+            finally:
+                # A pull that failed early will not have used its prefetch
+                version_control.forget_prefetches()
+
+    def pull_in_parallel(self, builder, labels, jobs):
+        """Pull the checkouts in 'labels', up to 'jobs' at a time.
+        """
+        labels = sorted(labels)
+        if len(labels) > 1:
+            print
+            print 'Pulling %d checkouts, %d at a time'%(len(labels),
+                                                       min(jobs, len(labels)))
+
+        def report(result):
+            print
+            print 'Pulled %s%s'%(labels[result.index],
+                                 '' if result.error is None else ' (FAILED)')
+            sys.stdout.write(result.output)
+
+        with utils.sharing_ssh_connections():
+            results = utils.run_in_parallel(_build_checkout_label,
+                                            [(builder, co, True) for co in labels],
+                                            jobs, callback=report)
+        for result in results:
+            co = labels[result.index]
+            if result.error is None:
+                pulled, not_needed = result.value
+                if pulled:
+                    builder.db.just_pulled.add(co)
+                if not_needed:
+                    self.not_needed.append(not_needed)
+            else:
+                self.problems.append(result.error)
+
     def delete_pyc_files(self, builder, co_label):
         """Delete .pyc files in this checkout
         """
@@ -6144,22 +6671,27 @@ class Merge(CheckoutCommand):
 
         builder.db.just_pulled.clear()
 
-        try:
-            for co in labels:
-                try:
-                    # First clear the 'merged' tag
-                    builder.db.clear_tag(co)
-                    # And then build it again
-                    builder.build_label(co)
-                except GiveUp as e:
-                    if stop_on_problem:
-                        raise
-                    else:
-                        print e
-                        problems.append(e)
-        finally:
-            # Remember to commit the 'just pulled' information
-            builder.db.just_pulled.commit()
+        # Don't fetch at the same time as "muddle fetchd"
+        with fetchd.fetch_lock(builder.db.root_path):
+            try:
+                _note_daemon_fetches(builder, labels)
+                for co in labels:
+                    try:
+                        # First clear the 'merged' tag
+                        builder.db.clear_tag(co)
+                        # And then build it again
+                        builder.build_label(co)
+                    except GiveUp as e:
+                        if stop_on_problem:
+                            raise
+                        else:
+                            print e
+                            problems.append(e)
+            finally:
+                # Don't leave any unused fetches for a later command to trust
+                version_control.forget_prefetches()
+                # Remember to commit the 'just pulled' information
+                builder.db.just_pulled.commit()
 
         just_pulled = builder.db.just_pulled.get_from_disk()
         if just_pulled:
@@ -6173,10 +6705,192 @@ class Merge(CheckoutCommand):
                 print str(e).rstrip()
             raise GiveUp()
 
+def _checkout_status(builder, co_label, verbose, quick):
+    """Find out if checkout 'co_label' needs attention, for "muddle status".
+
+    Returns None if it does not, or otherwise the text to report for it.
+
+    This may be run in a worker process (see utils.run_in_parallel).
+    """
+    if not builder.db.is_tag(co_label):
+        return '\n%s is not checked out'%co_label
+
+    try:
+        vcs_handler = builder.db.get_checkout_vcs(co_label)
+    except GiveUp:
+        return "Rule for label '%s' has no VCS - cannot find its status"%co_label
+
+    try:
+        text = vcs_handler.status(builder, co_label, verbose, quick=quick)
+    except MuddleBug as err:
+        raise MuddleBug('Giving up in %s because:\n%s'%(co_label,err))
+    except GiveUp as err:
+        return str(err)
+
+    if text:
+        return '\n%s'%text.strip()
+    return None
+
+def _batched_checkout_status(builder, labels, quick):
+    """Find the status of those checkouts whose VCS can do several at once.
+
+    Returns a dictionary of checkout label to the text that _checkout_status
+    would have returned for it. Checkouts that are not in the dictionary
+    should be asked about individually.
+    """
+    by_vcs = {}
+    for co in labels:
+        if not builder.db.is_tag(co):
+            continue
+        try:
+            vcs_handler = builder.db.get_checkout_vcs(co)
+        except GiveUp:
+            continue
+        if not vcs_handler.vcs.batches_status():
+            continue
+        if not os.path.isdir(builder.db.get_checkout_path(co)):
+            continue
+        by_vcs.setdefault(vcs_handler.short_name, (vcs_handler, []))[1].append(co)
+
+    texts = {}
+    for name, (vcs_handler, co_labels) in sorted(by_vcs.items()):
+        if len(co_labels) < 2:
+            continue
+        try:
+            results = vcs_handler.status_of_several(builder, co_labels, quick)
+        except GiveUp:
+            # Leave them to be asked about one by one, so that any problem
+            # is reported against the right checkout
+            continue
+        for co, text in zip(co_labels, results):
+            texts[co] = '\n%s'%text.strip() if text else None
+    return texts
+
+@command('fetchd', CAT_CHECKOUT)
+class FetchDaemon(Command):
+    """
+    :Syntax: muddle fetchd [-interval <seconds>] [-j <N>] [-foreground]
+    :or:     muddle fetchd -once [-j <N>]
+    :or:     muddle fetchd -stop
+    :or:     muddle fetchd -status
+
+    Fetch changes for the checkouts in this build tree, in the background.
+
+    With no switches, start the "fetch daemon" for this build tree. This is
+    a background process which, every so often, fetches changes from the
+    remote repository of each checkout, without altering any working tree.
+    "muddle pull" then has less to do, and "muddle status -quick" can report
+    that a checkout is behind its remote without having to ask the network.
+
+    Only checkouts whose version control system can fetch without touching
+    the working tree take part - at the moment, that means git. Subversion
+    and bazaar have no equivalent, so their checkouts are left alone. Nor
+    does the daemon fetch for shallow checkouts, or for checkouts whose
+    repository has "pull" turned off.
+
+    The daemon runs at low priority, and writes its output to
+    .muddle/fetchd.log. It stops by itself if the build tree is deleted.
+    "muddle pull" and "muddle merge" will not fetch at the same time as it
+    does - if the daemon is fetching, they wait for it to finish. If the
+    daemon fetched for a checkout within the last minute, they do not fetch
+    for it again. Otherwise they still fetch, but have less to fetch.
+
+    Switches:
+
+    * -interval <seconds> - fetch this often. The default is 600
+      (ten minutes).
+    * -j <N> (or -jobs <N>) - fetch for up to <N> checkouts at the same
+      time. The default is 2.
+    * -foreground - run the daemon in the foreground, instead of starting it
+      in the background. It can be stopped with "muddle fetchd -stop" or
+      Control-C.
+    * -once - fetch for all the checkouts once, now, in the foreground, and
+      then stop.
+    * -stop - stop the daemon for this build tree, if it is running.
+    * -status - report whether the daemon is running for this build tree.
+    """
+
+    allowed_switches = {'-foreground': 'foreground',
+                        '-once': 'once',
+                        '-stop': 'stop',
+                        '-status': 'status',
+                       }
+    allowed_value_switches = {'-interval': 'interval',
+                              '-j': 'jobs',
+                              '-jobs': 'jobs',
+                             }
+
+    def with_build_tree(self, builder, current_dir, args):
+        self.remove_switches(args, allowed_more=False)
+
+        root_path = builder.db.root_path
+        jobs = self.get_jobs(fetchd.DEFAULT_JOBS)
+        interval = self.switch_values.get('interval', fetchd.DEFAULT_INTERVAL)
+        try:
+            interval = int(interval)
+        except ValueError:
+            interval = 0
+        if interval < 1:
+            raise GiveUp('The interval must be a positive number of seconds,'
+                         ' not "%s"'%self.switch_values['interval'])
+
+        if len(self.switches) > 1:
+            raise GiveUp('Only one of -foreground, -once, -stop and -status'
+                         ' may be given')
+
+        if 'status' in self.switches:
+            pid = fetchd.running_pid(root_path)
+            if pid:
+                print '"muddle fetchd" is running (process %d)'%pid
+            else:
+                print '"muddle fetchd" is not running'
+        elif 'stop' in self.switches:
+            if self.no_op():
+                print 'Asked to stop "muddle fetchd"'
+                return
+            pid = fetchd.stop(root_path)
+            if pid:
+                print 'Stopped "muddle fetchd" (process %d)'%pid
+            else:
+                print '"muddle fetchd" was not running'
+        elif 'once' in self.switches:
+            if self.no_op():
+                for co_label, cmd, co_dir in fetchd.fetch_commands(builder):
+                    print 'Would fetch for %s: %s'%(co_label, ' '.join(cmd))
+                return
+            with fetchd.fetch_lock(root_path):
+                failures = fetchd.fetch_all(builder, jobs)
+            if failures:
+                raise GiveUp('Unable to fetch for %d checkout%s'%(failures,
+                             '' if failures == 1 else 's'))
+        elif 'foreground' in self.switches:
+            if self.no_op():
+                print 'Asked to run "muddle fetchd" in the foreground'
+                return
+            pid = fetchd.running_pid(root_path)
+            if pid:
+                raise GiveUp('"muddle fetchd" is already running for this'
+                             ' build tree (process %d)'%pid)
+            with open(fetchd.pid_file_name(root_path), 'w') as fd:
+                fd.write('%d\n'%os.getpid())
+            try:
+                fetchd.run(root_path, interval, jobs)
+            except KeyboardInterrupt:
+                print
+            finally:
+                fetchd.stop_if_ours(root_path)
+        else:
+            if self.no_op():
+                print 'Asked to start "muddle fetchd"'
+                return
+            pid = fetchd.start(root_path, interval, jobs)
+            print 'Started "muddle fetchd" (process %d), logging to %s'%(pid,
+                    fetchd.log_file_name(root_path))
+
 @command('status', CAT_CHECKOUT)
 class Status(CheckoutCommand):
     """
-    :Syntax: muddle status [-v] [-j] [-quick] [ <checkout> ... ]
+    :Syntax: muddle status [-v] [-j] [-quick] [-jobs <N>] [ <checkout> ... ]
 
     Report on the status of checkouts that need attention.
 
@@ -6216,6 +6930,19 @@ class Status(CheckoutCommand):
     can gives depends upon whatever was last fetched into the local repository.
     It can typically inform you if there are local updates to be pushed, but
     will not (cannot) warn you if there are commits to be pulled.
+
+    With '-jobs <N>', the status of up to <N> checkouts is found at the same
+    time, each in its own process. The report is then made, in the normal
+    order, once all of the checkouts have been looked at. With '-v' as well,
+    each checkout label is reported as its status is found, so the labels
+    will not necessarily be in order. If finding the status of a checkout
+    goes wrong unexpectedly, muddle stops when it gets to that checkout, just
+    as it does without '-jobs'.
+
+    Some version control systems (at the moment, just Subversion) can find
+    the status of several checkouts at once - Subversion, for instance, only
+    asks each server once. Such checkouts are always looked at together,
+    before any others, whether '-jobs' is given or not.
     """
 
     required_tag = LabelTag.CheckedOut
@@ -6223,6 +6950,7 @@ class Status(CheckoutCommand):
                         '-j': 'join',
                         '-quick' : 'quick'
                        }
+    allowed_value_switches = {'-jobs': 'jobs'}
 
     # This checkout command *is* allowed in a release build
     def allowed_in_release_build(self):
@@ -6238,35 +6966,51 @@ class Status(CheckoutCommand):
         verbose = ('verbose' in self.switches)
         joined = ('join' in self.switches)
         quick = ('quick' in self.switches)
+        jobs = self.get_jobs()
 
-        something = []
-        for co in labels:
-            if not builder.db.is_tag(co):
-                print
-                print '%s is not checked out'%co
-                something.append(co)
-                continue
-
-            try:
-                vcs_handler = builder.db.get_checkout_vcs(co)
-            except GiveUp:
-                print "Rule for label '%s' has no VCS - cannot find its status"%co
-                something.append(co)
-                continue
-
-            try:
-                text = vcs_handler.status(builder, co, verbose, quick=quick)
-            except MuddleBug as err:
-                raise MuddleBug('Giving up in %s because:\n%s'%(co,err))
-            except GiveUp as err:
-                print err
-                something.append(co)
-                continue
+        batched = _batched_checkout_status(builder, labels, quick)
+        others = [co for co in labels if co not in batched]
 
-            if text:
-                print
-                print text.strip()
-                something.append(co)
+        something = []
+        outputs = {}
+        if jobs > 1 and len(others) > 1:
+            def report(result):
+                print '>> %s%s'%(others[result.index],
+                                 '' if result.error is None else ' (FAILED)')
+
+            results = utils.run_in_parallel(_checkout_status,
+                                            [(builder, co, False, quick) for co in others],
+                                            jobs, callback=report if verbose else None)
+            failed = {}
+            for result in results:
+                co = others[result.index]
+                outputs[co] = result.output
+                if result.error is None:
+                    batched[co] = result.value
+                else:
+                    failed[co] = result.error
+            for co in labels:
+                sys.stdout.write(outputs.get(co, ''))
+                if co in failed:
+                    # _checkout_status only fails for unexpected problems,
+                    # so give up here, just as we would have without -jobs
+                    raise MuddleBug('Unable to find the status of %s:\n%s'%(co,
+                                    failed[co].rstrip()))
+                text = batched.get(co)
+                if text:
+                    print text
+                    something.append(co)
+        else:
+            for co in labels:
+                if co in batched:
+                    if verbose:
+                        print '>>', co
+                    text = batched[co]
+                else:
+                    text = _checkout_status(builder, co, verbose, quick)
+                if text:
+                    print text
+                    something.append(co)
 
         if something:
             if joined:
@@ -6281,7 +7025,7 @@ class Status(CheckoutCommand):
 @command('reparent', CAT_CHECKOUT)
 class Reparent(CheckoutCommand):
     """
-    :Syntax: muddle reparent [-f[orce]] [ <checkout> ... ]
+    :Syntax: muddle reparent [-f[orce]] [-j <N>] [ <checkout> ... ]
 
     Re-associate the specified checkouts with their remote repositories.
 
@@ -6309,11 +7053,19 @@ class Reparent(CheckoutCommand):
         * If "parent_branch" is unset, sets it.
         * With '-force', sets "parent_branch" regardless, and also unsets
           "push_branch".
+
+    With '-j <N>' (or '-jobs <N>'), up to <N> checkouts are reparented at
+    the same time, each in its own process. If any checkouts cannot be
+    reparented, the others still are, and the problems are reported together
+    at the end. Otherwise, the checkouts are reparented one at a time, and
+    muddle stops at the first problem.
     """
 
     # XXX Is this what we want???
     required_tag = LabelTag.Pulled
     allowed_switches = {'-f':'force', '-force':'force'}
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
 
     # This checkout command *is* allowed in a release build (I think it makes sense)
     def allowed_in_release_build(self):
@@ -6326,13 +7078,28 @@ class Reparent(CheckoutCommand):
         else:
             force = False
 
+        to_reparent = []
         for co in labels:
             try:
-                vcs_handler = builder.db.get_checkout_vcs(co)
+                builder.db.get_checkout_vcs(co)
             except GiveUp:
                 print "Rule for label '%s' has no VCS - cannot reparent, ignored"%co
                 continue
-            vcs_handler.reparent(builder, co, force=force, verbose=True)
+            to_reparent.append(co)
+
+        done, failed = _for_each_checkout(builder, _reparent_checkout,
+                                          to_reparent, (force,),
+                                          self.get_jobs())
+        if failed:
+            _report_checkout_failures(failed)
+            raise GiveUp('Unable to reparent %d of %d checkout%s'%(len(failed),
+                         len(to_reparent), '' if len(to_reparent) == 1 else 's'))
+
+def _reparent_checkout(builder, co_label, force):
+    """Reparent a checkout, on behalf of "muddle reparent".
+    """
+    vcs_handler = builder.db.get_checkout_vcs(co_label)
+    vcs_handler.reparent(builder, co_label, force=force, verbose=True)
 
 @command('uncheckout', CAT_CHECKOUT)
 class UnCheckout(CheckoutCommand):
@@ -6442,7 +7209,7 @@ class Import(CheckoutCommand):
 @command('checkout', CAT_CHECKOUT)
 class Checkout(CheckoutCommand):
     """
-    :Syntax: muddle checkout [ <checkout> ... ]
+    :Syntax: muddle checkout [-j <N>] [ <checkout> ... ]
 
     Checks out the specified checkouts.
 
@@ -6466,19 +7233,64 @@ class Checkout(CheckoutCommand):
         (The value of _just_pulled is cleared at the start of "muddle pull"
         or "muddle checkout", and set at the end - the list of checkout labels
         is actually stored in the file .muddle/_just_pulled.)
+
+    With '-j <N>' (or '-jobs <N>'), up to <N> checkouts are checked out at the
+    same time, each in its own process. The output for each checkout is
+    saved up and shown when that checkout is finished. If any of the
+    checkouts fail, the others still go ahead, and the problems are all
+    reported at the end.
+
+    If several of the checkouts come from the same git repository (for
+    instance, on different branches), then that repository is only fetched
+    once, into a shared store in .muddle/git-shared, and the checkouts are
+    cloned from there.
     """
 
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
+
     def build_these_labels(self, builder, labels):
         builder.db.just_pulled.clear()
-        for co in labels:
-            builder.build_label(co)
+        jobs = self.get_jobs()
+        _fetch_shared_repositories(builder,
+                                   [(co, builder.db.get_checkout_repo(co))
+                                    for co in labels if not builder.db.is_tag(co)],
+                                   jobs)
+        if jobs < 2:
+            for co in labels:
+                builder.build_label(co)
+            return
+
+        def report(result):
+            print
+            print 'Checked out %s%s'%(labels[result.index],
+                                      '' if result.error is None else ' (FAILED)')
+            sys.stdout.write(result.output)
+
+        results = utils.run_in_parallel(_build_checkout_label,
+                                        [(builder, co, False) for co in labels],
+                                        jobs, callback=report)
+        problems = []
+        for result in results:
+            if result.error is None:
+                pulled, not_needed = result.value
+                if pulled:
+                    builder.db.just_pulled.add(labels[result.index])
+            else:
+                problems.append(result.error)
+        if problems:
+            print '\nThe following problems occurred:'
+            for text in problems:
+                print
+                print text.rstrip()
+            raise GiveUp()
 
 @command('sync', CAT_CHECKOUT)
 class Sync(CheckoutCommand):
     """
-    :Syntax: muddle sync [ <checkout> ... ]
-    :or:     muddle sync [-v[erbose]] [ <checkout> ... ]
-    :or:     muddle sync [-show] [ <checkout> ...]
+    :Syntax: muddle sync [-j <N>] [ <checkout> ... ]
+    :or:     muddle sync [-v[erbose]] [-j <N>] [ <checkout> ... ]
+    :or:     muddle sync [-show] [-j <N>] [ <checkout> ...]
 
     "Synchronise" each checkout onto the branch it should be on...
 
@@ -6517,6 +7329,15 @@ class Sync(CheckoutCommand):
     With '-show', report on its decision making process, but don't actually
     do anything.
 
+    Any build descriptions are synchronised first, one at a time, since
+    where the other checkouts go may depend upon them. With '-j <N>' (or
+    '-jobs <N>'), up to <N> of the other checkouts are then synchronised at
+    the same time, each in its own process. The output for each checkout is
+    shown when that checkout is finished. If any checkouts cannot be
+    synchronised, the others still are, and the problems are reported
+    together at the end. Without '-j', the checkouts are synchronised one at
+    a time, and muddle stops at the first problem.
+
     <checkout> should be a label fragment specifying a checkout, or one of
     _all and friends, as for any checkout command. The <type> defaults to
     "checkout", and the checkout <tag> will be "/changes_committed". See
@@ -6533,6 +7354,8 @@ class Sync(CheckoutCommand):
                         '-verbose': 'verbose',
                         '-show': 'show'
                        }
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
 
     def build_these_labels(self, builder, labels):
 
@@ -6542,10 +7365,34 @@ class Sync(CheckoutCommand):
         else:
             verbose = True
 
+        # Where the other checkouts should go may depend upon the branch of
+        # the build descriptions, so sync those first, one at a time
+        build_descs = []
+        others = []
         for co in labels:
+            if builder.db.get_domain_build_desc_label(co.domain).match_without_tag(co):
+                build_descs.append(co)
+            else:
+                others.append(co)
+
+        for co in build_descs:
             vcs_handler = builder.db.get_checkout_vcs(co)
             vcs_handler.sync(builder, co, verbose=verbose, sync=sync)
 
+        done, failed = _for_each_checkout(builder, _sync_checkout, others,
+                                          (verbose, sync),
+                                          self.get_jobs())
+        if failed:
+            _report_checkout_failures(failed)
+            raise GiveUp('Unable to sync %d of %d checkout%s'%(len(failed),
+                         len(labels), '' if len(labels) == 1 else 's'))
+
+def _sync_checkout(builder, co_label, verbose, sync):
+    """Sync a checkout, on behalf of "muddle sync".
+    """
+    vcs_handler = builder.db.get_checkout_vcs(co_label)
+    vcs_handler.sync(builder, co_label, verbose=verbose, sync=sync)
+
 # -----------------------------------------------------------------------------
 # Checkout "upstream" commands
 # -----------------------------------------------------------------------------
@@ -6560,6 +7407,12 @@ class UpstreamCommand(CheckoutCommand):
     verbing = 'Pushing'
     direction = 'to'
 
+    # Does our verb fetch from the upstream repositories?
+    fetches = False
+
+    # How many checkout/upstream pairs to do at once (see "-j")
+    jobs = 1
+
     def with_build_tree(self, builder, current_dir, args):
         """Our command line is somewhat differently shaped.
 
@@ -6569,6 +7422,10 @@ class UpstreamCommand(CheckoutCommand):
         labels = []
         upstream_names = []
         had_upstream_switch = False
+        args = list(args)
+        while args and args[0] in ('-j', '-jobs'):
+            self.jobs = self._jobs_from_args(args[0], args[1:])
+            args = args[2:]
         for word in args:
             if word in ('-u', '-upstream'):
                 if had_upstream_switch:
@@ -6610,6 +7467,30 @@ class UpstreamCommand(CheckoutCommand):
     def build_these_labels(self, builder, labels, upstream_names, no_op):
         get_checkout_repo = builder.db.get_checkout_repo
         get_upstream_repos = builder.db.get_upstream_repos
+        jobs = self.jobs
+
+        if self.fetches and not no_op:
+            co_repos = []
+            for co in labels:
+                for repo, names in get_upstream_repos(get_checkout_repo(co),
+                                                      upstream_names):
+                    co_repos.append((co, repo))
+            _fetch_shared_repositories(builder, co_repos, jobs)
+
+        if jobs > 1 and not no_op:
+            with utils.sharing_ssh_connections():
+                self.handle_labels_in_parallel(builder, labels, upstream_names, jobs)
+        else:
+            self.handle_labels(builder, labels, upstream_names, no_op)
+
+    def handle_labels(self, builder, labels, upstream_names, no_op):
+        """Do our verb for each checkout, one at a time.
+
+        We stop at the first problem.
+        """
+        get_checkout_repo = builder.db.get_checkout_repo
+        get_upstream_repos = builder.db.get_upstream_repos
+
         for co in labels:
             orig_repo = get_checkout_repo(co)
             upstreams = get_upstream_repos(orig_repo, upstream_names)
@@ -6638,6 +7519,69 @@ class UpstreamCommand(CheckoutCommand):
                     print
                 print 'Nowhere to %s %s %s'%(self.verb, co, self.direction)
 
+    def handle_labels_in_parallel(self, builder, labels, upstream_names, jobs):
+        """Do our verb for each checkout, up to 'jobs' checkouts at a time.
+
+        Each checkout's upstreams are done one after another, and no more
+        than JOBS_PER_HOST checkouts whose (first) upstream is on the same
+        host are done at the same time. Any problems are reported together
+        at the end.
+        """
+        get_checkout_repo = builder.db.get_checkout_repo
+        get_upstream_repos = builder.db.get_upstream_repos
+
+        work = []
+        for co in labels:
+            upstreams = get_upstream_repos(get_checkout_repo(co), upstream_names)
+            if upstreams:
+                # Make sure we've got our checkout checked out (!)
+                builder.build_label(co)
+                work.append((co, upstreams))
+            else:
+                print
+                print 'Nowhere to %s %s %s'%(self.verb, co, self.direction)
+
+        def report(result):
+            sys.stdout.write(result.output)
+
+        results = utils.run_in_parallel_by_group(self.handle_upstreams,
+                                                 [(builder, co, co_upstreams)
+                                                     for co, co_upstreams in work],
+                                                 [_remote_host(co_upstreams[0][0].url)
+                                                     for co, co_upstreams in work],
+                                                 jobs, JOBS_PER_HOST, callback=report)
+        failed = []
+        for result in results:
+            if result.error is None:
+                failed.extend(result.value)
+            else:
+                failed.append((work[result.index][0], result.error))
+        if failed:
+            pairs = sum(len(upstreams) for co, upstreams in work)
+            _report_checkout_failures(failed)
+            raise GiveUp('Unable to %s %d of %d checkout/upstream pair%s'%(self.verb,
+                         len(failed), pairs, '' if pairs == 1 else 's'))
+
+    def handle_upstreams(self, builder, co_label, upstreams):
+        """Do our verb for a checkout and each of its upstreams, in turn.
+
+        Returns a list of (description, error text) for each upstream
+        for which we failed.
+        """
+        failed = []
+        for repo, names in upstreams:
+            print
+            print '%s %s %s %s (%s)'%(self.verbing,
+                    co_label, self.direction, repo, ', '.join(names))
+            try:
+                # Arbitrarily use the first of those names as the name that
+                # the VCS (might) remember for this upstream.
+                self.handle_label(builder, co_label, names[0], repo)
+            except GiveUp as e:
+                print e
+                failed.append(('%s %s %s'%(co_label, self.direction, repo), str(e)))
+        return failed
+
     def handle_label(self, builder, co_label, upstream_name, repo):
         vcs_handler = version_control.vcs_handler_for(builder, co_label)
         self.do_our_verb(builder, co_label, vcs_handler, upstream_name, repo)
@@ -6645,7 +7589,7 @@ class UpstreamCommand(CheckoutCommand):
 @command('push-upstream', CAT_CHECKOUT)
 class PushUpstream(UpstreamCommand):
     """
-    :Syntax: muddle push-upstream [ <checkout> ... ] -u[pstream] <name> ...
+    :Syntax: muddle push-upstream [-j <N>] [ <checkout> ... ] -u[pstream] <name> ...
 
     For each checkout, push to the named upstream repositories.
 
@@ -6678,6 +7622,13 @@ class PushUpstream(UpstreamCommand):
     upstream with the right name does not count as a "problem" for this
     purpose.
 
+    With '-j <N>' (or '-jobs <N>'), which must come first, up to <N>
+    checkouts are done at the same time, each in its own process, but no
+    more than 4 at a time for upstreams on the same host. In this case we
+    do not stop at the first problem - instead, all of the problems are
+    reported together at the end. As for "muddle push -j", connections made
+    by ssh to the same host share a single ssh connection.
+
     Use "muddle query upstream-repos [<checkout>]" to find out about the
     available upstream repositories.
     """
@@ -6697,7 +7648,7 @@ class PushUpstream(UpstreamCommand):
 @command('pull-upstream', CAT_CHECKOUT)
 class PullUpstream(UpstreamCommand):
     """
-    :Syntax: muddle pull-upstream [ <checkout> ... ] -u[pstream] <name> ...
+    :Syntax: muddle pull-upstream [-j <N>] [ <checkout> ... ] -u[pstream] <name> ...
 
     For each checkout, pull from the named upstream repositories.
 
@@ -6733,8 +7684,19 @@ class PullUpstream(UpstreamCommand):
     upstream with the right name does not count as a "problem" for this
     purpose.
 
+    With '-j <N>' (or '-jobs <N>'), which must come first, up to <N>
+    checkouts are done at the same time, each in its own process, but no
+    more than 4 at a time for upstreams on the same host. In this case we
+    do not stop at the first problem - instead, all of the problems are
+    reported together at the end. As for "muddle push -j", connections made
+    by ssh to the same host share a single ssh connection.
+
     Also, pull-upstream does not alter the meaning of "_just_pulled".
 
+    If several checkouts have the same (git) upstream repository, then that
+    repository is only fetched once, into a shared store in .muddle/git-shared,
+    and the checkouts then fetch from there.
+
     Use "muddle query upstream-repos [<checkout>]" to find out about the
     available upstream repositories.
     """
@@ -6745,6 +7707,7 @@ class PullUpstream(UpstreamCommand):
     verb = 'pull'
     verbing = 'Pulling'
     direction = 'from'
+    fetches = True
 
     def do_our_verb(self, builder, co_label, vcs_handler, upstream, repo):
         # And we can then use that to do the pull
@@ -6883,7 +7846,7 @@ class Retry(AnyLabelCommand):
 @command('branch-tree', CAT_MISC)        # or perhaps CAT_CHECKOUT
 class BranchTree(Command):
     """
-    :Syntax: muddle branch-tree [-c[check] | -f[orce]] [-v] <branch>
+    :Syntax: muddle branch-tree [-c[check] | -f[orce]] [-v] [-j <N>] <branch>
 
     Move all checkouts in the build tree (if they support it) to branch
     <branch>.
@@ -6919,6 +7882,12 @@ class BranchTree(Command):
     If the '-v' flag is used, report on each checkout (actually, each checkout
     directory) as it is entered.
 
+    With '-j <N>' (or '-jobs <N>'), both the checks in step 1 and the
+    branching in step 2 are done for up to <N> checkouts at once, each in its
+    own process. All of the checks are still finished before any checkout is
+    branched. Without '-j', the checkouts are dealt with one at a time, and
+    muddle stops at the first unexpected problem.
+
     It is recommended that <branch> include the build name (as specified
     using ``builder.build_name = <name>`` in the build description).
 
@@ -6994,6 +7963,8 @@ class BranchTree(Command):
                         '-check': 'check',
                         '-v': 'verbose',
                        }
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
 
     def with_build_tree(self, builder, current_dir, args):
 
@@ -7020,8 +7991,11 @@ class BranchTree(Command):
 
         all_checkouts = builder.all_checkout_labels(LabelTag.CheckedOut)
 
+        jobs = self.get_jobs()
+
         if not force:
-            problems = self.check_checkouts(builder, all_checkouts, branch, verbose)
+            problems = self.check_checkouts(builder, all_checkouts, branch,
+                                            verbose, jobs)
             if problems:
                 raise GiveUp('Unable to branch-tree to %s, because:\n  %s'%(branch,
                              '\n  '.join(sorted(problems))))
@@ -7030,7 +8004,8 @@ class BranchTree(Command):
                 print 'No problems expected for "branch-tree %s"'%branch
 
         if not check:
-            branched = self.branch_checkouts(builder, all_checkouts, branch, verbose)
+            branched = self.branch_checkouts(builder, all_checkouts, branch,
+                                             verbose, jobs)
             if branched:
                 print
                 print "If you want the tree branching to be persistent, remember to edit"
@@ -7042,13 +8017,17 @@ class BranchTree(Command):
                 print
                 print "to the describe_to() function, and check it in/push it."
 
-    def check_checkouts(self, builder, checkouts, branch, verbose):
+    def check_checkouts(self, builder, checkouts, branch, verbose, jobs=1):
         """
         Check if we can branch our checkouts.
 
+        The checks that need to ask the VCS are done for up to 'jobs'
+        checkouts at a time.
+
         Returns a list of problem reports, one per problem checkout.
         """
         problems = []
+        to_ask = []
         for co in checkouts:
             co_data = builder.db.get_checkout_data(co)
             vcs_handler = co_data.vcs_handler
@@ -7076,14 +8055,22 @@ class BranchTree(Command):
             elif 'shallow_checkout' in co_data.options:
                 problems.append('%s is shallow, so cannot be branched'%co)
 
-            elif vcs_handler.branch_exists(builder, co, branch, show_pushd=verbose):
+            else:
+                to_ask.append(co)
+
+        done, failed = _for_each_checkout(builder, _branch_exists, to_ask,
+                                          (branch, verbose), jobs)
+        for co, exists in done:
+            if exists:
                 problems.append('%s already has a branch called %s'%(co, branch))
+        for co, text in failed:
+            problems.append('%s: %s'%(co, text.strip()))
 
         return problems
 
-    def branch_checkouts(self, builder, all_checkouts, branch, verbose):
+    def branch_checkouts(self, builder, all_checkouts, branch, verbose, jobs=1):
         """
-        Branch our checkouts.
+        Branch our checkouts, up to 'jobs' at a time.
 
         If we can't, say so but continue anyway.
 
@@ -7095,6 +8082,7 @@ class BranchTree(Command):
         selected = 0
         problems = []
         already_exists_in = []
+        to_branch = []
         for co in all_checkouts:
             co_data = builder.db.get_checkout_data(co)
             vcs_handler = co_data.vcs_handler
@@ -7132,15 +8120,15 @@ class BranchTree(Command):
                 problems.append((co, "shallow checkout"))
                 continue
 
-            if vcs_handler.branch_exists(builder, co, branch, show_pushd=verbose):
-                already_exists_in.append(co)
-            else:
-                vcs_handler.create_branch(builder, co, branch, show_pushd=False,
-                                          verbose=verbose)
-                created += 1
+            to_branch.append(co)
 
-            vcs_handler.goto_branch(builder, co, branch, show_pushd=False,
-                                    verbose=verbose)
+        done, failed = _for_each_checkout(builder, _branch_checkout, to_branch,
+                                          (branch, verbose), jobs)
+        for co, was_created in done:
+            if was_created:
+                created += 1
+            else:
+                already_exists_in.append(co)
             selected += 1
 
         print 'Successfully created  branch %s in %d out of %d checkout%s'%(branch,
@@ -7163,9 +8151,37 @@ class BranchTree(Command):
             print 'Unable to branch the following:'
             for co, text in problems:
                 print '  %.*s (%s)'%(maxlen, co, text)
+        if failed:
+            _report_checkout_failures(failed)
+            raise GiveUp('Unable to branch %d of %d checkout%s'%(len(failed),
+                         len(to_branch), '' if len(to_branch) == 1 else 's'))
 
         return selected
 
+def _branch_exists(builder, co_label, branch, verbose):
+    """Does 'co_label' have a branch called 'branch'? For "muddle branch-tree".
+    """
+    vcs_handler = builder.db.get_checkout_vcs(co_label)
+    return vcs_handler.branch_exists(builder, co_label, branch, show_pushd=verbose)
+
+def _branch_checkout(builder, co_label, branch, verbose):
+    """Move 'co_label' to branch 'branch', on behalf of "muddle branch-tree".
+
+    Creates the branch first if it does not already exist.
+
+    Returns True if the branch was created, False if it already existed.
+    """
+    vcs_handler = builder.db.get_checkout_vcs(co_label)
+    if vcs_handler.branch_exists(builder, co_label, branch, show_pushd=verbose):
+        created = False
+    else:
+        vcs_handler.create_branch(builder, co_label, branch, show_pushd=False,
+                                  verbose=verbose)
+        created = True
+    vcs_handler.goto_branch(builder, co_label, branch, show_pushd=False,
+                            verbose=verbose)
+    return created
+
 
 @command('veryclean', CAT_MISC)
 class VeryClean(Command):
@@ -7561,6 +8577,74 @@ class CopyWithout(Command):
         utils.copy_without(src_dir, dst_dir, without, object_exactly=True,
                 preserve=True, force=force)
 
+@subcommand('mirror', 'update', CAT_MISC)
+class MirrorUpdate(Command):
+    """
+    :Syntax: muddle mirror update [-j <N>]
+
+    Update all of the local git mirrors, from their remote repositories.
+
+    If the environment variable MUDDLE_GIT_MIRRORS is set to the name of a
+    directory, then muddle keeps a bare "mirror" of each git repository that
+    it clones in that directory, creating it the first time that repository
+    is cloned. Subsequent clones of the same repository borrow objects from
+    the mirror (using "git clone --reference --dissociate"), so that only
+    objects that are not already in the mirror need to be fetched.
+
+    Mirrors are not updated when they are used. This command fetches any
+    changes into all of the mirrors, whether or not they are used by the
+    current build tree (if any).
+
+    With '-j <N>' (or '-jobs <N>'), up to <N> mirrors are updated at the same
+    time, each in its own process.
+
+    Clones copy the objects they borrowed, so they do not depend on the
+    mirror afterwards, and mirrors may safely be deleted.
+    """
+
+    allowed_value_switches = {'-j':'jobs',
+                              '-jobs':'jobs'}
+
+    def requires_build_tree(self):
+        return False
+
+    def with_build_tree(self, builder, current_dir, args):
+        self.do_update(args)
+
+    def without_build_tree(self, muddle_binary, current_dir, args):
+        self.do_update(args)
+
+    def do_update(self, args):
+        self.remove_switches(args, allowed_more=False)
+        jobs = self.get_jobs()
+
+        mirrors_dir = git_mirrors.mirrors_dir()
+        if mirrors_dir is None:
+            raise GiveUp('Git mirrors are not being used, as %s is not'
+                         ' set'%git_mirrors.MIRRORS_ENV_VAR)
+
+        mirrors = git_mirrors.all_mirrors(mirrors_dir)
+        if self.no_op():
+            print 'Update mirrors in %s:'%mirrors_dir
+            for path in mirrors:
+                print '  %s'%os.path.basename(path)
+            return
+
+        if not mirrors:
+            print 'There are no mirrors in %s'%mirrors_dir
+            return
+
+        failures = git_mirrors.update_all_mirrors(jobs, mirrors_dir)
+        if failures:
+            print '\nThe following mirrors could not be updated:'
+            for path, error in failures:
+                print
+                print os.path.basename(path)
+                print error.rstrip()
+            raise GiveUp()
+        print
+        print 'Updated %d mirror%s'%(len(mirrors), '' if len(mirrors)==1 else 's')
+
 @command('subst', CAT_MISC)
 class Subst(Command):
     """
@@ -259,6 +259,8 @@ class Database(object):
                                           '_just_pulled'))
 
         self.checkout_data = {}
+        # Incremented whenever checkout_data changes
+        self.checkout_data_changes = 0
 
         self.checkout_licenses = {}
         self.checkout_license_files = {}
@@ -381,6 +383,7 @@ class Database(object):
         for co_obj in other_db.checkout_data.values():
             co_obj.move_to_subdomain(other_domain_name)
         self.checkout_data.update(other_db.checkout_data)
+        self.checkout_data_changes += 1
 
         self.checkout_licenses.update(other_db.checkout_licenses)
         self.checkout_license_files.update(other_db.checkout_license_files)
@@ -549,6 +552,7 @@ class Database(object):
     def set_checkout_data(self, checkout_label, co_data):
         key = normalise_checkout_label(checkout_label)
         self.checkout_data[key] = co_data
+        self.checkout_data_changes += 1
 
     def get_checkout_data(self, checkout_label):
         key = normalise_checkout_label(checkout_label)
@@ -1196,6 +1200,75 @@ class Database(object):
                             label.type,
                             label.name, leaf)
 
+    def revision_cache_file_name(self, co_label):
+        """
+        The file in which we cache revision/branch information for a checkout.
+
+        See RevisionCache in muddled.version_control.
+        """
+        if co_label.domain:
+            root = os.path.join(self.root_path, domain_subpath(co_label.domain))
+        else:
+            root = self.root_path
+
+        return os.path.join(root, ".muddle", "revisions", co_label.name)
+
+    def fingerprint_file_name(self, pkg_label):
+        """
+        The file in which we remember the source fingerprints of the
+        checkouts a package was built from.
+
+        See set_source_fingerprints().
+        """
+        if pkg_label.domain:
+            root = os.path.join(self.root_path, domain_subpath(pkg_label.domain))
+        else:
+            root = self.root_path
+
+        if pkg_label.role is None:
+            leaf = "_default"
+        else:
+            leaf = pkg_label.role
+
+        return os.path.join(root, ".muddle", "fingerprints", pkg_label.name, leaf)
+
+    def set_source_fingerprints(self, pkg_label, fingerprints):
+        """
+        Remember the source fingerprints a package was built from.
+
+        'fingerprints' is a dictionary of {checkout label : fingerprint}, as
+        returned by each checkout's VCS handler's source_fingerprint() method.
+        A checkout whose fingerprint is None is not remembered.
+        """
+        file_name = self.fingerprint_file_name(pkg_label)
+        utils.ensure_dir(os.path.dirname(file_name), verbose=False)
+        with open(file_name, 'w') as fd:
+            for co_label in sorted(fingerprints.keys()):
+                if fingerprints[co_label] is not None:
+                    fd.write('%s %s\n'%(co_label, fingerprints[co_label]))
+
+    def get_source_fingerprints(self, pkg_label):
+        """
+        Return the source fingerprints a package was last built from.
+
+        Returns a dictionary of {checkout label : fingerprint}, or None if
+        we have no record of building this package.
+        """
+        fingerprints = {}
+        try:
+            with open(self.fingerprint_file_name(pkg_label)) as fd:
+                for line in fd:
+                    words = line.split()
+                    if len(words) != 2:     # Ignore anything we don't understand
+                        continue
+                    co_label = depend.Label.from_string(words[0])
+                    fingerprints[co_label] = words[1]
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return fingerprints
+
     def is_tag(self, label):
         """
         Is this label asserted?
@@ -136,7 +136,7 @@ class Label(object):
                              re.VERBOSE)
 
     def __init__(self, type, name, role=None, tag='*', transient=False,
-                 system=False, domain=None):
+                 system=False, domain=None, scope=None):
         """
         :type:      What kind of label this is. The standard muddle values are
                     "checkout", "package" and "deployment". These values are
@@ -172,6 +172,9 @@ class Label(object):
                     label corresponds to. Nested "tail recursive" parenthesised
                     components may be used to specify sub-domains (but this is
                     not recommended). The domain defaults to the current build.
+        :scope:     If given, the DomainScope that 'domain' is relative to.
+                    The label's full domain name then changes as that scope
+                    is included in other builds (see ScopedLabel).
 
         The role may be None, indicating (for instance) that roles are not
         relevant to this particular label.
@@ -239,8 +242,15 @@ class Label(object):
         if domain is not None:
             Label.split_domain(domain)
 
+        if scope is not None:
+            self.__class__ = ScopedLabel
+            self._scope = scope
+            self._relative_domain = domain
+            self._stamp = None
+        else:
+            self._domain = domain
+
         self._type = type
-        self._domain = domain
         self._name = name
         self._role = role
         self._tag = tag
@@ -321,6 +331,7 @@ class Label(object):
         Label._check_part('role', new_role)
         cp = self.copy()
         cp._role = new_role
+        cp.rehash()
         return cp
 
     def copy_with_domain(self, new_domain):
@@ -1068,14 +1079,19 @@ class Rule(object):
         """
         Whenever source appears in our dependencies, replace it with source.unify(target)
         """
+        self.unify_all_dependencies([(source, target)])
+
+    def unify_all_dependencies(self, pairs):
+        """
+        Apply each (source, target) unification in 'pairs' to our dependencies.
+
+        This is equivalent to calling unify_dependencies() for each pair in
+        turn, but only rebuilds our set of dependencies once.
+        """
         new_deps = set()
 
         for d in self.deps:
-            if (d.unifies(source)):
-                copied_d = d.copy_and_unify_with(target)
-                new_deps.add(copied_d)
-            else:
-                new_deps.add(d)
+            new_deps.add(unify_label(d, pairs))
 
         self.deps = new_deps
 
@@ -1254,6 +1270,9 @@ class RuleSet(object):
     def __init__(self):
         self.map = { }
         self.cache = { }
+        # Incremented whenever our rules change, for the benefit of anyone
+        # else who caches things derived from them
+        self.generation = 0
 
     def add(self, rule):
         """
@@ -1266,6 +1285,7 @@ class RuleSet(object):
         """
         # Invalidate our look-up cache
         self.cache = { }
+        self.generation += 1
 
         # Do we have the same target?
         inst = self.map.get(rule.target, None)
@@ -1331,7 +1351,7 @@ class RuleSet(object):
             for k in self.map.keys():
                 if (k.match(target) is not None):
                     result_set.add(k)
-        elif target in self.map.keys():
+        elif target in self.map:
             result_set.add(target)
 
         return result_set
@@ -1352,6 +1372,7 @@ class RuleSet(object):
             rv = Rule(target, None)
             self.map[target] = rv
             self.cache = { }
+            self.generation += 1
 
         return rv
 
@@ -1409,25 +1430,27 @@ class RuleSet(object):
 
         This is a pain, and depends heavily on CatenatedObject
         """
+        self.unify_all([(source, target)])
+
+    def unify_all(self, pairs):
+        """
+        Merge each source into its target, for each (source, target) in 'pairs'.
+
+        This is equivalent to calling unify() for each pair in turn, but only
+        rebuilds our map (and each rule's dependencies) once, rather than once
+        per pair.
+        """
 
         new_map = { }
 
 
         # First, collect anything that might be rewritten.
         for (k,v) in self.map.items():
-            new_k = None
             new_v = v
 
-            if (k.unifies(source)):
-                copied_source = k.copy_and_unify_with(target)
-                new_v.replace_target(copied_source)
-                new_k = copied_source
-                if False:
-                    print "Ruleset: rewrite src = %s\n" \
-                          "                   k = %s\n" \
-                          "                    to %s"%(source,k,copied_source)
-            else:
-                new_k = k
+            new_k = unify_label(k, pairs)
+            if new_k is not k:
+                new_v.replace_target(new_k)
 
             if (new_k in new_map):
                 old_v = new_map[new_k]
@@ -1438,11 +1461,12 @@ class RuleSet(object):
         # Now, rename everything in the dependencies and copy
         # back ..
         for (k,v) in new_map.items():
-            v.unify_dependencies(source, target)
+            v.unify_all_dependencies(pairs)
 
         # .. and new_map is the new map.
         self.map = new_map
         self.cache = { }
+        self.generation += 1
 
 
     def to_string(self, matchLabel = None,
@@ -1498,6 +1522,157 @@ class RuleSet(object):
     def __str__(self):
         return self.to_string()
 
+def unify_label(label, pairs):
+    """
+    Apply each (source, target) unification in 'pairs' to 'label', in order.
+
+    Returns 'label' itself if none of the sources unify with it, otherwise
+    a new label.
+
+        >>> a = Label.from_string('package:fred{x86}/built')
+        >>> b = Label.from_string('package:jim{x86}/*')
+        >>> c = Label.from_string('package:bob{arm}/*')
+        >>> unify_label(a, [])
+        Label('package', 'fred', role='x86', tag='built')
+        >>> unify_label(a, [(a.copy_with_tag('*'), b)])
+        Label('package', 'jim', role='x86', tag='built')
+        >>> unify_label(a, [(a.copy_with_tag('*'), b), (b, c)])
+        Label('package', 'bob', role='arm', tag='built')
+    """
+    for source, target in pairs:
+        if label.unifies(source):
+            label = label.copy_and_unify_with(target)
+    return label
+
+class DomainScope(object):
+    """
+    The (sub)domain that the labels of a build belong to.
+
+    When a build is included as a subdomain, every label it uses must have
+    the subdomain's name added to its domain - and if the including build is
+    itself a subdomain, the same thing happens again when it is included in
+    its turn, and so on.
+
+    Rather than changing every label at each level, the labels of a subdomain
+    are adopted by its scope, once, when it is included. Each adopted label
+    remembers the scope, and its domain relative to it (see ScopedLabel).
+    Labels that have already been adopted by the scope of a subdomain of our
+    own are left alone - instead, that scope is placed inside ours. So each
+    label is only changed once, however deeply it ends up nested, and works
+    out its full domain name the next time it is asked for it.
+
+        >>> inner = DomainScope()
+        >>> a = Label.from_string('checkout:fred/*')
+        >>> b = Label.from_string('checkout:(deeper)jim/*')
+        >>> inner.adopt([a, b])
+        >>> inner.include('sub')
+        >>> print a, b
+        checkout:(sub)fred/* checkout:(sub(deeper))jim/*
+        >>> outer = DomainScope()
+        >>> c = Label('checkout', 'bob', domain='other', scope=outer)
+        >>> outer.adopt([a, c])
+        >>> outer.include('top')
+        >>> print a, b, c
+        checkout:(top(sub))fred/* checkout:(top(sub(deeper)))jim/* checkout:(top(other))bob/*
+    """
+
+    def __init__(self):
+        self.name = None
+        self.parent = None
+        # Incremented whenever our full domain name changes, so that our
+        # labels know to work it out again
+        self.generation = 0
+        self._children = []
+
+    def include(self, name):
+        """
+        Our labels are now in the domain 'name'.
+
+        If the build including us is itself included as a subdomain, its
+        scope will take us in when it adopts our labels.
+        """
+        self.name = name
+        self._changed()
+
+    def adopt(self, labels):
+        """
+        Make each of 'labels' relative to this scope.
+
+        Labels that already belong to another scope (because they come from
+        a subdomain of ours) are not changed, but that scope is placed inside
+        ours, if it is not already.
+
+        'labels' may contain the same label more than once.
+        """
+        placed = set()
+        for label in labels:
+            if isinstance(label, ScopedLabel):
+                scope = label._scope
+                if scope is self or scope in placed:
+                    continue
+                placed.add(scope)
+                while scope.parent is not None:
+                    scope = scope.parent
+                if scope is not self:
+                    scope.parent = self
+                    self._children.append(scope)
+                    scope._changed()
+            else:
+                domain = label.__dict__.pop('_domain')
+                label.__class__ = ScopedLabel
+                label._scope = self
+                label._relative_domain = domain
+                label._stamp = None
+
+    def _changed(self):
+        self.generation += 1
+        for child in self._children:
+            child._changed()
+
+    def qualify(self, domain):
+        """
+        Return the full domain name for 'domain', relative to this scope.
+
+        The result is relative to the innermost scope that has not (yet) been
+        included anywhere.
+        """
+        scope = self
+        while scope is not None and scope.name is not None:
+            if domain:
+                domain = '%s(%s)'%(scope.name, domain)
+            else:
+                domain = scope.name
+            scope = scope.parent
+        return domain
+
+class ScopedLabel(Label):
+    """
+    A Label whose domain is relative to a DomainScope.
+
+    The full domain name is worked out when it is needed, and remembered
+    until the scope (or one of the scopes it is inside) is included in
+    another build. In all other respects, it behaves exactly as a Label.
+
+    Setting the domain of a ScopedLabel (for instance, in a copy of it with a
+    new domain) gives it a domain that is not relative to anything, and so
+    makes it a plain Label again.
+    """
+
+    def _get_domain(self):
+        scope = self._scope
+        if self._stamp != scope.generation:
+            self._full_domain = scope.qualify(self._relative_domain)
+            self._stamp = scope.generation
+        return self._full_domain
+
+    def _set_domain(self, domain):
+        self.__class__ = Label
+        for name in ('_scope', '_relative_domain', '_full_domain', '_stamp'):
+            self.__dict__.pop(name, None)
+        self._domain = domain
+
+    _domain = property(_get_domain, _set_domain)
+
 def depend_chain(action, label, tags, ruleset):
     """
     Add a chain of dependencies to the given ruleset.
@@ -12,11 +12,13 @@ into deployment directories, usually to be processed by some external tool.
 """
 
 import os
+import tempfile
 
 import muddled.depend as depend
 import muddled.utils as utils
 import muddled.filespec as filespec
 import muddled.deployment as deployment
+import muddled.deployments.privileged as privileged
 
 from muddled.depend import Action, Label
 from muddled.utils import GiveUp, MuddleBug
@@ -31,7 +33,26 @@ class InstructionImplementor(object):
         pass
 
     def apply(self, builder, instruction, role, path):
-        pass
+        """
+        Apply the instruction, in this process.
+
+        By default, this runs each of the commands returned by
+        'operations()'.
+        """
+        for op in self.operations(builder, instruction, role, path):
+            utils.run0(op)
+
+    def operations(self, builder, instruction, role, path):
+        """
+        Return the commands needed to apply the instruction.
+
+        This is a list of argument lists (for instance, ``[["chmod", "0755",
+        "/a/file"]]``). Working these out in advance means that instructions
+        needing privilege can be handed to the privileged helper (see
+        muddled.deployments.privileged), instead of re-running muddle under
+        sudo.
+        """
+        return []
 
     def needs_privilege(self, builder, instr, role, path):
         False
@@ -42,14 +63,15 @@ class CollectApplyChmod(InstructionImplementor):
         return True
 
     def apply(self, builder, instr, role, path):
+        InstructionImplementor.apply(self, builder, instr, role, path)
+        return True
 
+    def operations(self, builder, instr, role, path):
         dp = filespec.FSFileSpecDataProvider(path)
 
         files = dp.abs_match(instr.filespec)
         # @todo We _really_ need to use xargs here ..
-        for f in files:
-            utils.run0(["chmod", instr.new_mode, f])
-        return True
+        return [ ["chmod", instr.new_mode, f] for f in files ]
 
     def needs_privilege(self, builder, instr, role, path):
         # You don't, in general, need root to change permissions.
@@ -61,10 +83,14 @@ class CollectApplyChown(InstructionImplementor):
     def prepare(self, builder, instr, role, path):
         return self._prep_or_apply(builder, instr, role, path, True)
 
-    def apply(self, builder, instr, role, path):
+    def operations(self, builder, instr, role, path):
         return self._prep_or_apply(builder, instr, role, path, False)
 
     def _prep_or_apply(self, builder, instr, role, path, is_prepare):
+        """
+        If 'is_prepare' is true, remove the files concerned, otherwise
+        return the commands needed to chown them.
+        """
 
         # NB: take care to apply a chown command to the file named,
         # even if it is a symbolic link (the default is --reference,
@@ -81,6 +107,7 @@ class CollectApplyChown(InstructionImplementor):
             cmd = ["chown", "--no-dereference",
                    "%s:%s"%(instr.new_user, instr.new_group)]
 
+        ops = []
         for f in files:
             if is_prepare:
                 # @TODO: This doesn't handle directories that have been
@@ -91,7 +118,8 @@ class CollectApplyChown(InstructionImplementor):
                 #   or just run the whole rsync under sudo.
                 utils.run0(["rm", "-f", f])
             else:
-                utils.run0([cmd, f])
+                ops.append(cmd + [f])
+        return ops
 
     def needs_privilege(self, builder, instr, role, path):
         return True
@@ -251,22 +279,21 @@ class CollectDeploymentBuilder(Action):
                                      " found in label %s (filename %s)"%(lbl, fn))
 
 
-        print "Rerunning muddle to apply instructions .. "
-
-        permissions_label = Label(utils.LabelType.Deployment,
-                                  label.name, None, # XXX label.role,
-                                  utils.LabelTag.InstructionsApplied,
-                                  domain = label.domain)
-
-        cmd = [builder.muddle_binary, "buildlabel", str(permissions_label)]
+        deploy_path = builder.deploy_path(label)
         if need_root_for:
+            # Work out exactly what needs doing, and hand just that to
+            # our privileged helper, rather than re-running all of muddle
             print "I need root to do %s - sorry! - running sudo .."%(', '.join(sorted(need_root_for)))
-            utils.run0(["sudo"] + cmd)
+            ops = self.instruction_operations(builder, label, deploy_path)
+            run_privileged_operations(ops)
         else:
-            utils.run0(cmd)
-
-    def apply_instructions(self, builder, label, prepare, deploy_path):
+            self.apply_instructions(builder, label, False, deploy_path)
 
+    def _obeyed_instructions(self, builder):
+        """
+        Yield (label, filename, instructions) for each instruction file we
+        should obey.
+        """
         for asm in self.assemblies:
             lbl = Label(utils.LabelType.Package, '*', asm.from_label.role,
                         '*', domain = asm.from_label.domain)
@@ -274,21 +301,63 @@ class CollectDeploymentBuilder(Action):
             if not asm.obeyInstructions:
                 continue
 
-            instr_list = builder.load_instructions(lbl)
-            for (lbl, fn, instrs) in instr_list:
-                print "%s deployment: Applying instructions for role %s, label %s .. "%(self.what, lbl.role, lbl)
-                for instr in instrs:
-                    # Obey this instruction.
-                    iname = instr.outer_elem_name()
-                    print 'Instruction:', iname
-                    if iname in self.app_dict:
-                        if prepare:
-                            self.app_dict[iname].prepare(builder, instr, lbl.role, deploy_path)
-                        else:
-                            self.app_dict[iname].apply(builder, instr, lbl.role, deploy_path)
+            for item in builder.load_instructions(lbl):
+                yield item
+
+    def apply_instructions(self, builder, label, prepare, deploy_path):
+
+        for (lbl, fn, instrs) in self._obeyed_instructions(builder):
+            print "%s deployment: Applying instructions for role %s, label %s .. "%(self.what, lbl.role, lbl)
+            for instr in instrs:
+                # Obey this instruction.
+                iname = instr.outer_elem_name()
+                print 'Instruction:', iname
+                if iname in self.app_dict:
+                    if prepare:
+                        self.app_dict[iname].prepare(builder, instr, lbl.role, deploy_path)
                     else:
-                        raise GiveUp("%s deployments don't know about instruction %s"%(self.what, iname) +
-                                     " found in label %s (filename %s)"%(lbl, fn))
+                        self.app_dict[iname].apply(builder, instr, lbl.role, deploy_path)
+                else:
+                    raise GiveUp("%s deployments don't know about instruction %s"%(self.what, iname) +
+                                 " found in label %s (filename %s)"%(lbl, fn))
+
+    def instruction_operations(self, builder, label, deploy_path):
+        """
+        Return the list of commands that applying our instructions needs.
+
+        Each command is an argument list - see InstructionImplementor.operations
+        """
+        ops = []
+        for (lbl, fn, instrs) in self._obeyed_instructions(builder):
+            for instr in instrs:
+                iname = instr.outer_elem_name()
+                if iname in self.app_dict:
+                    ops.extend(self.app_dict[iname].operations(builder, instr,
+                                                               lbl.role, deploy_path))
+                else:
+                    raise GiveUp("%s deployments don't know about instruction %s"%(self.what, iname) +
+                                 " found in label %s (filename %s)"%(lbl, fn))
+        return ops
+
+
+def run_privileged_operations(ops):
+    """
+    Run the commands in 'ops' as root, using sudo.
+
+    'ops' is a list of argument lists, as returned by
+    InstructionImplementor.operations(). They are written to a temporary
+    file, which is then read by the (small) privileged helper script in
+    muddled.deployments.privileged, run under sudo.
+    """
+    if not ops:
+        return
+    fd, filename = tempfile.mkstemp(prefix='muddle-instructions-', suffix='.json')
+    os.close(fd)
+    try:
+        privileged.write_operations(ops, filename)
+        utils.run0(["sudo"] + privileged.helper_command(filename))
+    finally:
+        os.remove(filename)
 
 
 def _inside_of_deploy(builder, name, the_action):
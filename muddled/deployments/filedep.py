@@ -14,7 +14,7 @@ import muddled.deployment as deployment
 
 from muddled.depend import Action
 from muddled.deployments.collect import InstructionImplementor, \
-        CollectApplyChown, CollectApplyChmod
+        CollectApplyChown, CollectApplyChmod, run_privileged_operations
 
 class FIApplyChmod(CollectApplyChmod):
 
@@ -26,7 +26,7 @@ class FIApplyMknod(InstructionImplementor):
     def prepare(self, builder, instr, role, path):
         return False
 
-    def apply(self, builder, instr, role, path):
+    def operations(self, builder, instr, role, path):
 
         if (instr.type == "char"):
             mknod_type = "c"
@@ -34,10 +34,9 @@ class FIApplyMknod(InstructionImplementor):
             mknod_type = "b"
 
         abs_file = os.path.join(path, instr.file_name)
-        utils.run0("mknod %s %s %s %s"%(abs_file, mknod_type,
-                                        instr.major, instr.minor))
-        utils.run0("chown %s:%s %s"%(instr.uid, instr.gid, abs_file))
-        utils.run0("chmod %s %s"%(instr.mode, abs_file))
+        return [ ["mknod", abs_file, mknod_type, instr.major, instr.minor],
+                 ["chown", "%s:%s"%(instr.uid, instr.gid), abs_file],
+                 ["chmod", instr.mode, abs_file] ]
 
     def needs_privilege(self, builder, instr, role, path):
         return True
@@ -131,8 +130,9 @@ class FileDeploymentBuilder(Action):
             utils.recursively_copy(install_dir, deploy_dir, object_exactly=True)
 
         # This is somewhat tricky as it potentially requires privilege elevation.
-        # Privilege elevation is done by hooking back into ourselves via a
-        # build command to a label we registered earlier.
+        # If no privilege is needed, we just apply the instructions here and
+        # now. Otherwise, we work out the commands needed and run them all via
+        # a small helper under sudo (see muddled.deployments.privileged).
         #
         # Note that you cannot split instruction application - once the first
         # privilege-requiring instruction is executed, all further instructions
@@ -159,26 +159,20 @@ class FileDeploymentBuilder(Action):
                                             "instruction %s"%iname +
                                             " found in label %s (filename %s)"%(lbl, fn))
 
-        print "Rerunning muddle to apply instructions .. "
-
-        permissions_label = depend.Label(utils.LabelType.Deployment,
-                                         label.name, None, # XXX label.role,
-                                         utils.LabelTag.InstructionsApplied,
-                                         domain = label.domain)
-
         if need_root_for:
+            # Work out exactly what needs doing, and hand just that to
+            # our privileged helper, rather than re-running all of muddle
             print "I need root to do %s - sorry! - running sudo .."%(', '.join(sorted(need_root_for)))
-            utils.run0("sudo %s buildlabel '%s'"%(builder.muddle_binary,
-                                                  permissions_label))
+            ops = self.instruction_operations(builder, label)
+            run_privileged_operations(ops)
         else:
-            utils.run0("%s buildlabel '%s'"%(builder.muddle_binary,
-                                             permissions_label))
+            self.apply_instructions(builder, label)
 
     def apply_instructions(self, builder, label):
 
+        deploy_dir = builder.deploy_path(label)
         for role, domain in self.roles:
             lbl = depend.Label(utils.LabelType.Package, "*", role, "*", domain=domain)
-            deploy_dir = builder.deploy_path(label)
             instr_list = builder.load_instructions(lbl)
             for (lbl, fn, instrs) in instr_list:
                 print "File deployment: Applying instructions for role %s, label %s .. "%(role, lbl)
@@ -192,6 +186,28 @@ class FileDeploymentBuilder(Action):
                         raise utils.GiveUp("File deployments don't know about instruction %s"%iname +
                                             " found in label %s (filename %s)"%(lbl, fn))
 
+    def instruction_operations(self, builder, label):
+        """
+        Return the list of commands that applying our instructions needs.
+
+        Each command is an argument list - see InstructionImplementor.operations
+        """
+        ops = []
+        deploy_dir = builder.deploy_path(label)
+        for role, domain in self.roles:
+            lbl = depend.Label(utils.LabelType.Package, "*", role, "*", domain=domain)
+            instr_list = builder.load_instructions(lbl)
+            for (lbl, fn, instrs) in instr_list:
+                for instr in instrs:
+                    iname = instr.outer_elem_name()
+                    if iname in self.app_dict:
+                        ops.extend(self.app_dict[iname].operations(builder, instr,
+                                                                   role, deploy_dir))
+                    else:
+                        raise utils.GiveUp("File deployments don't know about instruction %s"%iname +
+                                            " found in label %s (filename %s)"%(lbl, fn))
+        return ops
+
 
 # Legacy function to register a deployment without domains.
 def deploy(builder, target_dir, name, roles):
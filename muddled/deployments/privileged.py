@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+"""
+Apply a precomputed list of privileged deployment operations.
+
+Some deployment instructions (chown, mknod, and so on) need root privilege
+to apply. Rather than re-running the whole of muddle under ``sudo`` (which
+means finding the build tree and loading the build description all over
+again, just to change a few file modes), the deployment works out exactly
+which commands it wants run, writes them to a file, and runs this module
+as a script under ``sudo`` to perform them::
+
+    sudo python privileged.py <operations-file>
+
+For that reason this module deliberately imports nothing from muddled -
+it must be runnable as a standalone script, with whatever Python path
+``sudo`` leaves us.
+
+The operations file is a JSON list of commands, each of which is itself a
+list of strings (i.e., an argument list suitable for passing to
+subprocess). Only a small set of commands is allowed - see
+ALLOWED_COMMANDS.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# The only commands we are prepared to run on behalf of a deployment
+ALLOWED_COMMANDS = ('chmod', 'chown', 'chgrp', 'mknod')
+
+class OperationsError(Exception):
+    pass
+
+def check_operations(operations):
+    """
+    Check that 'operations' is a list of acceptable commands.
+
+    Raises OperationsError if it is not.
+    """
+    if not isinstance(operations, list):
+        raise OperationsError('Operations must be a list, not %r'%(operations,))
+    for op in operations:
+        if not isinstance(op, list) or not op:
+            raise OperationsError('Operation must be a non-empty list,'
+                                  ' not %r'%(op,))
+        for word in op:
+            if not isinstance(word, basestring):
+                raise OperationsError('Operation %r contains non-string'
+                                      ' %r'%(op, word))
+        if op[0] not in ALLOWED_COMMANDS:
+            raise OperationsError('Operation %r is not one of the allowed'
+                                  ' commands (%s)'%(op, ', '.join(ALLOWED_COMMANDS)))
+
+def write_operations(operations, filename):
+    """
+    Write 'operations' (a list of argument lists) to 'filename'.
+    """
+    operations = [ [str(word) for word in op] for op in operations ]
+    check_operations(operations)
+    with open(filename, 'w') as fd:
+        json.dump(operations, fd, indent=1)
+
+def read_operations(filename):
+    """
+    Read and check a list of operations from 'filename'.
+    """
+    with open(filename) as fd:
+        operations = json.load(fd)
+    check_operations(operations)
+    return operations
+
+def apply_operations(operations):
+    """
+    Run each of the commands in 'operations', in order.
+
+    Stops at the first command that fails, returning its return code.
+    Returns 0 if all of the commands succeed.
+    """
+    for op in operations:
+        print '> %s'%' '.join(op)
+        rc = subprocess.call(op)
+        if rc:
+            print 'Command %s failed with retcode %d'%(' '.join(op), rc)
+            return rc
+    return 0
+
+def helper_command(filename):
+    """
+    Return the argument list to run this module on 'filename'.
+
+    The caller is expected to prefix this with "sudo".
+    """
+    this_file = os.path.abspath(__file__)
+    if this_file.endswith('.pyc') or this_file.endswith('.pyo'):
+        this_file = this_file[:-1]
+    return [sys.executable, this_file, filename]
+
+def main(args):
+    if len(args) != 1:
+        print __doc__
+        return 1
+    try:
+        operations = read_operations(args[0])
+    except (IOError, ValueError, OperationsError) as e:
+        print 'Unable to read operations from %s: %s'%(args[0], e)
+        return 1
+    return apply_operations(operations)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
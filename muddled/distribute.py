@@ -33,7 +33,7 @@ from fnmatch import fnmatchcase
 from muddled.depend import Action, Rule, Label, needed_to_build, label_list_to_string
 from muddled.utils import GiveUp, MuddleBug, LabelTag, LabelType, \
         copy_without, normalise_dir, find_local_relative_root, \
-        copy_file, domain_subpath, sort_domains
+        copy_file, link_file, domain_subpath, sort_domains
 from muddled.version_control import get_vcs_instance, vcs_special_files
 from muddled.mechanics import build_co_and_path_from_str
 from muddled.pkgs.make import MakeBuilder, deduce_makefile_name
@@ -911,13 +911,16 @@ def _actually_distribute_checkout(builder, label, target_dir, copy_vcs):
     co_src_dir = builder.db.get_checkout_path(label)
 
     # If we're not doing copy_vcs, find the VCS special files for this
-    # checkout, and them our "without" string
+    # checkout, and them our "without" string. If we are, then we can hard
+    # link, rather than copy, any VCS files that will never be altered
+    repo = builder.db.get_checkout_repo(label)
+    vcs_instance = get_vcs_instance(repo.vcs)
     if copy_vcs:
         without = []
+        link = vcs_instance.get_vcs_immutable_dirs()
     else:
-        repo = builder.db.get_checkout_repo(label)
-        vcs_instance = get_vcs_instance(repo.vcs)
         without = vcs_instance.get_vcs_special_files()
+        link = []
 
     # So we can now copy our source directory, ignoring the VCS files if
     # necessary. Note that this can create the target directory for us.
@@ -930,7 +933,12 @@ def _actually_distribute_checkout(builder, label, target_dir, copy_vcs):
         print '  to   %s'%co_tgt_dir
         if without:
             print '  without %s'%without
-    copy_without(co_src_dir, co_tgt_dir, without, preserve=True, verbose=VERBOSE)
+        if link:
+            print '  linking %s'%link
+    # Use copy-on-write clones of the files where the filesystem allows, so
+    # that distributing a large checkout need not copy all of its data
+    copy_without(co_src_dir, co_tgt_dir, without, preserve=True, verbose=VERBOSE,
+                 reflink=True, link=link)
 
     # We mustn't forget to set the appropriate tags in the target .muddle/
     # directory
@@ -949,12 +957,14 @@ def _actually_distribute_normal_build_desc(builder, label, target_dir,
     # Get the actual directory of the checkout
     co_src_dir = builder.db.get_checkout_path(label)
 
+    repo = builder.db.get_checkout_repo(label)
+    vcs_instance = get_vcs_instance(repo.vcs)
     if copy_vcs:
         files_to_ignore = []
+        link = vcs_instance.get_vcs_immutable_dirs()
     else:
-        repo = builder.db.get_checkout_repo(label)
-        vcs_instance = get_vcs_instance(repo.vcs)
         files_to_ignore = vcs_instance.get_vcs_special_files()
+        link = []
 
     co_src_rel_to_root = builder.db.get_checkout_location(label)
     co_tgt_dir = os.path.join(normalise_dir(target_dir), co_src_rel_to_root)
@@ -987,6 +997,8 @@ def _actually_distribute_normal_build_desc(builder, label, target_dir,
         for dirpath, dirnames, filenames in os.walk(co_src_rel_to_root):
 
             if DEBUG: print '--', dirpath
+            co_rel_dirpath = os.path.relpath(dirpath, co_src_rel_to_root)
+            linking = any(fnmatchcase(co_rel_dirpath, pattern) for pattern in link)
             for name in filenames:
                 if DEBUG: print '--', name
                 if name in files_to_ignore:           # Maybe ignore VCS files
@@ -1009,8 +1021,8 @@ def _actually_distribute_normal_build_desc(builder, label, target_dir,
                     if DEBUG: print 'Replacing private file', src_path
                     with open(tgt_path, 'w') as fd:
                         fd.write("def describe_private(builder, *args, **kwargs):\n    pass\n")
-                else:
-                    copy_file(src_path, tgt_path, preserve=True)
+                elif not (linking and link_file(src_path, tgt_path)):
+                    copy_file(src_path, tgt_path, preserve=True, reflink=True)
 
             # Ignore VCS directories, if we were asked to do so
             directories_to_ignore = files_to_ignore.intersection(dirnames)
@@ -0,0 +1,329 @@
+"""
+Fetching for the checkouts in a build tree, periodically, in the background.
+
+"muddle fetchd" starts a background process (the "fetch daemon") for a
+build tree, which every so often fetches changes from the remote repository
+for each checkout in the tree, without changing any working trees. Then
+"muddle pull" has less to fetch, and "muddle status -quick" (which does not
+talk to the network) has up-to-date information about whether checkouts are
+behind their remote repositories.
+
+Only version control systems that can fetch without changing the working
+tree take part - see VersionControlSystem.prefetch_command(). At the moment,
+that means git.
+
+The daemon runs at low priority, and remembers its process id in
+.muddle/fetchd.pid, and writes its output to .muddle/fetchd.log. It stops
+when asked to ("muddle fetchd -stop"), or on its own when the build tree
+(or rather, its .muddle directory) is removed.
+
+The daemon and "muddle pull" (and friends) both hold the lock file
+.muddle/fetch.lock whilst they are fetching, so they do not fetch into the
+same repository at the same time. The daemon never waits for the lock - if
+someone else has it, it just tries again next time round.
+
+Whilst it holds the lock, the daemon also remembers when it fetched for
+each checkout, and with what command, in .muddle/fetchd.fetched. If it did
+so within the last FRESH_FETCH seconds, with the same command, then
+"muddle pull" does not fetch for that checkout again. Otherwise, the pull
+still fetches, but has less to fetch.
+"""
+
+import errno
+import fcntl
+import os
+import signal
+import sys
+import time
+from contextlib import contextmanager
+
+import muddled.utils as utils
+from muddled.utils import GiveUp, LabelTag
+
+# The default number of seconds between fetches
+DEFAULT_INTERVAL = 600
+# The default number of checkouts to fetch for at the same time
+DEFAULT_JOBS = 2
+# How many seconds after the daemon fetched for a checkout "muddle pull"
+# will trust that fetch, instead of fetching again
+FRESH_FETCH = 60
+
+def lock_file_name(root_path):
+    return os.path.join(root_path, '.muddle', 'fetch.lock')
+
+def pid_file_name(root_path):
+    return os.path.join(root_path, '.muddle', 'fetchd.pid')
+
+def log_file_name(root_path):
+    return os.path.join(root_path, '.muddle', 'fetchd.log')
+
+def fetched_file_name(root_path):
+    return os.path.join(root_path, '.muddle', 'fetchd.fetched')
+
+@contextmanager
+def fetch_lock(root_path, wait=True):
+    """Hold the fetch lock for the build tree at 'root_path'.
+
+    Yields True if we have the lock. If 'wait' is false, and someone else
+    already has the lock, yields False instead of waiting for it.
+
+    If 'wait' is true and we have to wait, we say so.
+    """
+    with open(lock_file_name(root_path), 'a') as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if not wait:
+                yield False
+                return
+            print 'Waiting for "muddle fetchd" to finish fetching'
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+def running_pid(root_path):
+    """Return the process id of the fetch daemon for 'root_path', or None.
+    """
+    try:
+        with open(pid_file_name(root_path)) as fd:
+            pid = int(fd.read().strip())
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return None
+    return pid
+
+def fetch_commands(builder):
+    """Return (checkout label, command, directory) for each checkout to fetch.
+    """
+    commands = []
+    for co_label in sorted(builder.all_checkout_labels(LabelTag.CheckedOut)):
+        if not builder.db.is_tag(co_label):
+            continue
+        co_dir = builder.db.get_checkout_path(co_label)
+        if not os.path.isdir(co_dir):
+            continue
+        try:
+            vcs_handler = builder.db.get_checkout_vcs(co_label)
+            cmd = vcs_handler.prefetch_command(builder, co_label)
+        except GiveUp as e:
+            print 'Not fetching for %s:\n%s'%(co_label, utils.indent(str(e), '  '))
+            continue
+        if cmd:
+            commands.append((co_label, cmd, co_dir))
+    return commands
+
+def fetch_all(builder, jobs=DEFAULT_JOBS):
+    """Fetch for all the checkouts in the build tree, up to 'jobs' at a time.
+
+    Returns the number of fetches that failed.
+    """
+    commands = fetch_commands(builder)
+    failures = 0
+    # Remember when we *started* fetching, to be on the safe side
+    started = time.time()
+    fetched = _read_fetched(builder.db.root_path)
+    with utils.BackgroundCommands(jobs) as background:
+        for co_label, cmd, co_dir in commands:
+            background.add(co_label, cmd, co_dir)
+        for co_label, cmd, co_dir in commands:
+            retcode, output = background.wait_for(co_label)
+            if retcode:
+                failures += 1
+                fetched.pop(str(co_label), None)
+                print 'Unable to fetch for %s:'%co_label
+                print utils.indent(output.rstrip(), '  ')
+            else:
+                fetched[str(co_label)] = (started, ' '.join(cmd))
+                if output.strip():
+                    print 'Fetched for %s:'%co_label
+                    print utils.indent(output.rstrip(), '  ')
+    _write_fetched(builder.db.root_path, fetched)
+    return failures
+
+def _read_fetched(root_path):
+    """Return {checkout label string : (time, command)} for our last fetches.
+    """
+    fetched = {}
+    try:
+        with open(fetched_file_name(root_path)) as fd:
+            for line in fd:
+                words = line.rstrip('\n').split(' ', 2)
+                if len(words) == 3:
+                    try:
+                        fetched[words[1]] = (float(words[0]), words[2])
+                    except ValueError:
+                        pass
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return fetched
+
+def _write_fetched(root_path, fetched):
+    with open(fetched_file_name(root_path), 'w') as fd:
+        for label in sorted(fetched.keys()):
+            when, cmd = fetched[label]
+            fd.write('%r %s %s\n'%(when, label, cmd))
+
+def recently_fetched(builder, co_labels, max_age=FRESH_FETCH):
+    """Return those of 'co_labels' that the daemon has fetched for recently.
+
+    That is, within the last 'max_age' seconds, and using the same command
+    that we would use to fetch for the checkout now (so from the same
+    repository). Call this whilst holding the fetch lock, so that the daemon
+    is not part way through fetching.
+    """
+    fetched = _read_fetched(builder.db.root_path)
+    now = time.time()
+    recent = set()
+    for co_label in co_labels:
+        co_label = co_label.copy_with_tag(LabelTag.CheckedOut)
+        try:
+            when, cmd = fetched[str(co_label)]
+        except KeyError:
+            continue
+        if not (0 <= now - when <= max_age):
+            continue
+        if not os.path.isdir(builder.db.get_checkout_path(co_label)):
+            continue
+        try:
+            vcs_handler = builder.db.get_checkout_vcs(co_label)
+            our_cmd = vcs_handler.prefetch_command(builder, co_label)
+        except GiveUp:
+            continue
+        if our_cmd and ' '.join(our_cmd) == cmd:
+            recent.add(co_label)
+    return recent
+
+def _should_stop(root_path):
+    """Should the daemon for 'root_path' stop?
+
+    It should if the build tree has gone, or if its pid file no longer
+    names it (for instance, because "muddle fetchd -stop" was used).
+    """
+    if not os.path.isdir(os.path.join(root_path, '.muddle')):
+        return True
+    try:
+        with open(pid_file_name(root_path)) as fd:
+            return fd.read().strip() != str(os.getpid())
+    except IOError:
+        return True
+
+def run(root_path, interval=DEFAULT_INTERVAL, jobs=DEFAULT_JOBS):
+    """Fetch for the build tree at 'root_path' every 'interval' seconds.
+
+    Returns when the daemon should stop (see _should_stop).
+    """
+    # Import here, as mechanics imports (indirectly) so much of muddle
+    import muddled.mechanics as mechanics
+
+    while not _should_stop(root_path):
+        print
+        print '%s: Fetching'%utils.iso_time()
+        try:
+            with fetch_lock(root_path, wait=False) as locked:
+                if locked:
+                    builder = mechanics.load_builder(root_path, None)
+                    fetch_all(builder, jobs)
+                else:
+                    print 'Someone else is fetching, so not fetching this time'
+        except GiveUp as e:
+            print e
+        sys.stdout.flush()
+        # Sleep in small steps, so that we notice promptly if we should stop
+        wake_time = time.time() + interval
+        while time.time() < wake_time and not _should_stop(root_path):
+            time.sleep(min(1, max(0, wake_time - time.time())))
+
+def _terminate(signum, frame):
+    # Leave via SystemExit, so that any fetches still running are stopped
+    sys.exit(0)
+
+def start(root_path, interval=DEFAULT_INTERVAL, jobs=DEFAULT_JOBS):
+    """Start the fetch daemon for the build tree at 'root_path'.
+
+    Returns the daemon's process id.
+    """
+    pid = running_pid(root_path)
+    if pid:
+        raise GiveUp('"muddle fetchd" is already running for this build tree'
+                     ' (process %d)'%pid)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_fd, write_fd = os.pipe()
+    child = os.fork()
+    if child:
+        # The original process - find out who our grandchild is
+        os.close(write_fd)
+        os.waitpid(child, 0)
+        with os.fdopen(read_fd) as fd:
+            text = fd.read()
+        try:
+            return int(text)
+        except ValueError:
+            raise GiveUp('Unable to start "muddle fetchd"')
+
+    # The child - detach from our terminal, and fork again so that we
+    # cannot acquire another
+    os.close(read_fd)
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        # The grandchild, which is the daemon itself
+        os.chdir(root_path)
+        with open(pid_file_name(root_path), 'w') as fd:
+            fd.write('%d\n'%os.getpid())
+        os.write(write_fd, str(os.getpid()))
+        os.close(write_fd)
+        with open(os.devnull) as devnull:
+            os.dup2(devnull.fileno(), 0)
+        with open(log_file_name(root_path), 'a') as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        os.nice(10)
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            run(root_path, interval, jobs)
+        finally:
+            stop_if_ours(root_path)
+            sys.stdout.flush()
+    except SystemExit:
+        pass
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    os._exit(0)
+
+def stop_if_ours(root_path):
+    """Forget the fetch daemon for 'root_path', if it is this process.
+    """
+    if not _should_stop(root_path):
+        os.remove(pid_file_name(root_path))
+
+def stop(root_path):
+    """Stop the fetch daemon for the build tree at 'root_path'.
+
+    Returns its process id, or None if it was not running.
+    """
+    pid = running_pid(root_path)
+    try:
+        os.remove(pid_file_name(root_path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    if pid:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    return pid
@@ -127,7 +127,11 @@ class Builder(object):
         # XXX -----------------------------------------------------------------
         # XXX What used to be in the Invocation constructor
         self.db = db.Database(root_path)
-        self.ruleset = depend.RuleSet()
+        self._ruleset = depend.RuleSet()
+        # Unifications that have not yet been applied to our rule set (see
+        # unify_all_labels()), and the labels they will unify away.
+        self._pending_unifications = []
+        self._unified_away = set()
         self.env = {}
         self.default_roles = []
         self.default_deployment_labels = []
@@ -166,6 +170,12 @@ class Builder(object):
         # (explicitly) specifies its own branch or revision.
         self._follow_build_desc_branch = False
 
+        # An index from directories in the build tree to labels, used by
+        # find_location_in_tree(), and the state of the build when it was
+        # made - see _location_index().
+        self._location_trie = None
+        self._location_trie_key = None
+
     @property
     def build_desc_repo(self):
         """The Repository for our build description.
@@ -361,6 +371,21 @@ class Builder(object):
                                                 traceback.format_exc()))
         return True
 
+    @property
+    def ruleset(self):
+        """
+        The rules describing this build.
+
+        Any unifications that are still pending are applied first, all
+        together.
+        """
+        if self._pending_unifications:
+            pairs = self._pending_unifications
+            self._pending_unifications = []
+            self._unified_away = set()
+            self._ruleset.unify_all(pairs)
+        return self._ruleset
+
     def unify_labels(self, source, target):
         """
         Unify the 'source' label with/into the 'target' label.
@@ -377,14 +402,44 @@ class Builder(object):
         together. In retrospect, though, some variation on "merge" might have
         been easier to remember (if also still inaccurate).
         """
-        if not self.target_label_exists(source):
-            raise GiveUp('Cannot unify source label %s which does not exist'%source)
-        if not self.target_label_exists(target):
-            raise GiveUp('Cannot unify target label %s which does not exist'%target)
+        self.unify_all_labels([(source, target)])
+
+    def unify_all_labels(self, pairs):
+        """
+        Unify each (source, target) pair of labels in 'pairs'.
+
+        This is equivalent to calling unify_labels() on each pair in turn.
 
-        self.ruleset.unify(source, target)
-        self.unify_environments(source,target)
-        self.note_unification(source, target)
+        Rewriting the rule set is expensive, and a build description may well
+        unify many labels, one after another. So unifications of labels
+        without wildcards are queued, and applied to the rule set all at once
+        (using RuleSet.unify_all()) when the rule set is next used. Such a
+        source label no longer exists (as a target) once it has been unified
+        away, so a later unification that uses it is still refused.
+
+        Each source and target label must exist (as the target of a rule) at
+        the time its pair is reached.
+        """
+        for source, target in pairs:
+            if source.is_definite() and target.is_definite():
+                ruleset = self._ruleset
+            else:
+                # What this affects depends on the rules as they stand
+                ruleset = self.ruleset
+
+            for label, what in ((source, 'source'), (target, 'target')):
+                if label not in ruleset.map or label in self._unified_away:
+                    raise GiveUp('Cannot unify %s label %s which does not exist'%(what, label))
+
+            if ruleset is self._ruleset:
+                self._pending_unifications.append((source, target))
+                if source != target:
+                    self._unified_away.add(source)
+            else:
+                ruleset.unify(source, target)
+
+            self.unify_environments(source,target)
+            self.note_unification(source, target)
 
 
     def get_dependent_package_dirs(self, label):
@@ -725,25 +780,13 @@ class Builder(object):
             print "There is no rule to build label %s"%label
             return
 
+        known = {}
         for r in rule_list:
             if self.db.is_tag(r.target):
                 # Don't build stuff that's already built ..
                 pass
             else:
-                if not silent:
-                    print "> Building %s"%(r.target)
-
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
-
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
-
-                self.db.set_tag(r.target)
+                self._build_rule(r, silent, known)
 
     def build_label_with_options(self, label, useDepends = True, useTags = True, silent = False):
         """
@@ -763,24 +806,46 @@ class Builder(object):
             print "There is no rule to build label %s"%label
             return
 
+        known = {}
         for r in rule_list:
             # Build it.
             if (not self.db.is_tag(r.target)):
                 # Don't build stuff that's already built ..
-                if (not silent):
-                    print "> Building %s"%(r.target)
+                self._build_rule(r, silent, known)
 
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
+    def _build_rule(self, r, silent, known):
+        """
+        Build the target of rule 'r', and set its tag.
+
+        'known' is a dictionary of the checkout fingerprints already worked
+        out during this build, as for source_fingerprints(), so that we
+        only ask each checkout once.
+        """
+        if not silent:
+            print "> Building %s"%(r.target)
 
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
+        # Remember what the package is being built from, so that
+        # "muddle query changed-since-build" can tell if that changes.
+        # We look *before* building, so that we don't miss any changes
+        # made whilst we are building.
+        if r.target.type == LabelType.Package and r.target.tag == LabelTag.Built:
+            fingerprints = self.source_fingerprints(r.target, known)
+        else:
+            fingerprints = None
 
-                self.db.set_tag(r.target)
+        # Set up the environment for building this label
+        old_env = os.environ.copy()
+        try:
+            self._build_label_env(r.target, env_store)
+
+            if r.action:
+                r.action.build_label(self, r.target)
+        finally:
+            os.environ = old_env
+
+        self.db.set_tag(r.target)
+        if fingerprints is not None:
+            self.db.set_source_fingerprints(r.target, fingerprints)
 
     @property
     def build_name(self):
@@ -911,6 +976,77 @@ class Builder(object):
         else:
             return []
 
+    def _location_index(self):
+        """
+        Return a utils.PathTrie mapping directories in the build tree to
+        the values find_location_in_tree() should return for them.
+
+        The paths in the trie are relative to the root of the build tree.
+        Checkout, install and deployment directories cover everything below
+        them, as do package object directories that include a role.
+
+        The index is built the first time it is needed, and rebuilt if the
+        checkouts or rules have changed since then (including a subdomain
+        changes our rules).
+        """
+        key = (self.ruleset.generation, self.db.checkout_data_changes)
+        if self._location_trie is not None and self._location_trie_key == key:
+            return self._location_trie
+
+        trie = utils.PathTrie()
+        domains = set()
+        for rule in self.ruleset.map.values():
+            label = rule.target
+            domains.add(label.domain)
+            if label.type == LabelType.Package:
+                if label.name == '*' or label.role == '*':
+                    continue
+                where = os.path.join(domain_subpath(label.domain), 'obj', label.name)
+                trie.add(where,
+                         (utils.DirType.Object,
+                          Label(LabelType.Package, name=label.name,
+                                role='*', domain=label.domain),
+                          label.domain))
+                if label.role is None:
+                    # Such a package has no role directory (and no install
+                    # directory of its own), so leave anything below its
+                    # object directory to find_location_in_tree()
+                    continue
+                trie.add(os.path.join(where, label.role),
+                         (utils.DirType.Object,
+                          Label(LabelType.Package, name=label.name,
+                                role=label.role, domain=label.domain),
+                          label.domain), subtree=True)
+                where = os.path.join(domain_subpath(label.domain), 'install', label.role)
+                trie.add(where,
+                         (utils.DirType.Install,
+                          Label(LabelType.Package, name='*',
+                                role=label.role, domain=label.domain),
+                          label.domain), subtree=True)
+            elif label.type == LabelType.Deployment:
+                if label.name == '*':
+                    continue
+                where = os.path.join(domain_subpath(label.domain), 'deploy', label.name)
+                trie.add(where,
+                         (utils.DirType.Deployed,
+                          Label(LabelType.Deployment, name=label.name,
+                                domain=label.domain),
+                          label.domain), subtree=True)
+
+        for domain in domains:
+            if domain:
+                trie.add(domain_subpath(domain),
+                         (utils.DirType.DomainRoot, None, domain))
+
+        # Checkouts last, in case one is (oddly) inside one of the above
+        for label, data in self.db.checkout_data.items():
+            trie.add(data.location, (utils.DirType.Checkout, label, label.domain),
+                     subtree=True)
+
+        self._location_trie = trie
+        self._location_trie_key = key
+        return trie
+
     def find_location_in_tree(self, dir):
         """
         Find the directory type and name of subdirectory in a repository.
@@ -948,6 +1084,12 @@ class Builder(object):
         if dir == root_dir:
             return (utils.DirType.Root, None, None)
 
+        # The index knows about all the checkout, package, install and
+        # deployment directories our build description has told us of
+        result = self._location_index().lookup(os.path.relpath(dir, root_dir))
+        if result is not None:
+            return result
+
         # Are we in a subdomain?
         domain_name, domain_dir = utils.find_domain(root_dir, dir)
 
@@ -969,27 +1111,9 @@ class Builder(object):
             rest.insert(0, cur)
             dir = base
 
-        result = None
-
         if rest[0] == "src":
-            if len(rest) > 1:
-                lookfor = os.path.join(utils.domain_subpath(domain_name),
-                                       'src', *rest[1:])
-                for label, data in self.db.checkout_data.items():
-                    locn = data.location
-                    if lookfor.startswith(locn) and domain_name == label.domain:
-                        # but just in case we have (for instance) checkouts
-                        # 'fred' and 'freddy'...
-                        relpath = os.path.relpath(lookfor, locn)
-                        if relpath.startswith('..'):
-                            # It's not actually the same
-                            continue
-                        else:
-                            result = (utils.DirType.Checkout, label, domain_name)
-                            break
-            if result is None:
-                # Part way down a from src/ towards a checkout
-                result = (utils.DirType.Checkout, None, domain_name)
+            # Part way down a from src/ towards a checkout
+            result = (utils.DirType.Checkout, None, domain_name)
 
         elif rest[0] == "obj":
             # We know it goes obj/<package>/<role>
@@ -1391,7 +1515,7 @@ class Builder(object):
         Note that this method does not understand wildcards, so the match
         must be exact.
         """
-        return label in self.ruleset.map.keys()
+        return label in self.ruleset.map
 
     def checkout_label_exists(self, label):
         """
@@ -1632,6 +1756,34 @@ class Builder(object):
 
         return checkouts
 
+    def source_fingerprints(self, pkg_label, known=None):
+        """
+        Return the source fingerprints of the checkouts a package depends on.
+
+        Returns a dictionary of {checkout label : fingerprint}, where each
+        checkout label has tag CheckedOut, and each fingerprint is as returned
+        by the checkout's VCS handler's source_fingerprint() method (and so
+        may be None if the checkout has not been checked out).
+
+        If 'known' is given, it is a dictionary of fingerprints we have
+        already calculated, which is used (and added to) in preference to
+        asking the VCS again - this is useful when asking about many
+        packages, which may share checkouts.
+
+        As for checkouts_for_package(), only *direct* dependencies are
+        considered.
+        """
+        if known is None:
+            known = {}
+        fingerprints = {}
+        for co_label in self.checkouts_for_package(pkg_label):
+            co_label = co_label.copy_with_tag(LabelTag.CheckedOut)
+            if co_label not in known:
+                vcs_handler = self.db.get_checkout_vcs(co_label)
+                known[co_label] = vcs_handler.source_fingerprint(self, co_label)
+            fingerprints[co_label] = known[co_label]
+        return fingerprints
+
     def packages_for_deployment(self, dep_label):
         """
         Return a set of the packages that the given deployment depends upon
@@ -2202,8 +2354,56 @@ def _init_without_build_tree(muddle_binary, root_path, repo_location, build_desc
     return load_builder(root_path, muddle_binary, domain_params)
 
 
+def _check_domain_name(domain_name):
+    """Check our domain name is legitimate
+    """
+    try:
+        Label._check_part('dummy',domain_name)
+    except GiveUp:
+        raise GiveUp('Domain name "%s" is not valid'%domain_name)
+
+def _domain_root_path(root_path, domain_name):
+    """Return the root directory for the named (sub) domain.
+    """
+    # So, we're wanting our sub-builds to go into the 'domains/' directory
+    return os.path.join(root_path, 'domains', domain_name)
+
+def _domain_is_present(domain_root_path):
+    """Have we already retrieved the domain at 'domain_root_path'?
+    """
+    # muddle itself just does::
+    #
+    #    muddled.utils.find_root_and_domain(specified_root)
+    #
+    # to see if it has a build present (i.e., looking up-tree). That's essentially
+    # just a search for a .muddle directory. So a similarly simple algorithm to
+    # decide if our sub-build is present *should* be enough
+    return os.path.exists(domain_root_path) and \
+           os.path.exists(os.path.join(domain_root_path,'.muddle'))
+
+def _fetch_sub_domain(root_path, muddle_binary, domain_name, domain_repo,
+                      domain_build_desc, domain_params):
+    """
+    Retrieve a (sub) domain that is not yet present, without including it.
+
+    This is intended to be run in a worker process by include_domains(). It
+    checks out the domain's build description, and loads it (which will in
+    turn retrieve any subdomains of its own), so that afterwards the domain
+    can be loaded from local disk without any further network access. The
+    Builder it creates is then discarded.
+
+    Returns a list of the (string) labels that the domain "just pulled"
+    whilst doing so, so that they are not forgotten.
+    """
+    domain_root_path = _domain_root_path(root_path, domain_name)
+    os.makedirs(domain_root_path)
+    domain_builder = _init_without_build_tree(muddle_binary, domain_root_path,
+                                              domain_repo, domain_build_desc,
+                                              domain_params)
+    return [ str(l) for l in domain_builder.db.just_pulled.labels ]
+
 def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_build_desc,
-                    parent_builder):
+                    parent_builder, just_pulled=None):
     """
     * 'muddle_binary' is the full path to the ``muddle`` script (for use in
       environment variables)
@@ -2215,32 +2415,22 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
     * 'domain_build_desc' is then the path to the domain's build description,
       within that.
     * 'parent_builder' is the parent domain's Builder
+    * if given, 'just_pulled' is a list of (string) labels to add to the
+      domain's "just pulled" set - this is used when the domain was retrieved
+      by _fetch_sub_domain() in another process.
 
     Really.
     """
 
-    # Check our domain name is legitimate
-    try:
-        Label._check_part('dummy',domain_name)
-    except GiveUp:
-        raise GiveUp('Domain name "%s" is not valid'%domain_name)
+    _check_domain_name(domain_name)
 
-    # So, we're wanting our sub-builds to go into the 'domains/' directory
-    domain_root_path = os.path.join(root_path, 'domains', domain_name)
+    domain_root_path = _domain_root_path(root_path, domain_name)
 
     # Extract the domain parameters ..
     domain_params = parent_builder.get_domain_parameters(domain_name)
 
     # Did we already retrieve it, earlier on?
-    # muddle itself just does::
-    #
-    #    muddled.utils.find_root_and_domain(specified_root)
-    #
-    # to see if it has a build present (i.e., looking up-tree). That's essentially
-    # just a search for a .muddle directory. So a similarly simple algorithm to
-    # decide if our sub-build is present *should* be enough
-    if os.path.exists(domain_root_path) and \
-       os.path.exists(os.path.join(domain_root_path,'.muddle')):
+    if _domain_is_present(domain_root_path):
         domain_builder = load_builder(domain_root_path,
                                       muddle_binary,
                                       domain_params)
@@ -2250,15 +2440,13 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
                                                   domain_repo, domain_build_desc,
                                                   domain_params)
 
+    if just_pulled:
+        for text in just_pulled:
+            domain_builder.db.just_pulled.labels.add(Label.from_string(text))
+
     # Then we need to tell all of the labels in that build that they're
-    # actually in the new domain (this is the fun part(!))
+    # actually in the new domain.
     #
-    # We *should* just need to change (all of) the labels in the builds rule
-    # set...
-    #
-    # It should help that we *know* (!) that all of the labels do not yet have
-    # a domain
-
     # First, find all our labels.
     # Beware that we want to get labels that compare identically but are not
     # the same object, so we are willing to have an instance in our list more
@@ -2281,9 +2469,7 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
     # domain_builder.what_to_release, because we explicitly say that
     # what to release is only set by the top-level build.
 
-    ruleset = domain_builder.ruleset
-
-    rules = ruleset.map.values()
+    rules = domain_builder.ruleset.map.values()
 
     for rule in rules:
         labels.append(rule.target)
@@ -2296,30 +2482,30 @@ def _new_sub_domain(root_path, muddle_binary, domain_name, domain_repo, domain_b
     # Don't forget the labels inside the "db"
     labels.extend(domain_builder.db._inner_labels())
 
-    # Then, mark them all as "unchanged" (because we can't guarantee we won't
-    # have the same label more than once, and it's easier to do this than to
-    # try to remove repeated instances)
-    for l in labels:
-        l._mark_unswept()
-
-    # Then add the (new) domain name to every one (but the mark allows us to do
-    # this only once if a label *does* repeat). As a side effect of that, all
-    # labels in a sub-build (sub-domain) end up with a flag indicating as much,
-    # which is redundant given we could just check to see if label.domain was
-    # set, but might perhaps be useful somehow later on...
-    for l in labels:
-        l._change_domain(domain_name)
+    # Each label is then made relative to the domain's scope, and naming the
+    # scope puts them all into the domain. Labels that came from a subdomain
+    # of our own already belong to its scope, so are not changed again -
+    # instead, that scope is placed inside ours. So each label is only changed
+    # once, however deeply it ends up nested, and works out its full domain
+    # name when it is next asked for it.
+    scope = depend.DomainScope()
+    scope.adopt(labels)
+    scope.include(domain_name)
 
     # Also, check if any of our Rules need their "action" changing
     # (we'll assume that they do if they appear to have the appropriate magic
-    # method names)
-    for rule in rules:
-        if rule.action and hasattr(rule.action, '_mark_unswept'):
-            rule.action._mark_unswept()
-
+    # method names). The same action may be used by more than one rule, but
+    # must only be changed once.
+    seen_actions = set()
     for rule in rules:
-        if rule.action and hasattr(rule.action, '_change_domain'):
-            rule.action._change_domain(domain_name)
+        action = rule.action
+        if action is None or id(action) in seen_actions:
+            continue
+        seen_actions.add(id(action))
+        if hasattr(action, '_mark_unswept'):
+            action._mark_unswept()
+        if hasattr(action, '_change_domain'):
+            action._change_domain(domain_name)
 
     # Now mark the builder as a domain.
     domain_builder.mark_domain(domain_name)
@@ -2346,14 +2532,21 @@ def include_domain(builder, domain_name, domain_repo, domain_desc):
     ``include_domain()`` if necessary.
     """
 
-    domain_builder = _new_sub_domain(builder.db.root_path,
-                                     builder.muddle_binary,
-                                     domain_name,
-                                     domain_repo,
-                                     domain_desc,
-                                     parent_builder=builder)
+    with utils.phase_times.phase('subdomain inclusion'):
+        domain_builder = _new_sub_domain(builder.db.root_path,
+                                         builder.muddle_binary,
+                                         domain_name,
+                                         domain_repo,
+                                         domain_desc,
+                                         parent_builder=builder)
+        _merge_sub_domain(builder, domain_builder, domain_name)
+    return domain_builder
 
-    # And make sure we merge its rules into ours...
+def _merge_sub_domain(builder, domain_builder, domain_name):
+    """
+    Merge the (already relabelled) 'domain_builder' into 'builder'.
+    """
+    # Make sure we merge its rules into ours...
     builder.ruleset.merge(domain_builder.ruleset)
 
     # And its environments...
@@ -2365,7 +2558,94 @@ def include_domain(builder, domain_name, domain_repo, domain_desc):
     # for us.
     builder.include_domain(domain_builder, domain_name)
 
-    return domain_builder
+# How many subdomains include_domains() will retrieve at once, by default
+DEFAULT_DOMAIN_JOBS = 8
+
+@utils.timed_phase('subdomain inclusion')
+def include_domains(builder, domains, jobs=None):
+    """
+    Include several domains as sub-builds of this builder.
+
+    * 'domains' is a sequence of (domain_name, domain_repo, domain_desc)
+      tuples, each as would be given to include_domain().
+    * 'jobs' is the maximum number of domains to retrieve at the same time.
+      If it is None, then DEFAULT_DOMAIN_JOBS is used.
+
+    This is equivalent to calling include_domain() for each domain in turn,
+    except that any domains that have not yet been retrieved (typically, at
+    ``muddle init`` time) are retrieved in parallel, each in its own worker
+    process. This includes checking out the domain's build description and
+    any subdomains it includes in its turn (which are retrieved one at a
+    time, within that worker process, even if it uses include_domains()).
+
+    Once that is done, the domains are loaded and merged into this builder
+    one by one, in the order given, so the result does not depend on which
+    domain was retrieved first.
+
+    If any of the domains cannot be retrieved, then all of the problems are
+    reported together, in a single GiveUp exception.
+
+    Returns a list of the domain builders, in the same order as 'domains'.
+    """
+    domains = list(domains)
+    root_path = builder.db.root_path
+
+    names = set()
+    to_fetch = []
+    for domain_name, domain_repo, domain_desc in domains:
+        _check_domain_name(domain_name)
+        if domain_name in names:
+            raise GiveUp('Domain "%s" is included more than once'%domain_name)
+        names.add(domain_name)
+        if not _domain_is_present(_domain_root_path(root_path, domain_name)):
+            to_fetch.append((root_path, builder.muddle_binary, domain_name,
+                             domain_repo, domain_desc,
+                             builder.get_domain_parameters(domain_name)))
+
+    if jobs is None:
+        jobs = DEFAULT_DOMAIN_JOBS
+    if utils.in_parallel_worker():
+        # We are retrieving a subdomain for an outer include_domains(), in
+        # a worker process, which cannot have workers of its own
+        jobs = 1
+
+    just_pulled = {}
+    if len(to_fetch) > 1 and jobs > 1:
+        print 'Retrieving %d subdomains, %d at a time'%(len(to_fetch),
+                                                       min(jobs, len(to_fetch)))
+
+        def report(result):
+            domain_name = to_fetch[result.index][2]
+            print
+            print 'Retrieved subdomain %s%s'%(domain_name,
+                    '' if result.error is None else ' (FAILED)')
+            sys.stdout.write(result.output)
+
+        results = utils.run_in_parallel(_fetch_sub_domain, to_fetch, jobs,
+                                        callback=report)
+        problems = []
+        for result in results:
+            domain_name = to_fetch[result.index][2]
+            if result.error is None:
+                just_pulled[domain_name] = result.value
+            else:
+                problems.append('Unable to retrieve subdomain %s:\n%s'%(domain_name,
+                                utils.indent(result.error, '  ')))
+        if problems:
+            raise GiveUp('\n'.join(problems))
+
+    domain_builders = []
+    for domain_name, domain_repo, domain_desc in domains:
+        domain_builder = _new_sub_domain(root_path,
+                                         builder.muddle_binary,
+                                         domain_name,
+                                         domain_repo,
+                                         domain_desc,
+                                         parent_builder=builder,
+                                         just_pulled=just_pulled.get(domain_name))
+        _merge_sub_domain(builder, domain_builder, domain_name)
+        domain_builders.append(domain_builder)
+    return domain_builders
 
 def build_co_and_path_from_str(str):
     """Turn a BuildDescription text into checkout name and inner path.
@@ -3,6 +3,8 @@ Muddle utilities.
 """
 
 import errno
+import fcntl
+import filecmp
 import hashlib
 import imp
 import os
@@ -12,6 +14,7 @@ import re
 import select
 import shlex
 import shutil
+import signal
 import socket
 import stat
 import subprocess
@@ -23,6 +26,7 @@ import traceback
 import xml.dom
 import xml.dom.minidom
 from collections import MutableMapping, Mapping, namedtuple
+from contextlib import contextmanager
 from fnmatch import fnmatchcase
 from ConfigParser import RawConfigParser
 from StringIO import StringIO
@@ -508,7 +512,13 @@ def ensure_dir(dir, verbose=True):
     else:
         if verbose:
             print "> Make directory %s"%dir
-        os.makedirs(dir)
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            # Someone else (e.g., another muddle process) may have got
+            # there first
+            if e.errno != errno.EEXIST or not os.path.isdir(dir):
+                raise
 
 def pad_to(str, val, pad_with = " "):
     """
@@ -869,6 +879,508 @@ def run3(thing, env=None, show_command=True, show_output=False):
     all_stderr_text = ''.join(all_stderr_text)
     return proc.returncode, all_stdout_text, all_stderr_text
 
+# =============================================================================
+# Running things in parallel
+#
+# Much of muddle's work happens inside "with Directory(...)" blocks, which
+# change the current directory of the whole process, so it is not safe to
+# do that work in threads. Instead, we fork worker processes. Forking means
+# the workers inherit the function to call and its arguments (which commonly
+# involve a Builder, which cannot be pickled), so all we need to send them
+# is an index - only the results have to be picklable.
+
+class ParallelResult(object):
+    """The outcome of one call made by run_in_parallel().
+
+    * 'index' is the index of the call's arguments in the original list
+    * 'value' is the value returned by the call, or None if it failed
+    * 'error' is None if the call succeeded, otherwise the text of the
+      GiveUp exception it raised (or the traceback for any other exception)
+    * 'retcode' is the 'retcode' of any GiveUp exception, or 1 for any
+      other exception, or 0 if the call succeeded
+    * 'gave_up' is True if the call failed by raising GiveUp (but not
+      MuddleBug), and False otherwise
+    * 'output' is the output (stdout and stderr) produced by the call, if it
+      was captured, or '' if it was not.
+    """
+
+    def __init__(self, index, value=None, error=None, retcode=0, output='',
+                 gave_up=False):
+        self.index = index
+        self.value = value
+        self.error = error
+        self.retcode = retcode
+        self.output = output
+        self.gave_up = gave_up
+
+    def __repr__(self):
+        return 'ParallelResult(%d, %r, %r, %d)'%(self.index, self.value,
+                                                 self.error, self.retcode)
+
+# The (function, argument list, capture output) that the worker processes
+# for run_in_parallel() should use. This is set before the workers are forked.
+_parallel_work = None
+
+def _call_for_parallel(func, args, index):
+    """Call func(*args), returning a ParallelResult (without output).
+    """
+    try:
+        return ParallelResult(index, value=func(*args))
+    except MuddleBug as e:
+        # A bug in muddle itself deserves a traceback
+        return ParallelResult(index, error=traceback.format_exc(), retcode=e.retcode)
+    except GiveUp as e:
+        return ParallelResult(index, error=str(e), retcode=e.retcode, gave_up=True)
+    except Exception:
+        return ParallelResult(index, error=traceback.format_exc(), retcode=1)
+
+def _call_capturing_output(func, args, index):
+    """Call func(*args), returning a ParallelResult with its output.
+    """
+    # We want the output from anything we run (including subprocesses, which
+    # write directly to file descriptors 1 and 2) to be kept together, so
+    # redirect at the file descriptor level
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with tempfile.TemporaryFile() as capture:
+        saved_stdout = os.dup(1)
+        saved_stderr = os.dup(2)
+        try:
+            os.dup2(capture.fileno(), 1)
+            os.dup2(capture.fileno(), 2)
+            result = _call_for_parallel(func, args, index)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+        capture.seek(0)
+        result.output = capture.read()
+    return result
+
+def _parallel_worker(index):
+    """Do the work for run_in_parallel() in a worker process.
+    """
+    func, args_list, capture_output = _parallel_work
+    if not capture_output:
+        return _call_for_parallel(func, args_list[index], index)
+    return _call_capturing_output(func, args_list[index], index)
+
+def _call_in_turn(func, args_list, indices, capture_output):
+    """Make the calls for 'indices', one after another, for run_in_parallel_by_group().
+
+    Returns a list of ParallelResult.
+    """
+    results = []
+    for index in indices:
+        if capture_output:
+            results.append(_call_capturing_output(func, args_list[index], index))
+        else:
+            results.append(_call_for_parallel(func, args_list[index], index))
+    return results
+
+def default_jobs():
+    """Return a sensible default number of jobs to run at once.
+
+    This is the number of CPUs we have, if we can tell, or otherwise 1.
+    """
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def in_parallel_worker():
+    """Are we in one of the worker processes started by run_in_parallel()?
+
+    If so, run_in_parallel() will only make its calls one at a time.
+    """
+    import multiprocessing
+    return multiprocessing.current_process().daemon
+
+def run_in_parallel(func, args_list, jobs, capture_output=True, callback=None):
+    """Call 'func' once for each argument tuple in 'args_list'.
+
+    Up to 'jobs' calls are made at the same time, each in its own (forked)
+    worker process. If 'jobs' is less than 2, or there is only one call to
+    make, then the calls are just made in order, in this process. So are
+    calls made from within such a worker process (for instance, when a
+    subdomain being retrieved by include_domains() includes several
+    subdomains of its own), since the workers may not have children.
+
+    The value returned by 'func' must be picklable, since it has to be
+    returned from the worker process.
+
+    If 'capture_output' is true, then the output (stdout and stderr) from
+    each call made in a worker process is captured, rather than being shown
+    as it happens, and is returned in the corresponding ParallelResult.
+    Output from calls made in this process is always shown as normal.
+
+    If 'callback' is given, it is called with each ParallelResult as soon as
+    that call finishes (so, for parallel calls, not necessarily in order).
+
+    Returns a list of ParallelResult, in the same order as 'args_list'.
+
+    Exceptions raised by 'func' are caught and reported in its
+    ParallelResult. It is up to the caller to decide what to do about them.
+    """
+    global _parallel_work
+
+    args_list = list(args_list)
+    results = [None] * len(args_list)
+
+    if in_parallel_worker():
+        # Our worker processes are not allowed to start workers of their own
+        jobs = 1
+
+    if jobs < 2 or len(args_list) < 2:
+        for index, args in enumerate(args_list):
+            result = _call_for_parallel(func, args, index)
+            results[index] = result
+            if callback:
+                callback(result)
+        return results
+
+    # Anything we've already written must not be written again by each child
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    import multiprocessing
+    _parallel_work = (func, args_list, capture_output)
+    pool = multiprocessing.Pool(min(jobs, len(args_list)))
+    try:
+        iterator = pool.imap_unordered(_parallel_worker, range(len(args_list)))
+        for _ in range(len(args_list)):
+            # Waiting with a timeout allows KeyboardInterrupt to get through
+            result = iterator.next(timeout=2**31)
+            results[result.index] = result
+            if callback:
+                callback(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _parallel_work = None
+    return results
+
+def run_in_parallel_by_group(func, args_list, groups, jobs, per_group,
+                             capture_output=True, callback=None):
+    """Call 'func' once for each argument tuple in 'args_list', a group at a time.
+
+    This is like run_in_parallel(), except that each call belongs to a
+    group - 'groups[i]' is the group for 'args_list[i]' - and no more than
+    'per_group' calls from the same group are made at the same time.
+    For instance, the groups might be the hosts that each call talks to.
+
+    The calls for each group are shared out (in order) between at most
+    'per_group' queues, and it is the queues that are run in parallel, up to
+    'jobs' at a time. The calls in each queue are made one after another.
+
+    Returns a list of ParallelResult, in the same order as 'args_list'.
+    If 'callback' is given, it is called with each ParallelResult when the
+    queue containing that call finishes.
+    """
+    args_list = list(args_list)
+    order = []
+    by_group = {}
+    for index, group in enumerate(groups):
+        if group not in by_group:
+            order.append(group)
+            by_group[group] = []
+        by_group[group].append(index)
+
+    queues = []
+    for group in order:
+        indices = by_group[group]
+        count = min(per_group, len(indices))
+        for start in range(count):
+            queues.append(indices[start::count])
+
+    # Output is only captured if the queues really are run in other processes
+    capture_output = capture_output and jobs > 1 and len(queues) > 1
+
+    results = [None] * len(args_list)
+    def report(queue_result):
+        if queue_result.error is not None:
+            # _call_in_turn catches everything, so this should not happen
+            raise MuddleBug('Error running calls in parallel:\n%s'%queue_result.error)
+        for result in queue_result.value:
+            results[result.index] = result
+            if callback:
+                callback(result)
+
+    run_in_parallel(_call_in_turn,
+                    [(func, args_list, queue, capture_output) for queue in queues],
+                    jobs, capture_output=False, callback=report)
+    return results
+
+def _git_ssh_command_configured():
+    """Has the user told git which ssh command to use, with core.sshCommand?
+    """
+    try:
+        retcode, text = run2(['git', 'config', 'core.sshCommand'],
+                             show_command=False)
+    except (OSError, GiveUp):
+        # No git, so no configuration for it
+        return False
+    return retcode == 0 and text.strip() != ''
+
+@contextmanager
+def sharing_ssh_connections():
+    """Let the ssh connections made by git and svn share connections.
+
+    Within the 'with' statement, ssh is told (via GIT_SSH_COMMAND and
+    SVN_SSH) to use OpenSSH connection multiplexing ("ControlMaster"), so
+    that all of the connections to the same host (and as the same user)
+    share a single master connection, rather than each having to set up
+    (and authenticate) a new one. This makes a big difference when pushing
+    (or pulling) lots of checkouts from the same server.
+
+    The master connections are left running for a few seconds after they
+    were last used, and then exit on their own.
+
+    If the user has already set GIT_SSH or GIT_SSH_COMMAND, or SVN_SSH,
+    then that is left alone. So is git's own "core.sshCommand" setting
+    (which GIT_SSH_COMMAND would override), if "git config" in the current
+    directory finds it - note that a setting made only within a particular
+    checkout will not be found.
+
+    Since this changes how ssh is run, muddle commands only use it when they
+    are asked to work on several checkouts at once (typically, with '-j').
+    """
+    control_dir = tempfile.mkdtemp(prefix='muddle-ssh-')
+    ssh_command = ('ssh -o ControlMaster=auto -o ControlPersist=10'
+                   ' -o ControlPath=%s/%%r@%%h:%%p'%control_dir)
+    added = []
+    for name, others in (('GIT_SSH_COMMAND', ('GIT_SSH',)),
+                         ('SVN_SSH', ())):
+        if name in os.environ or any(x in os.environ for x in others):
+            continue
+        if name == 'GIT_SSH_COMMAND' and _git_ssh_command_configured():
+            continue
+        added.append(name)
+        os.environ[name] = ssh_command
+    try:
+        yield
+    finally:
+        for name in added:
+            del os.environ[name]
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+class BackgroundCommands(object):
+    """Run commands in the background, up to 'jobs' at a time.
+
+    Each command is added with a key, and is started as soon as there is
+    room for it. wait_for(key) then waits for that command to finish, and
+    returns its return code and output, whilst the other commands carry on.
+
+    The commands are run with their stdin as /dev/null, and in a new session,
+    so that they cannot prompt the user for anything (for instance, an ssh
+    password) - a command that needs to do that will just fail.
+
+    Use as a context manager, so that any commands that have not been waited
+    for are stopped at the end of the 'with' statement::
+
+        with BackgroundCommands(4) as background:
+            for key, cmd, dir in things_to_do:
+                background.add(key, cmd, dir)
+            ...
+            retcode, output = background.wait_for(key)
+    """
+
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.waiting = []       # (key, cmd, cwd), in order
+        self.running = {}       # key : (process, output file)
+        self.finished = {}      # key : (retcode, output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+    def add(self, key, cmd, cwd):
+        """Run command 'cmd' in directory 'cwd', remembering it as 'key'.
+        """
+        self.waiting.append((key, cmd, cwd))
+        self._start_more()
+
+    def _start_more(self):
+        while self.waiting and len(self.running) < self.jobs:
+            key, cmd, cwd = self.waiting.pop(0)
+            output = tempfile.TemporaryFile()
+            try:
+                with open(os.devnull) as devnull:
+                    process = subprocess.Popen(cmd, cwd=cwd, stdin=devnull,
+                                               stdout=output,
+                                               stderr=subprocess.STDOUT,
+                                               preexec_fn=os.setsid)
+            except OSError as e:
+                output.close()
+                self.finished[key] = (-1, 'Unable to run "%s": %s\n'%(
+                                      _stringify_cmd(cmd), e))
+                continue
+            self.running[key] = (process, output)
+
+    def _reap(self):
+        """Collect the results of any commands that have finished.
+        """
+        for key, (process, output) in self.running.items():
+            if process.poll() is not None:
+                output.seek(0)
+                self.finished[key] = (process.returncode, output.read())
+                output.close()
+                del self.running[key]
+        self._start_more()
+
+    def wait_for(self, key):
+        """Wait for the command called 'key' to finish.
+
+        Returns (retcode, output), or None if there is no such command (or
+        if we have already returned its result).
+        """
+        while key not in self.finished:
+            if key not in self.running and \
+                    not any(k == key for k, cmd, cwd in self.waiting):
+                return None
+            self._reap()
+            if key not in self.finished:
+                time.sleep(0.05)
+        return self.finished.pop(key)
+
+    def close(self):
+        """Stop any commands that are still running, and forget the rest.
+        """
+        self.waiting = []
+        for key, (process, output) in self.running.items():
+            if process.poll() is None:
+                # Each command leads its own session (and thus process group),
+                # so stop the whole group - for instance, the "git-remote-http"
+                # or ssh that a "git fetch" has started, as well as git itself
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                process.wait()
+            output.close()
+        self.running = {}
+        self.finished = {}
+
+# =============================================================================
+# Timing the phases of a muddle command
+
+class PhaseTimes(object):
+    """Accumulate the time spent in each (named) phase of a muddle command.
+
+    Timing is off until enable() is called, so that using phase() costs
+    (almost) nothing normally.
+
+    Phases may nest (for instance, subdomain inclusion happens whilst the
+    build description is being loaded). Time spent in an inner phase is not
+    counted towards the phase that contains it, so that the times for all
+    the phases add up to the total.
+
+        >>> t = PhaseTimes()
+        >>> with t.phase('ignored'):
+        ...     pass
+        >>> t.times
+        {}
+        >>> t.enable()
+        >>> with t.phase('outer'):
+        ...     with t.phase('inner'):
+        ...         pass
+        >>> t.order
+        ['outer', 'inner']
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        # The phase names, in the order we first met them
+        self.order = []
+        # Phase name -> (exclusive) time spent in it
+        self.times = {}
+        # Phase name -> number of times it was entered
+        self.counts = {}
+        # The phases we are currently inside, as [name, time-last-resumed]
+        self.stack = []
+
+    def enable(self):
+        """Start timing.
+        """
+        self.enabled = True
+        self.started = time.time()
+
+    def _add(self, name, elapsed):
+        if name not in self.times:
+            self.order.append(name)
+            self.times[name] = 0.0
+            self.counts[name] = 0
+        self.times[name] += elapsed
+
+    @contextmanager
+    def phase(self, name):
+        """A context manager that times the code it wraps as phase 'name'.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        now = time.time()
+        if self.stack:
+            # Pause whatever phase we're inside
+            outer = self.stack[-1]
+            self._add(outer[0], now - outer[1])
+        self._add(name, 0.0)
+        self.counts[name] += 1
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            this, resumed = self.stack.pop()
+            self._add(this, now - resumed)
+            if self.stack:
+                # And resume the outer phase
+                self.stack[-1][1] = now
+
+    def report(self):
+        """Return a summary of the phase times, as a string.
+        """
+        total = time.time() - self.started if self.started else 0.0
+        accounted = sum(self.times.values())
+        lines = ['Time spent in each phase:']
+        width = max([len(name) for name in self.order] + [len('(elsewhere)')])
+        for name in self.order:
+            count = self.counts[name]
+            lines.append('  %-*s %8.3fs%s'%(width, name, self.times[name],
+                         '' if count == 1 else '  (%d times)'%count))
+        lines.append('  %-*s %8.3fs'%(width, '(elsewhere)', max(total - accounted, 0.0)))
+        lines.append('  %-*s %8.3fs'%(width, 'Total', total))
+        return '\n'.join(lines)
+
+# The phase times for this muddle command. See "muddle --profile".
+phase_times = PhaseTimes()
+
+def timed_phase(name):
+    """A decorator, to time every call of a function as phase 'name'.
+
+    See PhaseTimes and 'phase_times'.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with phase_times.phase(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
 # =============================================================================
 
 def page_text(progname, text):
@@ -1080,7 +1592,54 @@ def copy_file_metadata(from_path, to_path):
         if os.geteuid() == 0:
             os.chown(to_path, st.st_uid, st.st_gid)
 
-def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=False):
+# The Linux ioctl that makes one file share the data of another (a "reflink")
+FICLONE = 0x40049409
+
+# The (source device, target device) pairs for which reflinks did not work
+_no_reflinks = set()
+
+def reflink_file(from_path, to_path):
+    """
+    Make 'to_path' a copy-on-write clone of 'from_path', if we can.
+
+    A clone shares its data with the original until one of them is altered,
+    so making it takes almost no time and no extra disk space. Only some
+    filesystems (for instance, btrfs and XFS) support this, and we only know
+    how to ask on Linux.
+
+    Returns True if 'to_path' is now a clone, or False if the caller should
+    copy the file instead. If cloning fails between two filesystems, we
+    remember that and do not try again.
+
+    Note that the file's mode, timestamp, etc., are not copied.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    to_dir = os.path.dirname(os.path.abspath(to_path))
+    devices = (os.stat(from_path).st_dev, os.stat(to_dir).st_dev)
+    if devices in _no_reflinks:
+        return False
+    with open(from_path, 'rb') as src:
+        with open(to_path, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except IOError as e:
+                if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                               errno.ENOTTY, errno.ENOSYS):
+                    _no_reflinks.add(devices)
+                    return False
+                raise
+    return True
+
+def _copy_file_data(from_path, to_path, reflink):
+    """
+    Copy the content of 'from_path' to 'to_path', by reflink if asked and able.
+    """
+    if not (reflink and reflink_file(from_path, to_path)):
+        shutil.copyfile(from_path, to_path)
+
+def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=False,
+              reflink=False):
     """
     Copy a file (either a "proper" file, not a directory, or a symbolic link).
 
@@ -1101,6 +1660,10 @@ def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=Fa
 
     If 'force' is true, then if a target file is not writeable, try removing it
     and then copying it.
+
+    If 'reflink' is true, then make the target a copy-on-write clone of the
+    source file if the filesystem supports it (see reflink_file), and only
+    copy its content if not.
     """
 
     if object_exactly and os.path.islink(from_path):
@@ -1110,11 +1673,11 @@ def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=Fa
         os.symlink(linkto, to_path)
     else:
         try:
-            shutil.copyfile(from_path, to_path)
+            _copy_file_data(from_path, to_path, reflink)
         except IOError as e:
             if force and e.errno == errno.EACCES:
                 os.remove(to_path)
-                shutil.copyfile(from_path, to_path)
+                _copy_file_data(from_path, to_path, reflink)
             else:
                 raise
 
@@ -1217,6 +1780,72 @@ def split_path_left(in_path):
     return (lst[0], rp)
 
 
+class PathTrie(object):
+    """
+    A prefix trie mapping relative paths to values.
+
+    Each path is stored as its sequence of directory components, so looking
+    up a path costs time proportional to its depth, not to the number of
+    paths stored.
+
+    A value may be stored as covering the whole of the subtree below its
+    path, or just the path itself. Looking up a path returns the value of
+    the deepest stored path that matches it:
+
+        >>> t = PathTrie()
+        >>> t.add('src/fred', 'fred', subtree=True)
+        >>> t.add('src/freddy', 'freddy', subtree=True)
+        >>> t.add('obj/jim', 'jim')
+        >>> t.lookup('src/fred/docs')
+        'fred'
+        >>> t.lookup('src/freddy')
+        'freddy'
+        >>> t.lookup('src/fr') is None
+        True
+        >>> t.lookup('obj/jim')
+        'jim'
+        >>> t.lookup('obj/jim/x86') is None
+        True
+    """
+
+    def __init__(self):
+        # Each node is a pair [value-or-None, {component: node}]
+        self.root = [None, {}]
+
+    @staticmethod
+    def _components(path):
+        return [x for x in os.path.normpath(path).split(os.sep) if x and x != '.']
+
+    def add(self, path, value, subtree=False):
+        """
+        Remember 'value' for 'path'.
+
+        If 'subtree' is true, then 'value' also applies to everything below
+        'path' (unless something deeper says otherwise).
+        """
+        node = self.root
+        for part in self._components(path):
+            node = node[1].setdefault(part, [None, {}])
+        node[0] = (value, subtree)
+
+    def lookup(self, path):
+        """
+        Return the value for 'path', or None if there isn't one.
+        """
+        found = None
+        node = self.root
+        parts = self._components(path)
+        for depth, part in enumerate(parts):
+            node = node[1].get(part)
+            if node is None:
+                break
+            if node[0] is not None:
+                value, subtree = node[0]
+                if subtree or depth == len(parts) - 1:
+                    found = value
+        return found
+
+
 def print_string_set(ss):
     """
     Given a string set, return a string representing it.
@@ -1290,11 +1919,36 @@ def xml_elem_with_child(doc, elem_name, child_text):
     return el
 
 
-def _copy_without(src, dst, ignored_names, object_exactly, preserve, force):
+def link_file(from_path, to_path):
+    """
+    Make 'to_path' a hard link to 'from_path', if we can.
+
+    Any existing 'to_path' is removed first.
+
+    Returns True if 'to_path' is now a link, or False if the caller should
+    copy the file instead (for instance, because the two paths are on
+    different filesystems).
+    """
+    if os.path.lexists(to_path):
+        os.remove(to_path)
+    try:
+        os.link(from_path, to_path)
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+            return False
+        raise
+    return True
+
+def _copy_without(src, dst, ignored_names, object_exactly, preserve, force,
+                  reflink=False, link=(), rel_path='', linking=False):
     """
     The insides of copy_without. See that for more documentation.
 
     'ignored_names' must be a sequence of filenames to ignore (but may be empty).
+
+    'rel_path' is the path of 'src' relative to the directory originally
+    being copied, and 'linking' is true if 'src' matched one of the 'link'
+    patterns (or is inside a directory that did).
     """
 
     # Inspired by the example for shutil.copytree in the Python 2.6 documentation
@@ -1317,12 +1971,19 @@ def _copy_without(src, dst, ignored_names, object_exactly, preserve, force):
             if object_exactly and os.path.islink(srcname):
                 copy_file(srcname, dstname, object_exactly=True, preserve=preserve)
             elif os.path.isdir(srcname):
+                rel_name = os.path.join(rel_path, name)
                 _copy_without(srcname, dstname, ignored_names=ignored_names,
                               object_exactly=object_exactly, preserve=preserve,
-                              force=force)
+                              force=force, reflink=reflink, link=link,
+                              rel_path=rel_name,
+                              linking=linking or any(fnmatchcase(rel_name, pattern)
+                                                     for pattern in link))
+            elif linking and link_file(srcname, dstname):
+                # The link shares its metadata with the original
+                pass
             else:
                 copy_file(srcname, dstname, object_exactly=object_exactly,
-                          preserve=preserve, force=force)
+                          preserve=preserve, force=force, reflink=reflink)
         except (IOError, os.error), why:
             raise GiveUp('Unable to copy %s to %s: %s'%(srcname, dstname, why))
 
@@ -1332,7 +1993,7 @@ def _copy_without(src, dst, ignored_names, object_exactly, preserve, force):
         raise GiveUp('Unable to copy properties of %s to %s: %s'%(src, dst, why))
 
 def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
-                 force=False, verbose=True):
+                 force=False, verbose=True, reflink=False, link=None):
     """
     Copy files from the 'src' directory to the 'dst' directory, without those in 'without'
 
@@ -1351,6 +2012,15 @@ def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
 
     If 'verbose' is true (the default), print out what we're copying.
 
+    If 'reflink' is true, then files are made copy-on-write clones of the
+    originals, where the filesystem supports it, and otherwise copied.
+
+    If given, 'link' should be a sequence of glob patterns, matched against
+    the paths of directories relative to 'src' - for instance,
+    ['.git/objects/pack']. The files within matching directories are hard
+    linked to the originals (where possible), rather than copied. This is
+    only safe for files that are never altered once written.
+
     Creates directories in the destination, if necessary.
 
     Uses copy_file() to copy each file.
@@ -1367,7 +2037,169 @@ def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
             print 'ignoring %s'%without
         print
 
-    _copy_without(src, dst, ignored_names, object_exactly, preserve, force)
+    _copy_without(src, dst, ignored_names, object_exactly, preserve, force,
+                  reflink, link or ())
+
+def _same_file_content(from_path, to_path, compare_content):
+    """
+    Does 'to_path' already hold the same file as 'from_path'?
+
+    See sync_directory() for what "the same" means.
+    """
+    from_st = os.stat(from_path)
+    try:
+        to_st = os.lstat(to_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    if not stat.S_ISREG(to_st.st_mode) or from_st.st_size != to_st.st_size:
+        return False
+    if int(from_st.st_mtime) == int(to_st.st_mtime):
+        return True
+    if compare_content and filecmp.cmp(from_path, to_path, shallow=False):
+        # Same content, different times - bring the times up to date, but
+        # don't count that as a change
+        copy_file_metadata(from_path, to_path)
+        return True
+    return False
+
+def _remove_path(path):
+    """
+    Remove 'path', whatever it is.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def _remove_copied(path, relname, previous):
+    """
+    Remove 'path', or as much of it as 'previous' says we copied there.
+
+    A directory is only removed if it is empty once the files we copied
+    into it have been removed.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in os.listdir(path):
+            child = '%s/%s'%(relname, name)
+            if child in previous:
+                _remove_copied(os.path.join(path, name), child, previous)
+        if not os.listdir(path):
+            os.rmdir(path)
+    else:
+        os.remove(path)
+
+def _sync_directory(src, dst, ignored_names, keep, compare_content,
+                    previous, copied, relpath):
+    """
+    The insides of sync_directory. See that for more documentation.
+
+    'relpath' is the path of 'dst' relative to the top of the copy, with
+    '/' as separator, or '' at the top.
+    """
+    changed = False
+
+    if os.path.lexists(dst) and (os.path.islink(dst) or not os.path.isdir(dst)):
+        os.remove(dst)
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+        changed = True
+
+    names = [name for name in os.listdir(src) if name not in ignored_names]
+
+    for name in sorted(set(os.listdir(dst)) - set(names)):
+        if name in ignored_names or any(fnmatchcase(name, k) for k in keep):
+            continue
+        relname = relpath + name
+        dstname = os.path.join(dst, name)
+        if previous is None:
+            _remove_path(dstname)
+        elif relname in previous:
+            _remove_copied(dstname, relname, previous)
+        else:
+            # We didn't put it there, so it's not ours to delete
+            continue
+        changed = True
+
+    for name in sorted(names):
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        relname = relpath + name
+        if copied is not None:
+            copied.add(relname)
+        try:
+            if os.path.isdir(srcname):
+                if _sync_directory(srcname, dstname, ignored_names, keep,
+                                   compare_content, previous, copied,
+                                   relname + '/'):
+                    changed = True
+            elif not _same_file_content(srcname, dstname, compare_content):
+                if os.path.lexists(dstname):
+                    _remove_path(dstname)
+                copy_file(srcname, dstname, preserve=True, force=True)
+                changed = True
+        except (IOError, os.error), why:
+            raise GiveUp('Unable to copy %s to %s: %s'%(srcname, dstname, why))
+
+    try:
+        copy_file_metadata(src, dst)
+    except OSError, why:
+        raise GiveUp('Unable to copy properties of %s to %s: %s'%(src, dst, why))
+
+    return changed
+
+def sync_directory(src, dst, without=None, keep=None, compare_content=False,
+                   previous=None, copied=None, verbose=True):
+    """
+    Make the 'dst' directory a copy of the 'src' directory, copying as little
+    as possible.
+
+    This is like recursively_copy(), with 'preserve' true, except that:
+
+    * a file is only copied if it differs from the file already in 'dst',
+      which is decided by comparing their sizes and modification times
+      (to the nearest second). If 'compare_content' is true, then files of
+      the same size but with different modification times are also compared
+      byte for byte, and are only copied if their content differs.
+    * anything in 'dst' that is not in 'src' is deleted (but see 'previous').
+
+    Symbolic links in 'src' are followed, as by recursively_copy().
+
+    If given, 'without' should be a sequence of filenames that are neither
+    copied nor deleted - for instance, ['.bzr', '.svn'].
+
+    If given, 'keep' should be a sequence of "glob" patterns (as understood
+    by fnmatch) for files that are not to be deleted from 'dst', even though
+    they are not in 'src' - for instance, ['*.pyc'].
+
+    If 'previous' is given, it should be a set of the paths (relative to
+    'dst', using '/' as separator) that an earlier synchronisation copied.
+    Only those paths are deleted when they are no longer in 'src', so that
+    anything else that has been added to 'dst' is left alone.
+
+    If 'copied' is given, it should be a set, to which we add the paths
+    (in the same form) of everything in 'src' - that is, everything that
+    'dst' now has a copy of. It is suitable for use as 'previous' next time.
+
+    If 'verbose' is true (the default), print out what we're synchronising.
+
+    Returns True if anything in 'dst' was changed, False otherwise.
+    """
+
+    if without is not None:
+        ignored_names = without
+    else:
+        ignored_names = set()
+
+    if keep is None:
+        keep = []
+
+    if verbose:
+        print 'Synchronising %s with %s'%(dst, src)
+
+    return _sync_directory(src, dst, ignored_names, keep, compare_content,
+                           previous, copied, '')
 
 def copy_name_list_with_dirs(file_list, old_root, new_root,
                              object_exactly = True, preserve = False):
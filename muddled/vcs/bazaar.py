@@ -31,12 +31,19 @@ Available Bazaar specific options are:
     but checkout <co-name> uses VCS Bazaar for which we do not support branching.
     The build description should specify a revision for checkout <co-name>.
 
+Working out the revision of a Bazaar checkout (for "muddle stamp") needs
+two bzr commands, each of which starts a new Python interpreter, and one of
+which asks the remote repository. So the result is remembered for each
+checkout, and only worked out again if .bzr/branch/last-revision or
+.bzr/checkout/dirstate has changed, or if "bzr version-info --check-clean"
+gives a different answer.
 """
 
 import os
 import re
 
-from muddled.version_control import register_vcs, VersionControlSystem
+from muddled.version_control import register_vcs, VersionControlSystem, \
+        metadata_key
 import muddled.utils as utils
 
 class Bazaar(VersionControlSystem):
@@ -444,6 +451,24 @@ class Bazaar(VersionControlSystem):
         repo = repo.copy_with_changed_revision(revision)
         self.pull(repo, None, verbose=verbose)
 
+    def _version_info(self, env):
+        """
+        Run 'bzr version-info --check-clean', and return what it says.
+
+        Returns (<cmd>, <text>, <fields>), where <cmd> is the BZR command
+        used, <text> is its output, and <fields> is a dictionary of the
+        "name: value" lines therein - for instance, 'revision-id', 'revno'
+        and 'clean'.
+        """
+        cmd = 'bzr version-info --check-clean'
+        text = self._run1(cmd, env=env, fold_stderr=False)
+        fields = {}
+        for line in text.split('\n'):
+            name, colon, value = line.partition(':')
+            if colon and name and not name.startswith(' '):
+                fields[name.strip()] = value.strip()
+        return cmd, text, fields
+
     def _all_checked_in(self, env):
         """
         Do we have anything that is not yet checked in?
@@ -452,9 +477,8 @@ class Bazaar(VersionControlSystem):
         (False, <cmd>, <text>) if not, where <cmd> is the BZR command used, and
         <text> is its output.
         """
-        cmd = 'bzr version-info --check-clean'
-        text = self._run1(cmd, env=env, fold_stderr=False)
-        if 'clean: False' in text:
+        cmd, text, fields = self._version_info(env)
+        if fields.get('clean') == 'False':
             return False, cmd, text
         return True, cmd, None
 
@@ -537,6 +561,10 @@ class Bazaar(VersionControlSystem):
         then that may be useful. Or no output with '-q' if they're OK.
         (needs to ignore stderr output, since I get that for mismatch
         in Bazaar network protocols)
+
+        Since the revision id that 'bzr version-info' reports is that of the
+        last commit on this local branch, which is what we want, we take
+        it from there, rather than asking bzr again.
         """
 
         env = self._derive_env()
@@ -555,8 +583,8 @@ class Bazaar(VersionControlSystem):
             orig_revision = 'HEAD'
 
         # So, have we checked everything in?
-        ok, cmd, txt = self._all_checked_in(env)
-        if not ok:
+        cmd, txt, fields = self._version_info(env)
+        if fields.get('clean') == 'False':
             if force:
                 print "'%s' reports checkout '%s' has uncommitted data" \
                         " (ignoring it)"%(cmd, co_leaf)
@@ -601,11 +629,38 @@ class Bazaar(VersionControlSystem):
                                     utils.indent(missing,'    ')))
 
         # So let's go with the revision id for the last commit of this local branch
+        if fields.get('revision-id'):
+            return fields['revision-id']
         try:
             return self._revision_id(env, 'revno:-1')
         except utils.GiveUp as e:
             raise utils.GiveUp('%s: %s'%(co_leaf, e))
 
+    def revision_cache_key(self):
+        """
+        Return a key describing the state of the checkout.
+
+        revision_to_checkout() checks for uncommitted changes, as well as
+        asking for the last revision, so the key is made up of the details
+        of .bzr/branch/last-revision and .bzr/checkout/dirstate, and the
+        revision id and "clean" values from "bzr version-info --check-clean"
+        (which is how revision_to_checkout() does its check). It is the
+        "bzr missing" that revision_to_checkout() then does, asking the
+        remote repository, that we save by remembering the result.
+
+        Returns None if this is not a bzr checkout, or if version-info fails,
+        so that nothing is cached.
+        """
+        if not os.path.isdir('.bzr'):
+            return None
+        try:
+            cmd, text, fields = self._version_info(self._derive_env())
+        except utils.ShellError:
+            return None
+        return metadata_key([os.path.join('.bzr', 'branch', 'last-revision'),
+                             os.path.join('.bzr', 'checkout', 'dirstate')]) + \
+               [['version-info', fields.get('revision-id'), fields.get('clean')]]
+
     def _just_revno(self):
         """
         This returns the revision number for the working tree
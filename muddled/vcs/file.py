@@ -1,9 +1,33 @@
 """
 Muddle support for naive file copying.
 
-.. to be documented ..
+* muddle checkout
+
+  Copies the directory named by the "file:" URL into the checkout directory.
+
+* muddle pull, muddle merge
+
+  Brings the checkout directory back into line with the original directory,
+  copying only those files whose size or modification time differ, and
+  deleting anything that is no longer in the original directory (except
+  for compiled Python files, "*.pyc", which are left alone). Only files
+  that muddle itself copied into the checkout are deleted - it remembers
+  what it copied in .muddle/file_manifests - so files that have been
+  added to the checkout locally are kept. The checkout is only counted as
+  "just pulled" if something was actually changed.
+
+  If the checkout has the VCS option "compare_content" set to True, then
+  files whose size is the same, but whose modification time differs, are
+  also compared byte for byte, and are not copied if their content is the
+  same. This is slower, but useful when the original directory is
+  regenerated (for instance, unpacked again) with new timestamps.
+
+* muddle commit, muddle push
+
+  Do nothing - we refuse to copy anything back to the original directory.
 """
 
+import errno
 import os
 import urlparse
 
@@ -18,6 +42,7 @@ class File(VersionControlSystem):
     def __init__(self):
         self.short_name = 'file'
         self.long_name = 'FileSystem'
+        self.allowed_options.add('compare_content')
 
     def init_directory(self, verbose=True):
         """
@@ -54,12 +79,14 @@ class File(VersionControlSystem):
         source_path = parsed.path
 
         utils.recursively_copy(source_path, co_leaf, preserve=True)
+        _write_manifest(co_leaf, _paths_under(co_leaf))
 
     def pull(self, repo, options, upstream=None, verbose=True):
         """
         Will be called in the actual checkout's directory.
 
-        Just copies everything again.
+        Copies whatever has changed, and deletes whatever has been removed.
+        Returns True if anything changed.
         """
         if repo.revision and repo.revision != 'HEAD':
             raise utils.GiveUp("File does not support the 'revision' argument to"
@@ -67,19 +94,14 @@ class File(VersionControlSystem):
         if repo.branch:
             raise utils.GiveUp("File does not support the 'branch' argument to"
                                " 'pull' (branch='%s'"%repo.branch)
-        self.checkout(repo, os.curdir, options, verbose=verbose)
-
-        # Ideally, we would determine whether the directory had changed by
-        # using hashlib to do a recursive MD5 or SHA1 sum of the files in it.
-        # However, since I don't know that anyone is *using* this VCS method,
-        # it hardly seems worth the effort. So we'll lie.
-        return True
+        return self._sync(repo, options, verbose)
 
     def merge(self, other_repo, options, verbose=True):
         """
         Merge 'other_repo' into the local repository and working tree,
 
-        Just copies everything again. This is an imperfect sort of "merge".
+        Just synchronises with 'other_repo', as pull() does. This is an
+        imperfect sort of "merge".
         """
         if other_repo.revision and other_repo.revision != 'HEAD':
             raise utils.GiveUp("File does not support the 'revision' argument to"
@@ -87,10 +109,25 @@ class File(VersionControlSystem):
         if other_repo.branch:
             raise utils.GiveUp("File does not support the 'branch' argument to"
                                " 'merge' (branch='%s'"%other_repo.branch)
-        self.checkout(other_repo, os.curdir, options, verbose=verbose)
+        return self._sync(other_repo, options, verbose)
+
+    def _sync(self, repo, options, verbose=True):
+        """
+        Synchronise the current directory with the directory 'repo' names.
 
-        # See the comment in 'pull()' above
-        return True
+        Returns True if anything changed.
+        """
+        parsed = urlparse.urlparse(repo.url)
+        source_path = parsed.path
+        copied = set()
+        # Build descriptions are compiled in place, so don't delete the
+        # results just because they're not in the original directory
+        changed = utils.sync_directory(source_path, os.curdir, keep=['*.pyc'],
+                                       compare_content=options.get('compare_content', False),
+                                       previous=_read_manifest(os.curdir),
+                                       copied=copied, verbose=verbose)
+        _write_manifest(os.curdir, copied)
+        return changed
 
     def commit(self, repo, options, verbose=True, quick = False):
         """
@@ -133,6 +170,70 @@ class File(VersionControlSystem):
         with open(source_path) as fd:
             return fd.read()
 
+def _manifest_file_name(co_dir):
+    """
+    Return the name of the file listing what we have copied into 'co_dir'.
+
+    This is in the .muddle directory of the build tree (or subdomain)
+    containing 'co_dir', or is None if we can't find one.
+    """
+    co_dir = os.path.abspath(co_dir)
+    root = os.path.dirname(co_dir)
+    while not os.path.isdir(os.path.join(root, '.muddle')):
+        parent = os.path.dirname(root)
+        if parent == root:
+            return None
+        root = parent
+    return os.path.join(root, '.muddle', 'file_manifests',
+                        os.path.relpath(co_dir, root) + '.manifest')
+
+def _paths_under(co_dir):
+    """
+    Return a set of the paths of everything in 'co_dir', relative to it.
+
+    The paths use '/' as separator, as for utils.sync_directory().
+    """
+    paths = set()
+    for dirpath, dirnames, filenames in os.walk(co_dir):
+        reldir = os.path.relpath(dirpath, co_dir)
+        for name in dirnames + filenames:
+            if reldir == os.curdir:
+                paths.add(name)
+            else:
+                paths.add('/'.join(reldir.split(os.sep) + [name]))
+    return paths
+
+def _read_manifest(co_dir):
+    """
+    Return a set of the paths we last copied into 'co_dir'.
+
+    If we have no record of that (for instance, because the checkout was
+    made by an older version of muddle), we return an empty set, so that
+    nothing gets deleted.
+    """
+    file_name = _manifest_file_name(co_dir)
+    if file_name is None:
+        return set()
+    try:
+        with open(file_name) as fd:
+            return set(line.rstrip('\n') for line in fd if line.strip())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return set()
+
+def _write_manifest(co_dir, paths):
+    """
+    Remember that 'paths' are what we have copied into 'co_dir'.
+    """
+    file_name = _manifest_file_name(co_dir)
+    if file_name is None:
+        return
+    utils.ensure_dir(os.path.dirname(file_name), verbose=False)
+    with open(file_name, 'w') as fd:
+        for path in sorted(paths):
+            fd.write('%s\n'%path)
+
 def _decode_file_url(url):
     result = urlparse.urlparse(url)
     if result.scheme not in ('', 'file'):
@@ -22,6 +22,16 @@ TODO: The following needs rewriting after work for issue 225
 
   (the emphasis is mine).
 
+  If a partial checkout is selected, then the ``--filter=blob:none`` switch
+  is added to the clone command.
+
+  If the environment variable MUDDLE_GIT_MIRRORS names a directory, then a
+  bare mirror of the repository is kept in that directory (and created if
+  necessary), and the clone borrows objects from it, using ``git clone
+  --reference --dissociate`` (so the clone does not depend on the mirror
+  afterwards). This is not done for shallow or partial checkouts. See
+  muddled.vcs.git_mirrors for more information.
+
   If a revision is requested, then ``git checkout`` is used to check it out.
 
   If a branch *and* a revision are requested, then muddle checks to see if
@@ -51,6 +61,12 @@ TODO: The following needs rewriting after work for issue 225
   otherwise it does ``git merge --ff-only``, which will merge in the fetch if
   it doesn't require human interaction.
 
+  When "muddle pull" is pulling several checkouts one at a time, it first
+  starts a ``git fetch`` for each of them in the background (a few at a
+  time), fetching from the remote repository into the "origin" remote
+  branches. Each pull then waits for its own fetch, and does not need to
+  fetch again. If a background fetch fails, the pull just fetches as normal.
+
 * muddle push, muddle push-upstream
 
   If the checkout is marked as "shallow', or is on a detached HEAD, then an
@@ -101,18 +117,45 @@ Available git specific options are:
 
   If 'shallow_checkout' is specified, then "muddle push" will refuse to do
   anything.
+
+* partial_checkout: If True, then make a "blobless" partial clone (i.e.,
+  pass the git switch "--filter=blob:none"). If False, then no effect. The
+  default is False.
+
+  A partial clone has all of the history (commits and trees), but file
+  contents (blobs) are only fetched from the remote repository when they
+  are needed - typically, when a revision is checked out. So, unlike a
+  shallow checkout, a partial checkout can still be pulled, pushed,
+  branched and stamped, whilst the initial clone of a large repository is
+  much cheaper. The remote repository must support partial clones - if it
+  does not, git will say so, and make a full clone instead.
+
+  Partial checkouts do not use shared stores or local mirrors (see
+  muddled.vcs.git_mirrors), since those would fetch all of the blobs anyway.
+
+  "muddle status" does not do rename detection for a partial checkout, and
+  "muddle stamp" (and friends) only look at commits and refs, so none of
+  them cause blobs to be fetched.
 """
 
+import hashlib
 import os
 import re
 
 import muddled.utils as utils
-from muddled.version_control import register_vcs, VersionControlSystem
+from muddled.vcs import git_mirrors, git_objects
+from muddled.version_control import register_vcs, VersionControlSystem, metadata_key, \
+        working_tree_digest, paths_digest
 from muddled.withdir import Directory
 from muddled.utils import GiveUp
 
 g_supports_ff_only = None
 
+# The checkouts that have been fetched by a prefetch command during this
+# muddle command, and not yet pulled, indexed by checkout directory. Each
+# value is (remote repository URL, output of the fetch).
+_prefetched = {}
+
 def git_supports_ff_only():
     """
     Does my git support --ff-only?
@@ -136,6 +179,9 @@ def expand_revision(revision):
 
     Raises GiveUp if the revision appears non-existent or ambiguous
     """
+    sha1 = git_objects.rev_parse(revision)
+    if sha1:
+        return sha1
     rv, out = utils.run2('git rev-parse %s'%revision, show_command=False)
     if rv:
         raise GiveUp('Revision "%s" is either non-existant or ambiguous'%revision)
@@ -150,6 +196,7 @@ class Git(VersionControlSystem):
         self.short_name = 'git'
         self.long_name = 'Git'
         self.allowed_options.add('shallow_checkout')
+        self.allowed_options.add('partial_checkout')
 
     def init_directory(self, verbose=True):
         """
@@ -185,12 +232,33 @@ class Git(VersionControlSystem):
             # Explicitly use master if no branch specified - don't default
             args = ["-b", "master"]
 
-        if options.get('shallow_checkout'):
-            args += ["--depth", "1"]
+        store = self._shared_store(repo, options)
+        source = repo.url
+        if options.get('shallow_checkout') or options.get('partial_checkout'):
+            if options.get('shallow_checkout'):
+                args += ["--depth", "1"]
+            if options.get('partial_checkout'):
+                args += ["--filter=blob:none"]
+        elif store:
+            # This muddle command has already fetched the repository into a
+            # shared store, so we can clone from that (locally) instead
+            source = store
+        else:
+            # If we're keeping local mirrors, borrow objects from ours -
+            # but copy them, so that we don't depend on the mirror later on
+            mirror = git_mirrors.ensure_mirror(repo.url, verbose)
+            if mirror:
+                args += ["--reference", mirror, "--dissociate"]
 
-        utils.shell(["git", "clone"] + args + [repo.url, str(co_leaf)],
+        utils.shell(["git", "clone"] + args + [source, str(co_leaf)],
                    show_command=verbose)
 
+        if source != repo.url:
+            # Our origin should be the real repository, not the shared store
+            with Directory(co_leaf, show_pushd=False):
+                utils.shell(["git", "remote", "set-url", "origin", repo.url],
+                           show_command=verbose)
+
         if repo.revision:
             with Directory(co_leaf):
                 # Are we already at the correct revision?
@@ -203,6 +271,42 @@ class Git(VersionControlSystem):
                     # XXX it is meant to be
                     utils.shell(["git", "checkout", repo.revision])
 
+    def _shared_store(self, repo, options):
+        """Return the shared store we should fetch 'repo' from, or None.
+
+        Shallow and partial checkouts always fetch from the real repository.
+        """
+        if options.get('shallow_checkout') or options.get('partial_checkout'):
+            return None
+        return git_mirrors.shared_store(repo.url)
+
+    def prefetch_command(self, repo, options):
+        """
+        Return a "git fetch" that updates our "origin" remote branches.
+
+        We fetch directly from the repository URL, rather than from "origin",
+        since the pull may yet change where "origin" points. Shallow and
+        partial checkouts, and repositories that have been fetched into a
+        shared store, are not prefetched.
+        """
+        if options.get('shallow_checkout') or options.get('partial_checkout'):
+            return None
+        if self._shared_store(repo, options):
+            return None
+        return ['git', 'fetch', str(repo), '+refs/heads/*:refs/remotes/origin/*']
+
+    def prefetched(self, repo, options, output):
+        """
+        Remember that we have fetched 'repo', so that pull need not.
+        """
+        _prefetched[os.path.realpath(os.getcwd())] = (str(repo), output)
+
+    def forget_prefetched(self):
+        """
+        Forget any prefetches that pull has not (yet) used.
+        """
+        _prefetched.clear()
+
     def _is_it_safe(self):
         """
         No dentists here...
@@ -294,11 +398,25 @@ class Git(VersionControlSystem):
         # for instance if we try to fetch a branch that does not exist.
         # This *does* mean there's a slight delay before the user sees the output,
         # though
-        cmd = "git fetch %s"%upstream
-        rv, out = utils.run2(cmd, show_command=verbose)
-        if rv:
-            raise GiveUp('Error %d running "%s"\n%s'%(rv, cmd, out))
+        store = self._shared_store(repo, options)
+        prefetch = _prefetched.pop(os.path.realpath(os.getcwd()), None)
+        if store:
+            # This muddle command has already fetched the repository into a
+            # shared store, so fetch from that (locally) instead
+            cmd = ["git", "fetch", store,
+                   "+refs/heads/*:refs/remotes/%s/*"%upstream]
+        elif prefetch and upstream == 'origin' and prefetch[0] == str(repo):
+            # We fetched from this repository in the background, just now
+            print '++ Already fetched from %s'%repo
+            if prefetch[1].strip():
+                print prefetch[1].rstrip()
+            cmd = None
         else:
+            cmd = ["git", "fetch", upstream]
+        if cmd:
+            rv, out = utils.run2(cmd, show_command=verbose)
+            if rv:
+                raise GiveUp('Error %d running "%s"\n%s'%(rv, ' '.join(cmd), out))
             # The older version of this code just used utils.run_cmd(), which
             # runs the command in a sub-shell, and thus its output is always
             # presented, regardless of the "verbose" setting. For the moment
@@ -427,13 +545,21 @@ class Git(VersionControlSystem):
 
         Return status text or None if there is no interesting status.
         """
-        retcode, text = utils.run2("git status --porcelain", show_command=False)
-        if retcode == 129:
-            print "Warning: Your git does not support --porcelain; you should upgrade it."
-            retcode, text = utils.run2("git status", show_command=False)
+        # Version 2 of the porcelain format (git 2.11 and later) also tells
+        # us about our HEAD and its upstream, which saves us asking
+        cmd = ["git", "status", "--porcelain=v2", "--branch"]
+        if options.get('partial_checkout'):
+            # Rename detection compares file contents, which in a partial
+            # clone may mean fetching blobs from the remote repository
+            cmd.append("--no-renames")
+        retcode, text = utils.run2(cmd, show_command=False)
+        if retcode:
+            return self._status_without_v2(repo, options, quick)
 
-        detached_head = self._is_detached_HEAD()
+        headers, changes = self._parse_porcelain_v2(text)
+        detached_head = (headers.get('branch.head') == '(detached)')
 
+        text = '\n'.join(changes)
         if detached_head:
             # That's all the user really needs to know
             note = '\n# Note that this checkout has a detached HEAD'
@@ -445,28 +571,35 @@ class Git(VersionControlSystem):
         if text:
             return text
 
-        # git status will tell us if there uncommitted changes, etc., but not if
-        # we are ahead of or behind (the local idea of) the remote repository,
-        # or it will, but not with --porcelain
-
-
+        local_head_ref = headers.get('branch.oid')
         if detached_head:
             head_name = 'HEAD'
+            branch_name = 'HEAD'
         else:
-            # First, find out what our HEAD actually is
-            retcode, text = utils.run2("git rev-parse --symbolic-full-name HEAD",
-                                       show_command=False)
-            head_name = text.strip()
-
-        # Now we can look up its SHA1, locally
-        retcode, head_revision = utils.run2("git rev-parse %s"%head_name,
-                                            show_command=False)
-        local_head_ref = head_revision.strip()
+            branch_name = headers.get('branch.head')
+            head_name = 'refs/heads/%s'%branch_name
 
         if quick:
-            branch_name = utils.get_cmd_data("git rev-parse --abbrev-ref HEAD")
-            text = utils.get_cmd_data("git show-ref origin/%s"%branch_name)
-            ref, what = text.split()
+            upstream = headers.get('branch.upstream')
+            if upstream == 'origin/%s'%branch_name and 'branch.ab' in headers:
+                # We already know how we compare to it, without asking
+                ahead, behind = [int(x) for x in headers['branch.ab'].split()]
+                if ahead == 0 and behind == 0:
+                    return None
+                return '\n'.join(
+                    ('After checking local HEAD against our local record of the remote HEAD',
+                     '# The local repository does not match the remote:',
+                     '#',
+                     '#  HEAD   is %s'%head_name,
+                     '#  Local  is %s'%local_head_ref,
+                     '#  Local  is %d commit%s ahead of, and %d behind, last known %s'%(
+                         ahead, '' if ahead == 1 else 's', -behind, upstream),
+                     '#',
+                     '# You probably need to push or pull.',
+                     '# Use "muddle status" without "-quick" to get a better idea'))
+            else:
+                text = utils.get_cmd_data("git show-ref origin/%s"%branch_name)
+                ref, what = text.split()
             if ref != local_head_ref:
                 return '\n'.join(
                     ('After checking local HEAD against our local record of the remote HEAD',
@@ -481,7 +614,73 @@ class Git(VersionControlSystem):
             else:
                 return None
 
-        # So look up the remote equivalents...
+        return self._compare_with_remote_HEAD(head_name, local_head_ref)
+
+    def _parse_porcelain_v2(self, text):
+        """
+        Parse the output of "git status --porcelain=v2 --branch".
+
+        Returns a tuple (headers, changes), where 'headers' is a dictionary
+        of the "# branch.xxx" header values, and 'changes' is a list of the
+        changed files, described in the traditional --porcelain manner.
+
+        For instance:
+
+            >>> g = Git()
+            >>> headers, changes = g._parse_porcelain_v2('''\\
+            ... # branch.oid 0123456789abcdef0123456789abcdef01234567
+            ... # branch.head master
+            ... # branch.upstream origin/master
+            ... # branch.ab +1 -0
+            ... 1 .M N... 100644 100644 100644 0123 4567 fred.c
+            ... 2 R. N... 100644 100644 100644 0123 4567 R100 new name.c\\told.c
+            ... ? untracked.c
+            ... ''')
+            >>> headers['branch.head'], headers['branch.ab']
+            ('master', '+1 -0')
+            >>> for line in changes:
+            ...     print line
+             M fred.c
+            R  old.c -> new name.c
+            ?? untracked.c
+        """
+        headers = {}
+        changes = []
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                parts = line[2:].split(' ', 1)
+                if len(parts) == 2:
+                    headers[parts[0]] = parts[1]
+                continue
+            kind = line[0]
+            if kind == '1':
+                fields = line.split(' ', 8)
+                changes.append('%s %s'%(fields[1].replace('.', ' '), fields[8]))
+            elif kind == '2':
+                fields = line.split(' ', 9)
+                path, orig_path = fields[9].split('\t', 1)
+                changes.append('%s %s -> %s'%(fields[1].replace('.', ' '),
+                                              orig_path, path))
+            elif kind == 'u':
+                fields = line.split(' ', 10)
+                changes.append('%s %s'%(fields[1], fields[10]))
+            elif kind == '?':
+                changes.append('?? %s'%line[2:])
+            elif kind == '!':
+                changes.append('!! %s'%line[2:])
+            else:
+                changes.append(line)
+        return headers, changes
+
+    def _compare_with_remote_HEAD(self, head_name, local_head_ref):
+        """
+        Ask the remote repository what it thinks 'head_name' is.
+
+        Returns None if that matches 'local_head_ref', and otherwise some
+        status text explaining the problem.
+        """
         retcode, text = utils.run2("git ls-remote", show_command=False)
         lines = text.split('\n')
         if retcode:
@@ -513,6 +712,67 @@ class Git(VersionControlSystem):
 
         return None
 
+    def _status_without_v2(self, repo, options, quick=False):
+        """
+        Work out our status with an older git, without --porcelain=v2
+        """
+        retcode, text = utils.run2("git status --porcelain", show_command=False)
+        if retcode == 129:
+            print "Warning: Your git does not support --porcelain; you should upgrade it."
+            retcode, text = utils.run2("git status", show_command=False)
+
+        detached_head = self._is_detached_HEAD()
+
+        if detached_head:
+            # That's all the user really needs to know
+            note = '\n# Note that this checkout has a detached HEAD'
+            if text:
+                text = '%s\n#%s'%(text, note)
+            else:
+                text = note
+
+        if text:
+            return text
+
+        # git status will tell us if there uncommitted changes, etc., but not if
+        # we are ahead of or behind (the local idea of) the remote repository,
+        # or it will, but not with --porcelain
+
+
+        if detached_head:
+            head_name = 'HEAD'
+        else:
+            # First, find out what our HEAD actually is
+            retcode, text = utils.run2("git rev-parse --symbolic-full-name HEAD",
+                                       show_command=False)
+            head_name = text.strip()
+
+        # Now we can look up its SHA1, locally
+        retcode, head_revision = utils.run2("git rev-parse %s"%head_name,
+                                            show_command=False)
+        local_head_ref = head_revision.strip()
+
+        if quick:
+            branch_name = utils.get_cmd_data("git rev-parse --abbrev-ref HEAD")
+            text = utils.get_cmd_data("git show-ref origin/%s"%branch_name)
+            ref, what = text.split()
+            if ref != local_head_ref:
+                return '\n'.join(
+                    ('After checking local HEAD against our local record of the remote HEAD',
+                     '# The local repository does not match the remote:',
+                     '#',
+                     '#  HEAD   is %s'%head_name,
+                     '#  Local  is %s'%local_head_ref,
+                     '#  last known origin/%s is %s'%(branch_name, ref),
+                     '#',
+                     '# You probably need to push or pull.',
+                     '# Use "muddle status" without "-quick" to get a better idea'))
+            else:
+                return None
+
+        # So look up the remote equivalents...
+        return self._compare_with_remote_HEAD(head_name, local_head_ref)
+
     def _setup_remote(self, remote_name, remote_repo, verbose=True):
         """
         Re-associate the local repository with a remote.
@@ -703,28 +963,113 @@ class Git(VersionControlSystem):
         """
         Is there a branch of this name?
 
+        Will be called in the actual checkout's directory.
+        """
+        return branch in self.list_branches()
+
+    def list_branches(self):
+        """
+        Return a list of the names of the local and remote branches.
+
+        Remote branches are named without their remote (so "origin/fred" is
+        just "fred"), and each name occurs only once.
+
         Will be called in the actual checkout's directory.
         """
         retcode, out = utils.run2('git branch -a', show_command=False)
         if retcode:
             raise GiveUp('Error looking up existing branches: %s'%out)
 
+        branches = []
         lines = out.split('\n')
         for line in lines:
             text = line[2:]         # Ignore the initial '  ' or '* '
             text = text.strip()     # Ignore trailing whitespace
+            if not text:
+                continue
             if '->' in text:        # Ignore 'remotes/origin/HEAD -> origin/master'
                 continue
             if '/' in text:
                 text = text.split('/')[-1]  # just take the name at the end
-            if text == branch:
-                return True
-        return False
+            if text not in branches:
+                branches.append(text)
+        return branches
+
+    def revision_cache_key(self):
+        """
+        Return a key describing the state of our refs.
+
+        Git updates a ref by writing a new file and renaming it over the old
+        one, so the mtime and inode of HEAD, of packed-refs, and of the files
+        and directories under .git/refs, tell us whether the current revision,
+        branch or set of branches can have changed.
+
+        Will be called in the actual checkout's directory.
+
+        Returns None if .git is not a directory (for instance, if this is a
+        "git worktree"), since we then don't know where the refs are.
+        """
+        if not os.path.isdir('.git'):
+            return None
+        paths = [os.path.join('.git', 'HEAD'),
+                 os.path.join('.git', 'packed-refs')]
+        for dirpath, dirnames, filenames in os.walk(os.path.join('.git', 'refs')):
+            dirnames.sort()
+            paths.append(dirpath)
+            for name in sorted(filenames):
+                paths.append(os.path.join(dirpath, name))
+        return metadata_key(paths)
+
+    def source_fingerprint(self):
+        """
+        Return a string identifying the current content of the checkout.
+
+        This is the id of the tree object for HEAD, which git already knows,
+        so that a clean checkout can be fingerprinted without looking at its
+        files. If there are local changes (including new files that are not
+        ignored), we also add a digest of the status, size and modification
+        time of each changed file (see paths_digest). Ignored files, such as
+        build results in the checkout, are not looked at.
+
+        Will be called in the actual checkout's directory.
+        """
+        tree = git_objects.rev_parse('HEAD^{tree}')
+        if not tree:
+            retcode, tree = utils.run2('git rev-parse HEAD^{tree}', show_command=False)
+            if retcode:
+                # Presumably there are no commits yet
+                tree = 'none'
+            tree = tree.strip()
+        # We ask "git status" rather than "git ls-files -m -o" so that changes
+        # that have been staged (but not committed) are also noticed.
+        # Each entry is "XY path", except that a rename or copy is followed
+        # by a separate entry for the original path.
+        retcode, text = utils.run2("git status --porcelain -z --untracked-files=all",
+                                   show_command=False)
+        if retcode:
+            return 'git:%s+%s'%(tree, working_tree_digest('.', '.git'))
+        entries = [x for x in text.split('\0') if x]
+        if not entries:
+            return 'git:%s'%tree
+        changes = []
+        paths = []
+        entries.reverse()
+        while entries:
+            entry = entries.pop()
+            changes.append(entry)
+            paths.append(entry[3:])
+            if entry[0] in 'RC' and entries:
+                changes.append(entries.pop())
+        digest = hashlib.sha1('\0'.join(changes) + paths_digest(paths))
+        return 'git:%s+%s'%(tree, digest.hexdigest())
 
     def _git_rev_parse_HEAD(self):
         """
         This returns a bare SHA1 object name for the current HEAD
         """
+        revision = git_objects.rev_parse('HEAD')
+        if revision:
+            return revision
         retcode, revision = utils.run2('git rev-parse HEAD', show_command=False)
         if retcode:
             raise GiveUp("'git rev-parse HEAD' failed with return code %d"%retcode)
@@ -752,6 +1097,10 @@ class Git(VersionControlSystem):
                     " could not determine a revision id for checkout:"%(co_leaf, before)),
                     text))
         else:
+            revision = git_objects.rev_parse('HEAD')
+            if revision:
+                return revision
+            # Ask again, so that we can report what went wrong
             retcode, revision = utils.run2('git rev-parse HEAD', show_command=False)
             if retcode:
                 if revision:
@@ -821,6 +1170,11 @@ class Git(VersionControlSystem):
     def get_vcs_special_files(self):
         return ['.git', '.gitignore', '.gitmodules']
 
+    def get_vcs_immutable_dirs(self):
+        # Pack files and loose objects are named for their content, so git
+        # never changes them (which is why "git clone --local" links them)
+        return ['.git/objects/pack', '.git/objects/[0-9a-f][0-9a-f]']
+
     # I can't see any way to do 'get_file_content', but this needs
     # reinvestigating periodically
 
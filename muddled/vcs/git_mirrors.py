@@ -0,0 +1,222 @@
+"""
+Local mirrors of git repositories, to make cloning faster.
+
+If the environment variable MUDDLE_GIT_MIRRORS is set to the name of a
+directory, then muddle keeps a bare "mirror" of each git repository that it
+clones in that directory. The mirror is created (by ``git clone --mirror``)
+the first time it is needed, and thereafter each clone of that repository
+borrows objects from it (``git clone --reference --dissociate``), so that
+only objects that are not yet in the mirror need to be fetched over the
+network.
+
+Mirrors are not updated when they are used - this is done explicitly, with
+"muddle mirror update", which updates all of the mirrors at once.
+
+Because of the ``--dissociate``, a clone copies the objects it borrowed
+before the clone finishes, so it does not depend upon the mirror continuing
+to exist, and mirrors may be deleted (or moved) at any time.
+
+Shared stores
+-------------
+Separately, when a single muddle command ("muddle checkout", "muddle pull"
+or "muddle pull-upstream") needs to fetch from the same repository for more
+than one checkout - for instance, several checkouts on different branches
+of the same repository - it fetches that repository just once, into a
+"shared store" in the build tree's .muddle/git-shared directory. Each
+checkout is then cloned, or fetches, from the shared store, which is a
+local operation. Shared stores are mirrors in exactly the same sense as
+above, but the checkouts copy (or hard link) objects from them, rather than
+borrowing them, so nothing depends on a shared store continuing to exist.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import muddled.utils as utils
+from muddled.utils import GiveUp
+from muddled.withdir import Directory
+
+MIRRORS_ENV_VAR = 'MUDDLE_GIT_MIRRORS'
+
+# The shared stores that have been brought up to date by this muddle
+# command, indexed by repository URL
+_shared_stores = {}
+
+def mirrors_dir():
+    """Return the directory our mirrors are kept in, or None.
+
+    The directory is taken from the environment variable MUDDLE_GIT_MIRRORS.
+    If that is not set (or is empty), we return None, which means that
+    mirrors are not being used.
+    """
+    dir = os.environ.get(MIRRORS_ENV_VAR)
+    if dir:
+        return os.path.abspath(os.path.expanduser(dir))
+    else:
+        return None
+
+def mirror_name(url):
+    """Return the name of the mirror directory for repository 'url'.
+
+    The name is meant to be recognisable, but also unique, so it is made up
+    of a "safe" version of the URL, followed by part of the SHA1 of the URL:
+
+        >>> mirror_name('https://github.com/tibs/muddle.git')
+        'github.com_tibs_muddle-0b3ce416.git'
+        >>> mirror_name('file:///home/tibs/repos/muddle')
+        'home_tibs_repos_muddle-c72d83cb.git'
+    """
+    name = re.sub(r'^[A-Za-z0-9+.-]*://', '', url)
+    name = name.rstrip('/')
+    if name.endswith('.git'):
+        name = name[:-4]
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_')
+    return '%s-%s.git'%(name, hashlib.sha1(url).hexdigest()[:8])
+
+def mirror_path(url, dir=None):
+    """Return the path to the mirror for repository 'url'.
+
+    If 'dir' is not given, use mirrors_dir(), in which case we return
+    None if mirrors are not being used.
+    """
+    if dir is None:
+        dir = mirrors_dir()
+        if dir is None:
+            return None
+    return os.path.join(dir, mirror_name(url))
+
+def is_mirror(path):
+    """Does 'path' look like one of our (bare) mirrors?
+    """
+    return (os.path.isdir(path) and path.endswith('.git') and
+            os.path.exists(os.path.join(path, 'HEAD')) and
+            os.path.isdir(os.path.join(path, 'objects')))
+
+def ensure_mirror(url, verbose=True, dir=None):
+    """Make sure that we have a mirror for repository 'url'.
+
+    If 'dir' is given, the mirror is kept in that directory. Otherwise,
+    if mirrors are not being used, does nothing and returns None.
+
+    Otherwise, creates the mirror if it does not yet exist, and returns its
+    path. If the mirror cannot be created, we print a warning and return
+    None - a mirror is only ever an optimisation.
+    """
+    path = mirror_path(url, dir)
+    if path is None:
+        return None
+    if is_mirror(path):
+        return path
+
+    parent = os.path.dirname(path)
+    utils.ensure_dir(parent, verbose=False)
+    # Clone into a temporary directory first, so that no-one else sees a
+    # partial mirror, and so that if someone else (another muddle) is making
+    # the same mirror at the same time, nothing bad happens
+    tempdir = tempfile.mkdtemp(prefix='.new-', dir=parent)
+    try:
+        temp_path = os.path.join(tempdir, 'mirror.git')
+        try:
+            utils.shell(['git', 'clone', '--mirror', url, temp_path],
+                        show_command=verbose)
+        except GiveUp as e:
+            print 'Unable to create git mirror for %s:\n%s'%(url, utils.indent(str(e), '  '))
+            return None
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Presumably someone else got there first
+            if not is_mirror(path):
+                raise
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    return path
+
+def update_mirror(path, verbose=True):
+    """Update the mirror at 'path' from its remote repository.
+    """
+    with Directory(path, show_pushd=False):
+        utils.shell(['git', 'fetch', '--prune', 'origin'], show_command=verbose)
+
+def all_mirrors(dir=None):
+    """Return a sorted list of the paths of all our mirrors.
+    """
+    if dir is None:
+        dir = mirrors_dir()
+        if dir is None:
+            return []
+    if not os.path.isdir(dir):
+        return []
+    paths = []
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        if is_mirror(path):
+            paths.append(path)
+    return paths
+
+def update_all_mirrors(jobs=1, dir=None):
+    """Update all of our mirrors, up to 'jobs' at a time.
+
+    Returns a list of (path, error text) for any that could not be updated.
+    """
+    paths = all_mirrors(dir)
+
+    def report(result):
+        print
+        print 'Updated %s%s'%(os.path.basename(paths[result.index]),
+                              '' if result.error is None else ' (FAILED)')
+        sys.stdout.write(result.output)
+
+    results = utils.run_in_parallel(update_mirror,
+                                    [(path, True) for path in paths],
+                                    jobs, callback=report)
+    failures = []
+    for result in results:
+        if result.error is not None:
+            failures.append((paths[result.index], result.error))
+    return failures
+
+def fetch_shared_store(url, dir, verbose=True):
+    """Bring the shared store for repository 'url' up to date.
+
+    The shared store is kept in directory 'dir', and is created if it does
+    not yet exist.
+
+    Returns the path to the shared store, or None if it could not be
+    created or updated (in which case we will have printed a warning).
+    """
+    path = mirror_path(url, dir)
+    if not is_mirror(path):
+        return ensure_mirror(url, verbose, dir)
+    try:
+        update_mirror(path, verbose)
+    except GiveUp as e:
+        print 'Unable to update shared store for %s:\n%s'%(url, utils.indent(str(e), '  '))
+        return None
+    return path
+
+def remember_shared_store(url, path):
+    """Remember that 'path' is an up-to-date shared store for 'url'.
+    """
+    _shared_stores[url] = path
+
+def forget_shared_stores():
+    """Forget the shared stores that this muddle command has brought up to date.
+
+    Called at the end of each muddle command, since by the time the next
+    command (in the same process) runs, they may be out of date, or even
+    belong to a different build tree.
+    """
+    _shared_stores.clear()
+
+def shared_store(url):
+    """Return the up-to-date shared store for 'url', or None.
+
+    Only returns a shared store that has been fetched into during this
+    muddle command (see remember_shared_store).
+    """
+    return _shared_stores.get(url)
@@ -0,0 +1,107 @@
+"""
+Looking up git objects and revisions without starting a new git each time.
+
+Asking git what a revision name (such as "HEAD", a branch name or an
+abbreviated SHA1) refers to normally means running "git rev-parse", which
+starts a new git process for each question. Commands such as "muddle stamp"
+ask many such questions, so instead we keep a "git cat-file --batch-check"
+process running for each repository we are interested in, and ask it
+questions over a pipe.
+
+These processes are kept in a pool, and are shut down by close_all(), which
+the muddle command line calls when each command is finished. Since a worker
+process (see utils.run_in_parallel) must not share its parent's pipes, each
+process only ever uses the lookups that it created itself.
+"""
+
+import os
+import subprocess
+
+# Our ObjectLookup instances, indexed by (process id, checkout directory)
+_lookups = {}
+
+class ObjectLookup(object):
+    """
+    A "git cat-file --batch-check" process, answering questions about the
+    objects in the repository for a single checkout directory.
+    """
+
+    def __init__(self, co_dir):
+        self.co_dir = co_dir
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(['git', 'cat-file', '--batch-check'],
+                                            cwd=co_dir, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=devnull)
+
+    def lookup(self, name):
+        """
+        Return (SHA1, type) for the object that 'name' refers to.
+
+        'name' may be anything that "git rev-parse" would understand as a
+        single object name, for instance "HEAD", "origin/master" or an
+        abbreviated SHA1.
+
+        Returns (None, None) if 'name' is missing or ambiguous, or if we
+        cannot talk to git.
+        """
+        if '\n' in name or self.process.poll() is not None:
+            return None, None
+        try:
+            self.process.stdin.write('%s\n'%name)
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError):
+            return None, None
+        words = line.split()
+        # A successful lookup gives "<sha1> <type> <size>", a failure gives
+        # "<name> missing" or "<name> ambiguous"
+        if len(words) == 3 and words[2].isdigit():
+            return words[0], words[1]
+        return None, None
+
+    def close(self):
+        """
+        Tell git we are finished, and wait for it to exit.
+        """
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.process.wait()
+
+def object_lookup(co_dir=None):
+    """
+    Return the ObjectLookup for 'co_dir', starting it if necessary.
+
+    If 'co_dir' is not given, the current directory is used.
+    """
+    if co_dir is None:
+        co_dir = os.getcwd()
+    key = (os.getpid(), os.path.realpath(co_dir))
+    lookup = _lookups.get(key)
+    if lookup is None:
+        lookup = _lookups[key] = ObjectLookup(key[1])
+    return lookup
+
+def rev_parse(name, co_dir=None):
+    """
+    Return the SHA1 of the object 'name' refers to, or None.
+
+    This is the equivalent of "git rev-parse <name>", run in 'co_dir' (or
+    in the current directory, if 'co_dir' is not given), except that it
+    returns None rather than failing. The caller may then choose to run
+    "git rev-parse" after all, to find out what the problem was.
+    """
+    sha1, what = object_lookup(co_dir).lookup(name)
+    return sha1
+
+def close_all():
+    """
+    Close all of the ObjectLookups that this process has started.
+    """
+    pid = os.getpid()
+    for key in sorted(_lookups.keys()):
+        if key[0] == pid:
+            _lookups.pop(key).close()
@@ -29,11 +29,112 @@ Available Subversion specific options are:
     but checkout <co-name> uses VCS Subversion for which we do not support branching.
     The build description should specify a revision for checkout <co-name>.
 
+Finding the status of several Subversion checkouts ("muddle status") asks
+the server about all of the checkouts from the same server at once, with a
+single "svn status --show-updates".
+
+The result of 'svnversion' (used by "muddle stamp") is remembered for each
+checkout, and only worked out again if .svn/wc.db, or what "svn status -q"
+says about the working copy, has changed. Working copies from before
+Subversion 1.7 (which have no .svn/wc.db) are not remembered.
 """
 
-from muddled.version_control import register_vcs, VersionControlSystem
+import hashlib
+import os
+import re
+import urlparse
+
+from muddled.version_control import register_vcs, VersionControlSystem, \
+        metadata_key
+from muddled.withdir import Directory
 import muddled.utils as utils
 
+def _interesting_status(lines):
+    """Return the interesting lines of "svn status --show-updates --verbose".
+
+    Returns them as a single string, or None if there is nothing of interest.
+    """
+    stuff = []
+    seven_spaces = ' '*7
+    for line in lines:
+        # The first 7 characters and the 9th give us our status
+        if line.startswith(seven_spaces) and line[8] == ' ':
+            continue
+        elif line == '':    # typically, a blank final line
+            continue
+        else:
+            stuff.append(line)
+
+    # Was it just reporting that nothing happened in this particular
+    # revision?
+    if len(stuff) == 1 and stuff[0].startswith('Status against revision'):
+        stuff = []
+
+    if stuff:
+        stuff.append('')        # add back a cosmetic blank line
+        return '\n'.join(stuff)
+    else:
+        return None
+
+def split_status(text, dirs):
+    r"""Split the output of "svn status" for several directories.
+
+    'text' is the output of "svn status --show-updates --verbose <dirs>",
+    where 'dirs' are the (absolute) paths of the working copies.
+
+    Returns a list of lists of lines, one for each directory in 'dirs', with
+    the paths in each line made relative to that directory, as if "svn
+    status" had been run within it.
+
+        >>> text = ('M       12       10 tibs         /a/b/fred.c\n'
+        ...         '        12       10 tibs         /a/b\n'
+        ...         'Status against revision:     14\n'
+        ...         '        12       11 tibs         /a/bc\n'
+        ...         'Status against revision:     14\n')
+        >>> for lines in split_status(text, ['/a/b', '/a/bc']):
+        ...     print lines
+        ['M       12       10 tibs         fred.c', '        12       10 tibs         .', 'Status against revision:     14']
+        ['        12       11 tibs         .', 'Status against revision:     14']
+    """
+    # Look for the longest directory first, in case one contains another
+    patterns = []
+    for index, dir in sorted(enumerate(dirs), key=lambda x: len(x[1]), reverse=True):
+        patterns.append((index, re.compile(r"(?<=[ '])%s(/|(?='|$))"%re.escape(dir))))
+
+    results = [[] for dir in dirs]
+    current = None
+    pending = []
+    for line in text.splitlines():
+        for index, pattern in patterns:
+            match = pattern.search(line)
+            if match:
+                if match.group(1):
+                    line = line[:match.start()] + line[match.end():]
+                else:
+                    line = line[:match.start()] + '.' + line[match.end():]
+                current = index
+                results[index].extend(pending)
+                results[index].append(line)
+                pending = []
+                break
+        else:
+            # Lines without a path (such as "Status against revision:")
+            # follow the lines for the directory they belong to, except
+            # for things like changelist headers, which precede them
+            if current is not None and line.startswith('Status against revision'):
+                results[current].append(line)
+            else:
+                pending.append(line)
+    if pending and current is not None:
+        results[current].extend(pending)
+    return results
+
+def _server(url):
+    """Return the part of 'url' that identifies its server.
+    """
+    parts = urlparse.urlsplit(url)
+    return (parts.scheme, parts.netloc)
+
 class Subversion(VersionControlSystem):
     """
     Provide version control operations for Subversion
@@ -168,29 +269,50 @@ class Subversion(VersionControlSystem):
             return "muddle status -quick is not supported on svn checkouts"
 
         text = utils.get_cmd_data("svn status --show-updates --verbose")
+        return _interesting_status(text.split('\n'))
 
-        lines = text.split('\n')
-        stuff = []
-        seven_spaces = ' '*7
-        for line in lines:
-            # The first 7 characters and the 9th give us our status
-            if line.startswith(seven_spaces) and line[8] == ' ':
-                continue
-            elif line == '':    # typically, a blank final line
-                continue
-            else:
-                stuff.append(line)
+    def batches_status(self):
+        return True
 
-        # Was it just reporting that nothing happened in this particular
-        # revision?
-        if len(stuff) == 1 and stuff[0].startswith('Status against revision'):
-            stuff = []
+    def status_of_several(self, checkouts, quick=False):
+        """
+        Return the status of several checkouts.
 
-        if stuff:
-            stuff.append('')        # add back a cosmetic blank line
-            return '\n'.join(stuff)
-        else:
-            return None
+        Runs a single "svn status --show-updates --verbose" for all of the
+        checkouts whose repositories are on the same server, so that we
+        only ask each server once.
+
+        If that fails (for instance, because one of the checkouts is not a
+        working copy), we fall back to asking about each checkout in turn,
+        so that any error is reported for the right checkout.
+        """
+        if quick:
+            return [self.status(repo, options, quick=True)
+                    for co_dir, repo, options in checkouts]
+
+        results = [None]*len(checkouts)
+        servers = {}
+        for index, (co_dir, repo, options) in enumerate(checkouts):
+            servers.setdefault(_server(repo.url), []).append(index)
+
+        for server, indices in sorted(servers.items()):
+            dirs = [checkouts[i][0] for i in indices]
+            text = None
+            if len(indices) > 1:
+                try:
+                    text = utils.get_cmd_data(['svn', 'status', '--show-updates',
+                                               '--verbose'] + dirs)
+                except utils.GiveUp:
+                    pass
+            if text is None:
+                for i in indices:
+                    co_dir, repo, options = checkouts[i]
+                    with Directory(co_dir, show_pushd=False):
+                        results[i] = self.status(repo, options)
+                continue
+            for i, lines in zip(indices, split_status(text, dirs)):
+                results[i] = _interesting_status(lines)
+        return results
 
     def goto_revision(self, revision, branch=None, repo=None, verbose=False):
         """
@@ -242,6 +364,29 @@ class Subversion(VersionControlSystem):
             raise utils.GiveUp("%s: 'svnversion' reports checkout has revision"
                     " '%s'"%(co_leaf, revision))
 
+    def revision_cache_key(self):
+        """
+        Return a key describing the state of the working copy.
+
+        'svnversion' reports local changes as well as the revision(s), so
+        the key is made up of the details of .svn/wc.db (which Subversion
+        changes whenever it changes the working copy) and a digest of the
+        output of "svn status -q", which lists the local changes. Unversioned
+        files (such as anything built in the checkout) make no difference to
+        either, so are not looked at.
+
+        Returns None for a working copy that has no .svn/wc.db (i.e., from
+        before Subversion 1.7), or if "svn status" fails, so that nothing is
+        cached.
+        """
+        wc_db = os.path.join('.svn', 'wc.db')
+        if not os.path.isfile(wc_db):
+            return None
+        retcode, text = utils.run2(['svn', 'status', '-q'], show_command=False)
+        if retcode:
+            return None
+        return metadata_key([wc_db]) + [['status', hashlib.sha1(text).hexdigest()]]
+
     def _just_revno(self):
         """
         This returns the revision number for the working tree
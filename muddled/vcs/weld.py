@@ -11,10 +11,69 @@ The effect is that one can write a build description within a weld and
 
 import os
 import muddled.utils as utils
+from muddled.vcs import git_objects
 from muddled.version_control import register_vcs, VersionControlSystem
 from muddled.withdir import Directory
 from muddled.utils import GiveUp
 
+# The revisions we have already worked out during this muddle command,
+# indexed by (weld directory, revision name). Every checkout in a weld
+# has the same revision, so there is no point in asking git more than once.
+_weld_revisions = {}
+
+def forget_revisions():
+    """
+    Forget the weld revisions we have worked out.
+
+    Called at the end of each muddle command, since the welds may well have
+    changed by the time the next command (in the same process) runs.
+    """
+    _weld_revisions.clear()
+
+def weld_root(dir=None):
+    """
+    Return the top-level directory of the weld containing 'dir'.
+
+    That is, the nearest directory at or above 'dir' (or the current
+    directory, if 'dir' is not given) that contains a ".git" - we look for
+    this ourselves, rather than running "git rev-parse --show-toplevel" for
+    each checkout.
+
+    Returns None if there is no such directory.
+    """
+    if dir is None:
+        dir = os.getcwd()
+    dir = os.path.realpath(dir)
+    while True:
+        if os.path.exists(os.path.join(dir, '.git')):
+            return dir
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+
+def _split_porcelain_status(text):
+    r"""
+    Split the output of "git status --porcelain -z" into (status, path) pairs.
+
+    For a rename or copy, the path is the new name (the old name follows in
+    the output, and is ignored):
+
+        >>> _split_porcelain_status(' M a/b.c\0?? d\0R  new\0old\0')
+        [(' M', 'a/b.c'), ('??', 'd'), ('R ', 'new')]
+    """
+    entries = []
+    words = text.split('\0')
+    while words:
+        word = words.pop(0)
+        if len(word) < 4:
+            continue
+        status, path = word[:2], word[3:]
+        if status[0] in 'RC' and words:
+            words.pop(0)
+        entries.append((status, path))
+    return entries
+
 class Weld(VersionControlSystem):
     """
     Provides version control operations for a weld -
@@ -22,28 +81,92 @@ class Weld(VersionControlSystem):
     what the base class provides, so .. 
 
     Obviously, the checkout revision for every checkout is just the
-    revision-id of the weld itself.
+    revision-id of the weld itself, so we only work it out once per weld
+    (per muddle command). Similarly, the status of all the checkouts in a
+    weld comes from a single "git status" of the weld.
     """
 
     def _calculate_revision(self, co_leaf, orig_revision):
         """
         This returns a bare SHA1 object name for orig_revision
+        """
+        root = weld_root()
+        key = (root, orig_revision)
+        if root and key in _weld_revisions:
+            return _weld_revisions[key]
 
-        NB: if 'before' is specified, 'force' is ignored.
+        revision = None
+        if root:
+            revision = git_objects.rev_parse(orig_revision, root)
+        if not revision:
+            retcode, revision, ignore = utils.run3('git rev-parse %s'%orig_revision,
+                                                   show_command=False)
+            if retcode:
+                if revision:
+                    text = utils.indent(revision.strip(),'    ')
+                    raise GiveUp("%s\n%s"%(utils.wrap("%s: 'git rev-parse HEAD'"
+                                                      " could not determine a revision id for checkout:"%co_leaf),
+                                           text))
+                else:
+                    raise GiveUp("%s\n"%(utils.wrap("%s: 'git rev-parse HEAD'"
+                                                    " could not determine a revision id for checkout:"%co_leaf)))
+            revision = revision.strip()
+
+        if root:
+            _weld_revisions[key] = revision
+        return revision
+
+    def status(self, repo, options, quick=False):
         """
-        retcode, revision, ignore = utils.run3('git rev-parse %s'%orig_revision)
-        if retcode:
-            if revision:
-                text = utils.indent(revision.strip(),'    ')
-                raise GiveUp("%s\n%s"%(utils.wrap("%s: 'git rev-parse HEAD'"
-                                                  " could not determine a revision id for checkout:"%co_leaf),
-                                       text))
+        Will be called in the actual checkout's directory.
+
+        Reports any changes that "git status" finds within this checkout,
+        or None if there are none.
+        """
+        return self.status_of_several([(os.getcwd(), repo, options)], quick)[0]
+
+    def batches_status(self):
+        return True
+
+    def status_of_several(self, checkouts, quick=False):
+        """
+        Return the status of several checkouts.
+
+        We run "git status" once for each weld, and then share out the
+        changes it reports amongst the checkouts in that weld.
+        """
+        changes = {}
+        results = []
+        for co_dir, repo, options in checkouts:
+            root = weld_root(co_dir)
+            if root is None:
+                raise GiveUp('%s is not within a weld (there is no .git'
+                             ' directory above it)'%co_dir)
+            if root not in changes:
+                changes[root] = self._weld_status(root)
+            rel = os.path.relpath(os.path.realpath(co_dir), root)
+            lines = []
+            for status, path in changes[root]:
+                if rel == os.curdir or path == rel or path.startswith(rel + '/'):
+                    lines.append('%s %s'%(status, path))
+            if lines:
+                results.append('\n'.join(lines))
             else:
-                raise GiveUp("%s\n"%(utils.wrap("%s: 'git rev-parse HEAD'"
-                                                " could not determine a revision id for checkout:"%co_leaf)))
-        return revision.strip()
+                results.append(None)
+        return results
+
+    def _weld_status(self, root):
+        """
+        Return the (status, path) pairs for the changes in the weld at 'root'.
+        """
+        with Directory(root, show_pushd=False):
+            retcode, text, errors = utils.run3('git status --porcelain -z',
+                                               show_command=False)
+        if retcode:
+            raise GiveUp("'git status' failed in weld %s:\n%s"%(root,
+                         utils.indent(errors.strip(), '    ')))
+        return _split_porcelain_status(text)
 
-    
     def __init__(self):
         self.short_name = 'weld'
         self.long_name = 'Weld'
@@ -64,9 +187,9 @@ class Weld(VersionControlSystem):
             rr = repo.revision
             if (rr is None):
                 rr = 'HEAD'
-            rev = self._calculate_revision(self, rr)
+            rev = self._calculate_revision(co_leaf, rr)
             # Now get the version we have .. 
-            rev2 = self._calculate_revision(self, 'HEAD')
+            rev2 = self._calculate_revision(co_leaf, 'HEAD')
             if (rev != rev2):
                 raise GiveUp("git repo required for %s is revision (%s) %s, but we have %s"%(co_leaf, repo.revision, rev,rev2))
         else:
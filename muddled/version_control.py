@@ -2,13 +2,17 @@
 Routines which deal with version control.
 """
 
-import re
+import errno
+import hashlib
+import json
 import os
+import re
+import tempfile
 
 import muddled.pkg as pkg
 import muddled.utils as utils
 
-from muddled.depend import Label
+from muddled.depend import Label, label_list_to_string
 from muddled.repository import Repository
 from muddled.utils import split_vcs_url, GiveUp, MuddleBug, Unsupported
 from muddled.db import CheckoutData
@@ -106,6 +110,72 @@ class VersionControlSystem(object):
         """
         pass
 
+    def batches_status(self):
+        """
+        Can this VCS find the status of several checkouts more cheaply at once?
+
+        If it can, it should override status_of_several() as well.
+
+        The default is False.
+        """
+        return False
+
+    def status_of_several(self, checkouts, quick=False):
+        """
+        Return the status of several checkouts.
+
+        'checkouts' is a list of (co_dir, repo, options) tuples, where 'co_dir'
+        is the absolute path of the checkout's directory.
+
+        Returns a list of status texts (or None), one for each checkout,
+        in the same order, exactly as status() would return them.
+
+        The default is to call status() in each checkout's directory in turn.
+        """
+        results = []
+        for co_dir, repo, options in checkouts:
+            with Directory(co_dir, show_pushd=False):
+                results.append(self.status(repo, options, quick=quick))
+        return results
+
+    def prefetch_command(self, repo, options):
+        """
+        Return a command that fetches changes for a later pull, or None.
+
+        Will be called in the actual checkout's directory.
+
+        "muddle pull" runs this command in the background, for several
+        checkouts at once, whilst it works through the pulls one by one.
+        The command must only retrieve changes from the remote repository
+        into the local repository - it must not change the working tree
+        (or anything else the user can see), and must be safe to run at the
+        same time as a pull of a different checkout.
+
+        If the command succeeds, prefetched() is called before pull(), so
+        that pull() need not fetch again.
+
+        The default is None, meaning that this VCS does not prefetch.
+        """
+        return None
+
+    def prefetched(self, repo, options, output):
+        """
+        Note that the prefetch_command() succeeded, with the given output.
+
+        Will be called in the actual checkout's directory, just before pull().
+        """
+        pass
+
+    def forget_prefetched(self):
+        """
+        Forget any prefetches noted by prefetched() that pull() has not used.
+
+        A pull may fail before it gets as far as using its prefetch, and we
+        don't want a later pull (in the same process) to trust a prefetch
+        that may be out of date by then. See forget_prefetches().
+        """
+        pass
+
     def reparent(self, co_leaf, remote_repo, options, force=False, verbose=True):
         """
         Will be called in the actual checkout's directory.
@@ -209,6 +279,59 @@ class VersionControlSystem(object):
         raise utils.Unsupported("VCS '%s' cannot goto a different branch"
                                 " of a checkout"%self.long_name)
 
+    def list_branches(self):
+        """
+        Return a list of the names of the branches that exist.
+
+        As with branch_exists(), this may include the names of remote
+        branches.
+
+        Will be called in the actual checkout's directory.
+
+        Raises Unsupported if the VCS does not support this operation.
+        """
+        raise utils.Unsupported("VCS '%s' cannot list the branches"
+                                " of a checkout"%self.long_name)
+
+    def revision_cache_key(self):
+        """
+        Return a key describing the state of the checkout's VCS metadata.
+
+        Will be called in the actual checkout's directory.
+
+        The key is a list of (path, mtime, inode, size) tuples for the
+        metadata files and directories that change when the current revision
+        or branch, or the set of branches, changes. If the key is the same as
+        it was when we last calculated the current revision (or branch, or
+        list of branches), then we may reuse the value we calculated then,
+        without asking the VCS again. See RevisionCache.
+
+        Returns None if this VCS cannot provide such a key, in which case
+        nothing is cached. This is the default. A VCS that does provide a key
+        and supports branching must also support list_branches().
+        """
+        return None
+
+    def source_fingerprint(self):
+        """
+        Return a string identifying the current content of the checkout.
+
+        Will be called in the actual checkout's directory.
+
+        The fingerprint must change whenever the files in the checkout do,
+        and must be calculated without talking to any remote repository,
+        since it is used (by "muddle query changed-since-build") to decide
+        which packages need rebuilding.
+
+        The default is a digest of the names, sizes and modification times
+        of the files in the checkout (see working_tree_digest), ignoring the
+        VCS's own metadata directory. A VCS that can name the content of its
+        working tree more cheaply (for instance, git's tree ids) may
+        override this.
+        """
+        special = self.get_vcs_special_files()
+        return 'stat:%s'%working_tree_digest('.', special[0] if special else None)
+
     def allows_relative_in_repo(self):
         """
         Does this VCS allow relative locations within the repository to be checked out?
@@ -247,6 +370,155 @@ class VersionControlSystem(object):
         """
         return []
 
+    def get_vcs_immutable_dirs(self):
+        """
+        Return glob patterns for the directories whose files this VCS never
+        alters once they are written.
+
+        The patterns are relative to the checkout directory - for instance,
+        for git we might return [".git/objects/pack"]. When a checkout is
+        copied with its VCS files, the files in such directories may be hard
+        linked to the originals, rather than copied.
+
+        Returns an empty list if there are no such directories.
+        """
+        return []
+
+
+def metadata_key(paths):
+    """
+    Return a revision cache key for the files and directories in 'paths'.
+
+    The key is a list of [path, mtime, inode, size] for each path, in order.
+    A path that does not exist is recorded with None for each of its details.
+    """
+    key = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key.append([path, st.st_mtime, st.st_ino, st.st_size])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            key.append([path, None, None, None])
+    return key
+
+def working_tree_digest(dir, ignore):
+    """
+    Return a digest of the names, sizes and times of the files under 'dir'.
+
+    Directories called 'ignore' (typically the VCS's own metadata directory)
+    are not looked in. The digest changes if any file or directory is added,
+    removed, resized or touched, so it can be used as part of a revision
+    cache key by a VCS whose idea of the current revision includes whether
+    there are local changes.
+    """
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(dir):
+        if ignore in dirnames:
+            dirnames.remove(ignore)
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            digest.update('%s\0%r\0%d\0'%(path, st.st_mtime, st.st_size))
+    return digest.hexdigest()
+
+def paths_digest(paths):
+    """
+    Return a digest of the names, sizes and times of the files in 'paths'.
+
+    This is like working_tree_digest, but only looks at the paths it is
+    given (typically the files a VCS reports as changed), rather than
+    everything in the checkout. A path that does not exist is recorded as
+    such, so that deleting a file also changes the digest.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            st = os.lstat(path)
+            digest.update('%s\0%r\0%d\0'%(path, st.st_mtime, st.st_size))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            digest.update('%s\0-\0'%path)
+    return digest.hexdigest()
+
+def _str_from_json(value):
+    """JSON gives us back unicode strings, but the rest of muddle wants str.
+    """
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, list):
+        return [_str_from_json(x) for x in value]
+    else:
+        return value
+
+class RevisionCache(object):
+    """
+    Our memory of the revision, branch and branches of a checkout.
+
+    Finding out the current revision or branch of a checkout means asking
+    the VCS, which is (relatively) slow, and commands like "muddle stamp"
+    and "muddle branch-tree" ask for such information many times over.
+    So we remember the answers in a file in the .muddle directory, along
+    with a key (see VersionControlSystem.revision_cache_key) describing the
+    state of the VCS metadata at the time. If the key has changed, the
+    remembered values are discarded.
+
+    Note that the key must be calculated *before* asking the VCS for
+    anything, so that any change made whilst we are asking is noticed
+    next time round.
+    """
+
+    def __init__(self, file_name, key):
+        self.file_name = file_name
+        self.key = key
+        self.values = self._read()
+
+    def _read(self):
+        try:
+            with open(self.file_name) as fd:
+                data = json.load(fd)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        except ValueError:
+            # A damaged cache is just an empty cache
+            return {}
+        if not isinstance(data, dict) or data.get('key') != self.key:
+            return {}
+        return dict((str(k), _str_from_json(v))
+                    for k, v in data.get('values', {}).items())
+
+    def _write(self):
+        # Other muddle processes may be reading (or writing) the same file,
+        # so write a temporary file and rename it into place
+        dir = os.path.dirname(self.file_name)
+        utils.ensure_dir(dir, verbose=False)
+        fd, temp_name = tempfile.mkstemp(prefix='.new-', dir=dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': self.key, 'values': self.values}, f)
+            os.rename(temp_name, self.file_name)
+        except:
+            os.remove(temp_name)
+            raise
+
+    def get(self, name, calculate):
+        """
+        Return the value called 'name', calling 'calculate' to work it out.
+
+        'calculate' is only called if we do not already have a value
+        for 'name'. Its result is remembered for next time.
+        """
+        if name in self.values:
+            return self.values[name]
+        value = calculate()
+        self.values[name] = value
+        self._write()
+        return value
 
 class VersionControlHandler(object):
     """
@@ -356,8 +628,9 @@ class VersionControlHandler(object):
                          '  %s does not allow "pull"'%(co_label, parent_dir, repo))
 
         # Be careful - if the parent is 'src/', then it may well exist by now
-        if not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
+        # (and if we are one of several checkouts being done in parallel,
+        # someone else may be making it as we look)
+        utils.ensure_dir(parent_dir, verbose=False)
 
         specific_branch = self.branch_to_follow(builder, co_label)
         if specific_branch:
@@ -571,6 +844,60 @@ class VersionControlHandler(object):
             raise GiveUp('Failure finding status for %s in %s:\n%s'%(co_label,
                          builder.db.get_checkout_location(co_label), err))
 
+    def status_of_several(self, builder, co_labels, quick=False):
+        """
+        Report on the status of several checkouts, all using this VCS.
+
+        Returns a list containing, for each checkout in 'co_labels', what
+        status() would have returned for it.
+
+        This is only worth doing if our VCS batches_status(), in which case
+        it may (for instance) ask a remote server about all of the checkouts
+        at once.
+        """
+        checkouts = []
+        for co_label in co_labels:
+            checkouts.append((builder.db.get_checkout_path(co_label),
+                              builder.db.get_checkout_repo(co_label),
+                              builder.db.get_checkout_vcs_options(co_label)))
+        try:
+            texts = self.vcs.status_of_several(checkouts, quick=quick)
+        except GiveUp as err:
+            raise GiveUp('Failure finding status for %s:\n%s'%(
+                         label_list_to_string(co_labels, join_with=', '), err))
+        results = []
+        for co_label, status_text in zip(co_labels, texts):
+            if status_text:
+                results.append('%s status for %s in %s:\n%s'%(self.vcs.short_name,
+                               co_label,
+                               builder.db.get_checkout_location(co_label),
+                               status_text))
+            else:
+                results.append(None)
+        return results
+
+    def prefetch_command(self, builder, co_label):
+        """
+        Return a command to fetch changes for this checkout, or None.
+
+        See the VersionControlSystem method of the same name.
+        """
+        repo = builder.db.get_checkout_repo(co_label)
+        if not repo.pull:
+            return None
+        options = builder.db.get_checkout_vcs_options(co_label)
+        with Directory(builder.db.get_checkout_path(co_label), show_pushd=False):
+            return self.vcs.prefetch_command(repo, options)
+
+    def prefetched(self, builder, co_label, output):
+        """
+        Note that the prefetch_command() for this checkout succeeded.
+        """
+        repo = builder.db.get_checkout_repo(co_label)
+        options = builder.db.get_checkout_vcs_options(co_label)
+        with Directory(builder.db.get_checkout_path(co_label), show_pushd=False):
+            self.vcs.prefetched(repo, options, output)
+
     def reparent(self, builder, co_label, force=False, verbose=True):
         """
         Re-associate the local repository with its original remote repository,
@@ -633,8 +960,47 @@ class VersionControlHandler(object):
         repo = builder.db.get_checkout_repo(co_label)
         options = builder.db.get_checkout_vcs_options(co_label)
         with Directory(co_dir, show_pushd=show_pushd):
-            return self.vcs.revision_to_checkout(repo, co_leaf, options,
-                                                 force, before, verbose)
+            def calculate():
+                return self.vcs.revision_to_checkout(repo, co_leaf, options,
+                                                     force, before, verbose)
+            cache = None if before else self._revision_cache(builder, co_label)
+            if cache is None:
+                return calculate()
+            elif force and 'revision' not in cache.values:
+                # If the VCS could not work out the revision, 'force' may
+                # have made it return the original revision instead, and we
+                # don't want to remember that
+                return calculate()
+            else:
+                return cache.get('revision', calculate)
+
+    def _revision_cache(self, builder, co_label):
+        """
+        Return a RevisionCache for this checkout, or None.
+
+        Will be called in the actual checkout's directory.
+
+        Returns None if the VCS does not support caching revision information.
+        """
+        key = self.vcs.revision_cache_key()
+        if key is None:
+            return None
+        return RevisionCache(builder.db.revision_cache_file_name(co_label), key)
+
+    def source_fingerprint(self, builder, co_label, show_pushd=False):
+        """
+        Return a string identifying the current content of this checkout.
+
+        Returns None if the checkout has not been checked out.
+
+        No remote repository is consulted. See the VersionControlSystem
+        method of the same name for more information.
+        """
+        co_dir = builder.db.get_checkout_path(co_label)
+        if not os.path.isdir(co_dir):
+            return None
+        with Directory(co_dir, show_pushd=show_pushd):
+            return self.vcs.source_fingerprint()
 
     def get_current_branch(self, builder, co_label, verbose=False, show_pushd=False):
         """
@@ -653,7 +1019,11 @@ class VersionControlHandler(object):
         """
         try:
             with Directory(builder.db.get_checkout_path(co_label), show_pushd=show_pushd):
-                return self.vcs.get_current_branch()
+                cache = self._revision_cache(builder, co_label)
+                if cache is None:
+                    return self.vcs.get_current_branch()
+                else:
+                    return cache.get('branch', self.vcs.get_current_branch)
         except (GiveUp, Unsupported) as err:
             raise GiveUp('Failure getting current branch for %s in %s:\n%s'%(co_label,
                          builder.db.get_checkout_location(co_label), err))
@@ -727,7 +1097,11 @@ class VersionControlHandler(object):
         """
         try:
             with Directory(builder.db.get_checkout_path(co_label), show_pushd=show_pushd):
-                return self.vcs.branch_exists(branch)
+                cache = self._revision_cache(builder, co_label)
+                if cache is None:
+                    return self.vcs.branch_exists(branch)
+                else:
+                    return branch in cache.get('branches', self.vcs.list_branches)
         except (GiveUp, Unsupported) as err:
             raise GiveUp('Failure checking existence of branch %s for %s in %s:\n%s'%(branch,
                          co_label, builder.db.get_checkout_location(co_label), err))
@@ -894,6 +1268,13 @@ def register_vcs(scheme, vcs_instance, docs=None, options=None):
     vcs_dict[scheme] = vcs_instance
     vcs_docs[scheme] = docs
 
+def forget_prefetches():
+    """
+    Tell every version control system to forget its unused prefetches.
+    """
+    for vcs in vcs_dict.values():
+        vcs.forget_prefetched()
+
 def list_registered(indent=''):
     """
     Return a list of registered version control systems.
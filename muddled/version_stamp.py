@@ -221,8 +221,8 @@ from StringIO import StringIO
 from muddled.depend import Label
 from muddled.repository import Repository
 from muddled.utils import MuddleSortedDict, MuddleOrderedDict, \
-        HashFile, GiveUp, truncate, LabelType, LabelTag, split_vcs_url, \
-        sort_domains
+        HashFile, GiveUp, MuddleBug, truncate, LabelType, LabelTag, \
+        split_vcs_url, sort_domains, run_in_parallel
 
 CheckoutTupleV1 = namedtuple('CheckoutTupleV1', 'name repo rev rel dir domain co_leaf branch')
 
@@ -281,6 +281,45 @@ def make_RawConfigParser(ordered=False, sorted=False):
     config.optionxform = str
     return config
 
+def _checkout_revision_and_branch(builder, label, vcs_handler, force,
+                                  just_use_head, before, quiet):
+    """Work out the revision, and any branch, to put in a stamp for 'label'.
+
+    Returns a tuple (revision, branch), where 'branch' is None if the
+    stamp does not need to specify a branch.
+
+    This may be run in a worker process (see utils.run_in_parallel).
+    """
+    if not quiet:
+        print "Processing %s checkout '%s'"%(vcs_handler.short_name,
+                                     '(%s)%s'%(label.domain,label.name)
+                                               if label.domain
+                                               else label.name)
+
+    # We always want to specify the revision in the stamp file
+    if just_use_head:
+        if not quiet:
+            print 'Forcing head'
+        rev = "HEAD"
+    else:
+        rev = vcs_handler.revision_to_checkout(builder, label, force=force,
+                                               before=before, verbose=True)
+
+    # We may also want to specify the branch
+    branch = None
+    if vcs_handler.vcs.supports_branching():
+        current_branch = vcs_handler.get_current_branch(builder, label)
+        # If the Repository doesn't ask for a particular branch,
+        # then we normally assume it means "master".
+        orig_branch = builder.db.get_checkout_repo(label).branch
+        if orig_branch is None:
+            orig_branch = 'master'
+
+        if current_branch != orig_branch:
+            branch = current_branch
+
+    return rev, branch
+
 class VersionStamp(object):
     """A representation of the revision state of a build tree's checkouts.
 
@@ -581,7 +620,8 @@ class VersionStamp(object):
                                 truncate(str(item), columns=truncate)))
 
     @staticmethod
-    def _from_builder(stamp, builder, force=False, just_use_head=False, before=None, quiet=False):
+    def _from_builder(stamp, builder, force=False, just_use_head=False,
+                      before=None, quiet=False, jobs=1):
         """The internal mechanisms of the 'from_builder' static method.
         """
         stamp.repository = builder.db.RootRepository_pathfile.get()
@@ -609,6 +649,8 @@ class VersionStamp(object):
             print 'found %d'%len(checkout_rules)
 
         checkout_rules.sort()
+        # First, the quick things we can do for each checkout
+        to_resolve = []
         for rule in checkout_rules:
             try:
                 label = rule.target
@@ -619,39 +661,37 @@ class VersionStamp(object):
                     if not quiet:
                         print stamp.problems[-1]
                     continue
-                if not quiet:
-                    print "Processing %s checkout '%s'"%(vcs_handler.short_name,
-                                                 '(%s)%s'%(label.domain,label.name)
-                                                           if label.domain
-                                                           else label.name)
                 if label.domain:
                     domain_name = label.domain
                     domain_repo, domain_desc = builder.db.get_subdomain_info(domain_name)
                     stamp.domains[domain_name] = (domain_repo, domain_desc)
+                to_resolve.append((builder, label, vcs_handler, force,
+                                   just_use_head, before, quiet))
+            except GiveUp as exc:
+                print exc
+                stamp.problems.append(str(exc))
 
-                # We always want to specify the revision in the stamp file
-                if just_use_head:
-                    if not quiet:
-                        print 'Forcing head'
-                    rev = "HEAD"
-                else:
-                    rev = vcs_handler.revision_to_checkout(builder, label, force=force,
-                                                           before=before, verbose=True)
-
-                # We may also want to specify the branch
-                branch = None
+        # Then ask the VCS for each checkout's revision (and branch). This
+        # means running (possibly slow) VCS commands, so we do as many at
+        # once as we are allowed
+        results = run_in_parallel(_checkout_revision_and_branch,
+                                  to_resolve, jobs)
+
+        for result in results:
+            label = to_resolve[result.index][1]
+            sys.stdout.write(result.output)
+            if result.error is not None:
+                if not result.gave_up:
+                    # Something unexpected went wrong, which is not just
+                    # a problem with this checkout
+                    raise MuddleBug('Error finding the revision of %s:\n%s'%(
+                                    label, result.error))
+                print result.error
+                stamp.problems.append(result.error)
+                continue
+            rev, branch = result.value
+            try:
                 repo = builder.db.get_checkout_repo(label)
-                if vcs_handler.vcs.supports_branching():
-                    current_branch = vcs_handler.get_current_branch(builder, label)
-                    # If the Repository doesn't ask for a particular branch,
-                    # then we normally assume it means "master".
-                    orig_branch = repo.branch
-                    if orig_branch is None:
-                        orig_branch = 'master'
-
-                    if current_branch != orig_branch:
-                        branch = current_branch
-
                 if branch:
                     repo = repo.copy_with_changed_branch(branch, rev)
                 else:
@@ -689,7 +729,8 @@ class VersionStamp(object):
                 stamp.problems.append('Unable to work out revision ids for all the checkouts')
 
     @staticmethod
-    def from_builder(builder, force=False, just_use_head=False, before=None, quiet=False):
+    def from_builder(builder, force=False, just_use_head=False, before=None,
+                     quiet=False, jobs=1):
         """Construct a VersionStamp from a muddle build description.
 
         'builder' is the muddle Builder for our build description.
@@ -721,6 +762,10 @@ class VersionStamp(object):
         If 'quiet' is True, then we will not print information about what
         we are doing, and we will not print out problems as they are found.
 
+        The revision ids (and branches) of up to 'jobs' checkouts are worked
+        out at the same time, each in its own process. By default, they are
+        worked out one at a time.
+
         Returns a tuple of:
 
             * the new VersionStamp instance
@@ -734,7 +779,8 @@ class VersionStamp(object):
                                    force=force,
                                    just_use_head=just_use_head,
                                    before=before,
-                                   quiet=quiet)
+                                   quiet=quiet,
+                                   jobs=jobs)
 
         return stamp, stamp.problems
 
@@ -1142,7 +1188,7 @@ class ReleaseStamp(VersionStamp):
         self.release_spec = ReleaseSpec()
 
     @staticmethod
-    def from_builder(builder, quiet=False):
+    def from_builder(builder, quiet=False, jobs=1):
         """Construct a ReleaseStamp from a muddle build description.
 
         'builder' is the muddle Builder for our build description.
@@ -1150,6 +1196,9 @@ class ReleaseStamp(VersionStamp):
         If 'quiet' is True, then we will not print information about what
         we are doing, and we will not print out problems as they are found.
 
+        The revision ids (and branches) of up to 'jobs' checkouts are worked
+        out at the same time, as for VersionStamp.from_builder().
+
         Returns a tuple of:
 
             * the new ReleaseStamp instance
@@ -1162,7 +1211,7 @@ class ReleaseStamp(VersionStamp):
 
         VersionStamp._from_builder(stamp, builder,
                                    force=False, just_use_head=False, before=None,
-                                   quiet=quiet)
+                                   quiet=quiet, jobs=jobs)
 
         # and then add in release information
         stamp.release_spec = builder.release_spec
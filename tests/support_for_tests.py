@@ -290,7 +290,7 @@ def check_nosuch_files(paths, verbose=True):
             raise GiveUp('File %s exists'%name)
         else:
             if verbose:
-                sys.sydout.write('  -- %s\n'%name)
+                sys.stdout.write('  -- %s\n'%name)
     if verbose:
         flushing_print('++ All named files do not exist\n')
 
@@ -4,11 +4,14 @@ Tests the rest of muddled.
 """
 
 import os
+import shutil
 import sys
 import subprocess
+import tempfile
+import time
 import traceback
 
-from support_for_tests import get_parent_dir
+from support_for_tests import get_parent_dir, muddle, captured_muddle
 
 try:
     import muddled.cmdline
@@ -28,6 +31,7 @@ import muddled.subst as subst
 import muddled.cpiofile as cpiofile
 
 from muddled.depend import Label
+from muddled.withdir import Directory
 
 def cpio_unit_test():
     """
@@ -278,6 +282,79 @@ def utils_unit_test():
     assert s == "/d/e"
 
 
+def ssh_sharing_unit_test():
+    """
+    Test when sharing_ssh_connections() sets GIT_SSH_COMMAND and SVN_SSH.
+    """
+    saved = {}
+    for name in ('HOME', 'GIT_SSH', 'GIT_SSH_COMMAND', 'SVN_SSH',
+                 'GIT_CONFIG_NOSYSTEM'):
+        saved[name] = os.environ.pop(name, None)
+    home = tempfile.mkdtemp()
+    try:
+        # Use an empty global git configuration
+        os.environ['HOME'] = home
+        os.environ['GIT_CONFIG_NOSYSTEM'] = '1'
+        with Directory(home, show_pushd=False):
+            with utils.sharing_ssh_connections():
+                assert 'ControlMaster' in os.environ['GIT_SSH_COMMAND']
+                assert 'ControlMaster' in os.environ['SVN_SSH']
+            assert 'GIT_SSH_COMMAND' not in os.environ
+            assert 'SVN_SSH' not in os.environ
+
+            # The user's own choice of ssh command is left alone
+            with open(os.path.join(home, '.gitconfig'), 'w') as fd:
+                fd.write('[core]\n\tsshCommand = ssh -i my_key\n')
+            with utils.sharing_ssh_connections():
+                assert 'GIT_SSH_COMMAND' not in os.environ
+                assert 'ControlMaster' in os.environ['SVN_SSH']
+
+            os.environ['SVN_SSH'] = 'my_ssh'
+            with utils.sharing_ssh_connections():
+                assert os.environ['SVN_SSH'] == 'my_ssh'
+    finally:
+        shutil.rmtree(home)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def _process_gone(pid):
+    """
+    Is process 'pid' gone (or a zombie waiting for its parent to notice)?
+    """
+    try:
+        with open('/proc/%d/stat'%pid) as fd:
+            return fd.read().split(') ')[1].startswith('Z')
+    except IOError:
+        return True
+
+def background_commands_unit_test():
+    """
+    Closing BackgroundCommands stops whatever its commands have started.
+    """
+    tmpd = tempfile.mkdtemp()
+    try:
+        pidfile = os.path.join(tmpd, 'pid')
+        with utils.BackgroundCommands(2) as background:
+            background.add('quick', ['echo', 'Hello'], tmpd)
+            background.add('slow', ['sh', '-c', 'sleep 60 & echo $! > %s; wait'%pidfile],
+                           tmpd)
+            assert background.wait_for('quick') == (0, 'Hello\n')
+            for count in range(100):
+                if os.path.exists(pidfile) and open(pidfile).read().strip():
+                    break
+                time.sleep(0.05)
+            pid = int(open(pidfile).read())
+        for count in range(100):
+            if _process_gone(pid):
+                break
+            time.sleep(0.05)
+        assert _process_gone(pid)
+    finally:
+        shutil.rmtree(tmpd)
+
 def vcs_unit_test():
     """
     Perform VCS unit tests.
@@ -445,6 +522,118 @@ def label_domain_sort():
              " checkout:(subdomain2(subdomain4))second_co/checked_out"
             )
 
+def domain_scope_unit_test():
+    """
+    Labels adopted by a domain scope move into its domain when it is included.
+    """
+    inner = depend.DomainScope()
+    label = Label.from_string('checkout:co/checked_out')
+    deeper = Label.from_string('package:(deeper)pkg{x86}/built')
+    inner.adopt([label, deeper, label])
+    assert isinstance(label, depend.ScopedLabel)
+    # Until the scope is included, the domains are unchanged
+    assert str(label) == 'checkout:co/checked_out'
+    inner.include('sub')
+
+    # Copies keep their original label's scope, unless given a new domain
+    copied = label.copy_with_tag('pulled')
+    moved = label.copy_with_domain('elsewhere')
+    assert not isinstance(moved, depend.ScopedLabel)
+
+    # Labels not adopted are not affected
+    plain = Label.from_string('checkout:co/checked_out')
+    assert not isinstance(plain, depend.ScopedLabel)
+
+    assert str(label) == 'checkout:(sub)co/checked_out'
+    assert str(deeper) == 'package:(sub(deeper))pkg{x86}/built'
+    assert str(moved) == 'checkout:(elsewhere)co/checked_out'
+    assert str(copied) == 'checkout:(sub)co/pulled'
+    assert label != plain
+    assert hash(label) == hash(plain)   # since the domain is not hashed
+
+    # An unrelated scope does not affect our labels
+    other = depend.DomainScope()
+    other_label = Label('checkout', 'other_co', tag='checked_out', scope=other)
+    other.include('other')
+    assert str(other_label) == 'checkout:(other)other_co/checked_out'
+    assert label._stamp == inner.generation
+
+    # Including the build that included us, places our scope inside its own,
+    # without changing our labels again
+    top = depend.DomainScope()
+    outer_label = Label.from_string('checkout:outer_co/checked_out')
+    rules = set([label])
+    top.adopt([outer_label, label, copied])
+    assert label._scope is inner
+    assert inner.parent is top
+    top.include('top')
+
+    assert str(outer_label) == 'checkout:(top)outer_co/checked_out'
+    assert str(label) == 'checkout:(top(sub))co/checked_out'
+    assert str(deeper) == 'package:(top(sub(deeper)))pkg{x86}/built'
+    assert str(copied) == 'checkout:(top(sub))co/pulled'
+    assert str(other_label) == 'checkout:(other)other_co/checked_out'
+    # Lookups by label still work after the domain has changed
+    assert Label.from_string('checkout:(top(sub))co/checked_out') in rules
+    assert plain not in rules
+
+def unify_all_unit_test():
+    """
+    Unifying several pairs at once is the same as unifying them in turn.
+    """
+    def make_rules():
+        rs = depend.RuleSet()
+        for name in ('a', 'b', 'c', 'd'):
+            co = Label.from_string('checkout:%s/checked_out'%name)
+            rs.add(depend.Rule(co, pkg.NoAction()))
+            pk = Label.from_string('package:%s{x86}/built'%name)
+            rule = depend.Rule(pk, pkg.NoAction())
+            rule.add(co)
+            rs.add(rule)
+        return rs
+
+    pairs = [(Label.from_string('checkout:a/checked_out'),
+              Label.from_string('checkout:b/checked_out')),
+             (Label.from_string('checkout:b/checked_out'),
+              Label.from_string('checkout:c/checked_out')),
+             (Label.from_string('package:d{x86}/built'),
+              Label.from_string('package:c{x86}/built'))]
+
+    one_by_one = make_rules()
+    for source, target in pairs:
+        one_by_one.unify(source, target)
+
+    all_at_once = make_rules()
+    all_at_once.unify_all(pairs)
+
+    assert str(all_at_once) == str(one_by_one)
+    targets = sorted(str(label) for label in all_at_once.map.keys())
+    assert targets == ['checkout:c/checked_out',
+                       'checkout:d/checked_out',
+                       'package:a{x86}/built',
+                       'package:b{x86}/built',
+                       'package:c{x86}/built']
+    for label in ('package:a{x86}/built', 'package:b{x86}/built'):
+        rule = all_at_once.map[Label.from_string(label)]
+        assert rule.deps == set([Label.from_string('checkout:c/checked_out')])
+
+def profile_test():
+    """
+    "muddle --profile" reports the time spent in each phase of the command.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        with Directory(root, show_pushd=False):
+            muddle(['bootstrap', 'git+file:///nowhere', 'test_build'])
+            text = captured_muddle(['--profile', 'query', 'root'])
+    finally:
+        shutil.rmtree(root)
+
+    table = text[text.index('Time spent in each phase:'):].split('\n')
+    phases = [line.split('  ')[1].strip() for line in table[1:] if line.strip()]
+    assert phases == ['root discovery', 'build description load',
+                      'planning and execution', '(elsewhere)', 'Total'], phases
+
 def run_tests():
     print "> cpio"
     cpio_unit_test()
@@ -458,10 +647,20 @@ def run_tests():
     filespec_unit_test()
     print "> VCS"
     vcs_unit_test()
+    print "> Background commands"
+    background_commands_unit_test()
+    print "> ssh sharing"
+    ssh_sharing_unit_test()
     print "> Depends"
     depend_unit_test()
+    print "> Domain scopes"
+    domain_scope_unit_test()
+    print "> Unify all"
+    unify_all_unit_test()
     print "> Label domain sort"
     label_domain_sort()
+    print "> Profile"
+    profile_test()
 
 if __name__ == '__main__':
     try:
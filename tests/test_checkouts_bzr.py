@@ -370,6 +370,46 @@ def test_just_pulled():
         if not same_content(_just_pulled_file, ''):
             raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
 
+def test_revision_cache():
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_bzr_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_A') as d:
+        muddle(['init', 'bzr+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        cache_file = os.path.join(d.where, '.muddle', 'revisions', 'checkout1')
+
+        banner('Revision cache is created')
+        check_nosuch_files([cache_file])
+        revision = captured_muddle(['query', 'checkout-id', 'checkout1']).strip()
+        check_files([cache_file])
+
+        banner('Revision cache is used when nothing has changed')
+        with open(cache_file) as fd:
+            cached = fd.read()
+        with open(cache_file, 'w') as fd:
+            fd.write(cached.replace(revision, 'not-really-a-revision'))
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != 'not-really-a-revision':
+            raise GiveUp('Expected cached checkout-id, got %s'%text.strip())
+
+        banner('Revision cache is discarded when the working tree changes')
+        append('src/checkout1/Makefile.muddle', '# Just a comment\n')
+        rc, text = captured_muddle2(['query', 'checkout-id', 'checkout1'])
+        if rc == 0:
+            raise GiveUp('Expected checkout-id of a changed checkout to fail:\n%s'%text)
+
+        banner('Revision cache is discarded when the branch changes')
+        with Directory('src/checkout1'):
+            bzr('commit -m "A simple change"')
+            bzr('push')
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() in (revision, 'not-really-a-revision'):
+            raise GiveUp('Expected a new checkout-id, got %s'%text.strip())
+
 def main(args):
 
     keep = False
@@ -401,6 +441,10 @@ def main(args):
             banner('TEST _JUST_PULLED')
             test_just_pulled()
 
+        with NewDirectory('revision_cache'):
+            banner('TEST REVISION CACHE')
+            test_revision_cache()
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     try:
@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+"""Test checkout support for "file:" checkouts.
+
+    $ ./test_checkouts_file.py [-keep]
+
+With -keep, do not delete the 'transient' directory used for the tests.
+"""
+
+import os
+import sys
+import time
+import traceback
+
+from support_for_tests import *
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.utils import GiveUp, normalise_dir
+from muddled.withdir import Directory, NewDirectory, TransientDirectory
+
+BUILD_DESC = """ \
+# Two "file:" checkouts, one of which compares file content when pulling
+
+import muddled.checkouts.simple
+import muddled.pkg as pkg
+from muddled.depend import checkout
+
+def describe_to(builder):
+    builder.build_name = 'file_test'
+    muddled.checkouts.simple.relative(builder, co_name='vendor')
+    muddled.checkouts.simple.relative(builder, co_name='regenerated')
+    pkg.set_checkout_vcs_option(builder, checkout('regenerated'),
+                                compare_content=True)
+"""
+
+def make_repositories():
+    """Make our "remote" directories, and put something in them.
+    """
+    with NewDirectory('repo'):
+        with NewDirectory('builds'):
+            touch('01.py', BUILD_DESC)
+        for name in ('vendor', 'regenerated'):
+            with NewDirectory(name):
+                touch('a.txt', 'Apple\n')
+                with NewDirectory('sub'):
+                    touch('b.txt', 'Banana\n')
+                    touch('old.txt', 'Old\n')
+
+def check_just_pulled(expected):
+    text = open(os.path.join('.muddle', '_just_pulled')).read()
+    if text.split() != expected:
+        raise GiveUp('Expected _just_pulled to contain %s, got:\n%s'%(expected, text))
+
+def make_older(path):
+    """Make 'path' look two seconds older, so that a later change is noticed.
+    """
+    t = os.stat(path).st_mtime - 2
+    os.utime(path, (t, t))
+
+def test_file_pulls(root_dir):
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    make_repositories()
+
+    with NewDirectory('build'):
+        banner('Checking out')
+        muddle(['init', 'file+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_files(['src/vendor/a.txt', 'src/vendor/sub/b.txt',
+                     'src/vendor/sub/old.txt', 'src/regenerated/a.txt'])
+
+        banner('Pulling when nothing has changed')
+        muddle(['pull', '_all'])
+        check_just_pulled([])
+        check_files(['src/builds/01.pyc'])
+
+    banner('Changing the vendor directory')
+    with Directory('repo/vendor'):
+        make_older('a.txt')
+        append('a.txt', 'More apple\n')
+        os.remove('sub/old.txt')
+        touch('sub/new.txt', 'New\n')
+
+    with Directory('build'):
+        banner('Pulling the changes')
+        muddle(['pull', '_all'])
+        check_just_pulled(['checkout:vendor/checked_out'])
+        if not same_content('src/vendor/a.txt', 'Apple\nMore apple\n'):
+            raise GiveUp('src/vendor/a.txt was not updated')
+        check_files(['src/vendor/sub/b.txt', 'src/vendor/sub/new.txt'])
+        check_nosuch_files(['src/vendor/sub/old.txt'])
+
+    banner('Giving the files new times, but not new content')
+    now = time.time() + 10
+    for name in ('vendor', 'regenerated'):
+        with Directory(os.path.join('repo', name)):
+            os.utime('a.txt', (now, now))
+
+    with Directory('build'):
+        banner('Pulling again')
+        muddle(['pull', '_all'])
+        # Only the checkout that does not compare content thinks it changed
+        check_just_pulled(['checkout:vendor/checked_out'])
+        muddle(['pull', '_all'])
+        check_just_pulled([])
+
+def test_local_files_kept(root_dir):
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    make_repositories()
+
+    with NewDirectory('build'):
+        banner('Checking out')
+        muddle(['init', 'file+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_files(['.muddle/file_manifests/src/vendor.manifest'])
+
+        banner('Adding local files to the checkout')
+        with Directory('src/vendor'):
+            touch('local.txt', 'Mine\n')
+            touch('sub/local.txt', 'Also mine\n')
+
+    banner('Removing files from the vendor directory')
+    with Directory('repo/vendor'):
+        os.remove('a.txt')
+        os.remove('sub/b.txt')
+        os.remove('sub/old.txt')
+        os.rmdir('sub')
+
+    with Directory('build'):
+        banner('Pulling the changes')
+        muddle(['pull', '_all'])
+        check_just_pulled(['checkout:vendor/checked_out'])
+        check_files(['src/vendor/local.txt', 'src/vendor/sub/local.txt'])
+        check_nosuch_files(['src/vendor/a.txt', 'src/vendor/sub/b.txt',
+                            'src/vendor/sub/old.txt'])
+
+    banner('Putting a file back, and removing it again')
+    with Directory('repo/vendor'):
+        touch('a.txt', 'Apple again\n')
+
+    with Directory('build'):
+        muddle(['pull', '_all'])
+        check_files(['src/vendor/a.txt'])
+
+    with Directory('repo/vendor'):
+        os.remove('a.txt')
+
+    with Directory('build'):
+        muddle(['pull', '_all'])
+        check_nosuch_files(['src/vendor/a.txt'])
+        check_files(['src/vendor/local.txt', 'src/vendor/sub/local.txt'])
+
+def main(args):
+
+    keep = False
+    if args:
+        if len(args) == 1 and args[0] == '-keep':
+            keep = True
+        else:
+            print __doc__
+            return
+
+    root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
+
+    with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep) as root_d:
+        with NewDirectory('pulls') as d:
+            banner('TEST FILE PULLS')
+            test_file_pulls(d.where)
+
+        with NewDirectory('local') as d:
+            banner('TEST LOCAL FILES ARE KEPT')
+            test_local_files_kept(d.where)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -12,6 +12,7 @@ import os
 import shutil
 import subprocess
 import sys
+import time
 import traceback
 
 from support_for_tests import *
@@ -23,7 +24,9 @@ except ImportError:
     sys.path.insert(0, get_parent_dir(__file__))
     import muddled.cmdline
 
-from muddled.utils import GiveUp, normalise_dir
+from muddled.utils import GiveUp, MuddleBug, normalise_dir
+from muddled.vcs import git_objects
+import muddled.vcs.git as git_vcs
 from muddled.withdir import Directory, NewDirectory, TransientDirectory
 
 MUDDLE_MAKEFILE = """\
@@ -261,6 +264,57 @@ def test_git_checkout_build():
                      'src/multilevel/inner/checkout3/Makefile.muddle',
                      ])
 
+    # ...and do so several checkouts at a time
+    with NewDirectory('test_build4'):
+        banner('Unstamping checkout build, in parallel')
+        muddle(['unstamp', '-j', '4', 'git+%s'%root_repo, 'versions/checkout_test.stamp'])
+
+        check_files(['src/builds/01.py',
+                     'versions/checkout_test.stamp',
+                     'src/checkout1/Makefile.muddle',
+                     'src/twolevel/checkout2/Makefile.muddle',
+                     'src/multilevel/inner/checkout3/Makefile.muddle',
+                     ])
+
+    # A checkout that cannot be retrieved should not stop the others
+    with NewDirectory('test_build5'):
+        banner('Unstamping checkout build, in parallel, with a bad checkout')
+        with open(os.path.join(root_dir, 'test_build1', 'versions',
+                               'checkout_test.stamp')) as fd:
+            stamp_text = fd.read()
+        touch('broken.stamp', stamp_text.replace('repo_name = checkout1\n',
+                                                 'repo_name = no_such_checkout\n'))
+        rc, text = captured_muddle2(['unstamp', '-j', '4', 'broken.stamp'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle unstamp" to fail')
+        if 'Unable to restore 1 of the 4 checkouts' not in text:
+            raise GiveUp('Expected failure to restore checkout1, got:\n%s'%text)
+
+        check_files(['src/builds/01.py',
+                     'src/twolevel/checkout2/Makefile.muddle',
+                     'src/multilevel/inner/checkout3/Makefile.muddle',
+                     ])
+        check_nosuch_files(['src/checkout1/Makefile.muddle'])
+
+    # Without -j, the first checkout that cannot be retrieved stops us
+    with NewDirectory('test_build6'):
+        banner('Unstamping checkout build, with a bad checkout')
+        touch('broken.stamp', stamp_text.replace('repo_name = checkout1\n',
+                                                 'repo_name = no_such_checkout\n'))
+        rc, text = captured_muddle2(['unstamp', 'broken.stamp'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle unstamp" to fail')
+        if 'Unable to restore' in text:
+            raise GiveUp('Expected "muddle unstamp" to stop at checkout1,'
+                         ' got:\n%s'%text)
+
+        # The checkouts are retrieved in order of label, and checkout3 is
+        # called "alice"
+        check_files(['src/builds/01.py',
+                     'src/multilevel/inner/checkout3/Makefile.muddle'])
+        check_nosuch_files(['src/checkout1/Makefile.muddle',
+                            'src/twolevel/checkout2/Makefile.muddle'])
+
 def test_git_muddle_patch():
     """Test the workings of the muddle_patch program against git
 
@@ -387,6 +441,746 @@ def test_just_pulled():
         if not same_content(_just_pulled_file, ''):
             raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
 
+    banner('Change Build A again')
+    with Directory('build_A/src/twolevel/checkout2'):
+        append('Makefile.muddle', '# Another simple change\n')
+        git('commit -a -m "Another simple change"')
+        muddle(['push'])
+
+    banner('Pull into Build B, fetching in the background')
+    with Directory('build_B') as d:
+        text = captured_muddle(['pull', '_all'])
+        if text.count('++ Already fetched from') != 4:
+            raise GiveUp('Expected four checkouts to have been fetched'
+                         ' in the background:\n%s'%text)
+        if not same_content(_just_pulled_file,
+                            'checkout:checkout2/checked_out\n'):
+            raise GiveUp('%s does not contain expected labels:\n%s'%(
+                _just_pulled_file,open(_just_pulled_file).readlines()))
+
+    banner('Change Build A a third time')
+    with Directory('build_A/src/twolevel/checkout2'):
+        append('Makefile.muddle', '# A third simple change\n')
+        git('commit -a -m "A third simple change"')
+        muddle(['push'])
+
+    banner('Pull into Build B, without fetching in the background')
+    with Directory('build_B') as d:
+        text = captured_muddle(['pull', '-noprefetch', 'builds', 'checkout1',
+                                'checkout2', 'alice'])
+        if 'Already fetched from' in text:
+            raise GiveUp('Did not expect any checkouts to have been fetched'
+                         ' in the background:\n%s'%text)
+        if not same_content(_just_pulled_file,
+                            'checkout:checkout2/checked_out\n'):
+            raise GiveUp('%s does not contain expected labels:\n%s'%(
+                _just_pulled_file,open(_just_pulled_file).readlines()))
+
+def test_just_pulled_in_parallel():
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    # Set up our repositories
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    banner('Build A')
+    with NewDirectory('build_A'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+    banner('Build B, checked out in parallel')
+    with NewDirectory('build_B') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '-j', '4', '_all'])
+        check_files([d.join('src', 'builds', '01.py'),
+                     d.join('src', 'checkout1', 'Makefile.muddle'),
+                     d.join('src', 'twolevel', 'checkout2', 'Makefile.muddle'),
+                     d.join('src', 'multilevel', 'inner', 'checkout3', 'Makefile.muddle')])
+
+    banner('Change Build A')
+    with Directory('build_A'):
+        with Directory('src'):
+            with Directory('builds'):
+                append('01.py', '# Just a comment\n')
+                # Then remove the .pyc file, because Python probably won't realise
+                # that this new 01.py is later than the previous version
+                os.remove('01.pyc')
+                git('commit -a -m "A simple change"')
+                muddle(['push'])
+            with Directory('twolevel'):
+                with Directory('checkout2'):
+                    append('Makefile.muddle', '# Just a comment\n')
+                    git('commit -a -m "A simple change"')
+                    muddle(['push'])
+
+    banner('Pull into Build B, in parallel')
+    with Directory('build_B') as d:
+        _just_pulled_file = os.path.join(d.where, '.muddle', '_just_pulled')
+        muddle(['pull', '-j', '4', '_all'])
+        if not same_content(_just_pulled_file,
+                            'checkout:builds/checked_out\n'
+                            'checkout:checkout2/checked_out\n'):
+            raise GiveUp('%s does not contain expected labels:\n%s'%(
+                _just_pulled_file,open(_just_pulled_file).readlines()))
+        muddle(['pull', '-j', '4', '_all'])
+        if not same_content(_just_pulled_file, ''):
+            raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
+
+    banner('Status of Build B, in parallel')
+    with Directory('build_B'):
+        muddle(['status', '-jobs', '4', '_all'])
+        with Directory('src/twolevel/checkout2'):
+            append('Makefile.muddle', '# Another comment\n')
+        rc, text = captured_muddle2(['status', '-jobs', '4', '_all'])
+        if rc != 1:
+            raise GiveUp('Expected "muddle status" to fail, but got %d'%rc)
+        check_text_endswith(text, 'The following checkouts need attention:\n'
+                                  '  checkout:checkout2/checked_out\n')
+
+        # A checkout we can't look at is reported, along with the others
+        os.rename('src/checkout1', 'src/checkout1.moved')
+        rc, text = captured_muddle2(['status', '-jobs', '4', '_all'])
+        os.rename('src/checkout1.moved', 'src/checkout1')
+        if rc != 1:
+            raise GiveUp('Expected "muddle status" to fail, but got %d'%rc)
+        if 'MuddleBug' in text or 'Traceback' in text:
+            raise GiveUp('Expected a simple failure from "muddle status",'
+                         ' got:\n%s'%text)
+        check_text_endswith(text, 'The following checkouts need attention:\n'
+                                  '  checkout:checkout1/checked_out\n'
+                                  '  checkout:checkout2/checked_out\n')
+
+        # But something going wrong unexpectedly stops us, whether in a
+        # worker process or not
+        def broken_status(self, repo, options, quick=False):
+            if repo.repo_name == 'checkout1':
+                raise MuddleBug('Something unexpected happened')
+            return original_status(self, repo, options, quick)
+        original_status = git_vcs.Git.status
+        environ = os.environ
+        saved = environ.copy()
+        git_vcs.Git.status = broken_status
+        try:
+            for args in (['status', '_all'], ['status', '-jobs', '4', '_all']):
+                try:
+                    run_muddle_directly(args)
+                except MuddleBug as e:
+                    if 'checkout1' not in str(e) or \
+                       'Something unexpected happened' not in str(e):
+                        raise GiveUp('Unexpected failure from "muddle %s":'
+                                     '\n%s'%(' '.join(args), e))
+                else:
+                    raise GiveUp('Expected "muddle %s" to fail'%' '.join(args))
+        finally:
+            git_vcs.Git.status = original_status
+            # Loading the build description replaces os.environ
+            os.environ = environ
+            environ.clear()
+            environ.update(saved)
+
+def test_revision_cache():
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_A') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        cache_file = os.path.join(d.where, '.muddle', 'revisions', 'checkout1')
+
+        banner('Revision cache is created')
+        with Directory('src/checkout1'):
+            head = get_stdout('git rev-parse HEAD', False).strip()
+        check_nosuch_files([cache_file])
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != head:
+            raise GiveUp('Expected checkout-id %s, got %s'%(head, text.strip()))
+        check_files([cache_file])
+
+        banner('Revision cache is used when nothing has changed')
+        # Doctor the cached value, so we can tell it is being used
+        with open(cache_file) as fd:
+            cached = fd.read()
+        with open(cache_file, 'w') as fd:
+            fd.write(cached.replace(head, 'not-really-a-revision'))
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != 'not-really-a-revision':
+            raise GiveUp('Expected cached checkout-id, got %s'%text.strip())
+
+        banner('Revision cache is discarded when HEAD changes')
+        with Directory('src/checkout1'):
+            append('Makefile.muddle', '# Just a comment\n')
+            git('commit -a -m "A simple change"')
+            head = get_stdout('git rev-parse HEAD', False).strip()
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != head:
+            raise GiveUp('Expected checkout-id %s, got %s'%(head, text.strip()))
+
+        banner('Revision cache is discarded when branches change')
+        with Directory('src/checkout1'):
+            git('checkout -b fred')
+        text = captured_muddle(['query', 'checkout-branches'])
+        for line in text.split('\n'):
+            words = line.split()
+            if words and words[0] == 'checkout1':
+                if words[1] != 'fred':
+                    raise GiveUp('Expected checkout1 to be on branch fred:\n%s'%text)
+                break
+        else:
+            raise GiveUp('checkout1 not listed:\n%s'%text)
+
+PARTIAL_BUILD_DESC = """ \
+# A build with a partial checkout
+
+import muddled.pkg as pkg
+from muddled.depend import checkout
+from muddled.version_control import checkout_from_repo
+
+def describe_to(builder):
+    builder.build_name = 'partial_test'
+    root_repo = builder.build_desc_repo
+    checkout_from_repo(builder, checkout('big'),
+                       root_repo.copy_with_changes('big'))
+    pkg.set_checkout_vcs_option(builder, checkout('big'), partial_checkout=True)
+"""
+
+def test_partial_checkout():
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    with NewDirectory('repo'):
+        for name in ('builds', 'big'):
+            with NewDirectory(name):
+                git('init --bare')
+                # Allow partial clones from this repository
+                git('config uploadpack.allowFilter true')
+
+    with NewDirectory('setup'):
+        with NewDirectory('builds'):
+            touch('01.py', PARTIAL_BUILD_DESC)
+            touch('.gitignore', '*.pyc\n')
+            git('init')
+            git('add 01.py .gitignore')
+            git('commit -m "Build description"')
+            git('push %s/builds HEAD:master'%root_repo)
+        with NewDirectory('big'):
+            touch('big.c', '// Big\n')
+            git('init')
+            git('add big.c')
+            git('commit -m "Big"')
+            git('push %s/big HEAD:master'%root_repo)
+
+    banner('Partial checkout')
+    with NewDirectory('build'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        with Directory('src/big'):
+            filter = get_stdout('git config remote.origin.partialclonefilter', False)
+            if filter.strip() != 'blob:none':
+                raise GiveUp('src/big is not a blobless partial clone')
+            head = get_stdout('git rev-parse HEAD', False).strip()
+
+        banner('Partial checkouts can be stamped, branched and pushed')
+        text = captured_muddle(['query', 'checkout-id', 'big'])
+        if text.strip() != head:
+            raise GiveUp('Expected checkout-id %s, got %s'%(head, text.strip()))
+        muddle(['status', 'big'])
+        with Directory('src/big'):
+            append('big.c', '// Bigger\n')
+            git('commit -a -m "Bigger"')
+            muddle(['push'])
+        muddle(['branch-tree', 'v1-maintenance'])
+        text = captured_muddle(['query', 'checkout-branches'])
+        for line in text.split('\n'):
+            words = line.split()
+            if words and words[0] == 'big' and words[1] != 'v1-maintenance':
+                raise GiveUp('Expected big to be on v1-maintenance:\n%s'%text)
+
+def checkout_branches(text):
+    """Return a dictionary of checkout name to branch, from "query checkout-branches"
+    """
+    branches = {}
+    for line in text.split('\n'):
+        words = line.split()
+        if len(words) > 1 and words[0] != 'Checkout' and \
+           not words[0].startswith('-'):
+            branches[words[0]] = words[1]
+    return branches
+
+def test_parallel_branching():
+    """Test "muddle branch-tree", "muddle sync" and "muddle reparent" with -j
+    """
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_A'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        names = sorted(checkout_branches(captured_muddle(['query', 'checkout-branches'])))
+
+        banner('Branching the tree, in parallel')
+        muddle(['branch-tree', '-j', '4', 'v1-maintenance'])
+        branches = checkout_branches(captured_muddle(['query', 'checkout-branches']))
+        for name in names:
+            if branches.get(name) != 'v1-maintenance':
+                raise GiveUp('Expected %s to be on v1-maintenance:\n%s'%(name, branches))
+
+        banner('Branching the tree again fails for all checkouts')
+        rc, text = captured_muddle2(['branch-tree', '-j', '4', 'v1-maintenance'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle branch-tree" to fail')
+        for name in names:
+            if 'checkout:%s/checked_out already has a branch called v1-maintenance'%name not in text:
+                raise GiveUp('Expected %s to be reported as already branched:\n%s'%(name, text))
+
+        banner('Syncing back to master, in parallel')
+        with Directory('src/builds'):
+            git('checkout master')
+        muddle(['sync', '-j', '4', '_all'])
+        branches = checkout_branches(captured_muddle(['query', 'checkout-branches']))
+        for name in names:
+            if branches.get(name) != 'master':
+                raise GiveUp('Expected %s to be on master:\n%s'%(name, branches))
+
+        banner('Reparenting, in parallel')
+        muddle(['reparent', '-j', '4', '-f', '_all'])
+
+        def current_branch(co_dir):
+            with Directory(co_dir):
+                return get_stdout('git rev-parse --abbrev-ref HEAD', False).strip()
+
+        banner('Without -j, a checkout that cannot be synced stops us')
+        muddle(['branch-tree', 'v2-maintenance'])
+        with Directory('src/builds'):
+            git('checkout master')
+        # The checkouts are synced in order of label, and checkout3 is called
+        # "alice", so comes first
+        os.rename('src/multilevel/inner/checkout3',
+                  'src/multilevel/inner/checkout3.moved')
+        try:
+            rc, text = captured_muddle2(['sync', '_all'])
+            if rc == 0:
+                raise GiveUp('Expected "muddle sync" to fail')
+            if 'Unable to sync' in text:
+                raise GiveUp('Expected "muddle sync" to stop at the first'
+                             ' problem, got:\n%s'%text)
+            if current_branch('src/checkout1') != 'v2-maintenance':
+                raise GiveUp('Expected checkout1 to be left on v2-maintenance')
+
+            banner('With -j, it does not stop the others')
+            rc, text = captured_muddle2(['sync', '-j', '4', '_all'])
+            if rc == 0:
+                raise GiveUp('Expected "muddle sync -j 4" to fail')
+            if 'Unable to sync 1 of' not in text:
+                raise GiveUp('Expected one checkout to fail to sync,'
+                             ' got:\n%s'%text)
+            if current_branch('src/checkout1') != 'master':
+                raise GiveUp('Expected checkout1 to be synced to master')
+        finally:
+            os.rename('src/multilevel/inner/checkout3.moved',
+                      'src/multilevel/inner/checkout3')
+
+def test_object_lookups():
+    """Test looking up revisions with a long-running "git cat-file"
+    """
+    with NewDirectory('repo') as d:
+        touch('fred.c', '// Fred\n')
+        git('init')
+        git('add fred.c')
+        git('commit -m "Fred"')
+        head = get_stdout('git rev-parse HEAD', False).strip()
+
+        banner('Looking up revisions')
+        if git_objects.rev_parse('HEAD') != head:
+            raise GiveUp('Expected HEAD to be %s'%head)
+        if git_objects.rev_parse(head[:8]) != head:
+            raise GiveUp('Expected %s to expand to %s'%(head[:8], head))
+        if git_objects.rev_parse('no-such-branch') is not None:
+            raise GiveUp('Expected no-such-branch not to be found')
+
+        banner('Looking up revisions that have changed')
+        append('fred.c', '// More Fred\n')
+        git('commit -a -m "More Fred"')
+        new_head = get_stdout('git rev-parse HEAD', False).strip()
+        if git_objects.rev_parse('HEAD') != new_head:
+            raise GiveUp('Expected HEAD to have changed to %s'%new_head)
+        if git_objects.rev_parse('HEAD~1') != head:
+            raise GiveUp('Expected HEAD~1 to be %s'%head)
+
+        banner('Closing the lookups')
+        lookup = git_objects.object_lookup()
+        git_objects.close_all()
+        if lookup.process.poll() is None:
+            raise GiveUp('Expected "git cat-file" to have exited')
+        if git_objects.rev_parse('HEAD') != new_head:
+            raise GiveUp('Expected a new lookup to find HEAD %s'%new_head)
+        git_objects.close_all()
+
+def test_parallel_push():
+    """Test "muddle push" with -j
+    """
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_A'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        banner('Pushing, in parallel')
+        checkouts = ('src/checkout1', 'src/twolevel/checkout2',
+                     'src/multilevel/inner/checkout3')
+        for path in checkouts:
+            with Directory(path):
+                append('Makefile.muddle', '# A change\n')
+                git('commit -a -m "A change"')
+        muddle(['push', '-j', '4', 'checkout1', 'checkout2', 'alice'])
+        for path in checkouts:
+            with Directory(path):
+                local = get_stdout('git rev-parse HEAD', False).strip()
+                remote = get_stdout('git ls-remote origin refs/heads/master',
+                                    False).split()[0]
+            if local != remote:
+                raise GiveUp('%s was not pushed (%s, remote %s)'%(path, local, remote))
+
+    banner('A push that fails does not stop the others')
+    with NewDirectory('build_B'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        with Directory('src/checkout1'):
+            git('reset --hard HEAD~1')
+        for path in checkouts:
+            with Directory(path):
+                append('Makefile.muddle', '# Another change\n')
+                git('commit -a -m "Another change"')
+        rc, text = captured_muddle2(['push', '-j', '4', 'checkout1', 'checkout2', 'alice'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle push" to fail for checkout1')
+        check_text_endswith(text, 'Unable to push 1 of 3 checkouts\n')
+        with Directory('src/twolevel/checkout2'):
+            local = get_stdout('git rev-parse HEAD', False).strip()
+            remote = get_stdout('git ls-remote origin refs/heads/master',
+                                False).split()[0]
+        if local != remote:
+            raise GiveUp('checkout2 was not pushed (%s, remote %s)'%(local, remote))
+
+def process_gone(pid):
+    """Is process 'pid' gone (or a zombie waiting for its parent to notice)?
+    """
+    try:
+        with open('/proc/%d/stat'%pid) as fd:
+            return fd.read().split(') ')[1].startswith('Z')
+    except IOError:
+        return True
+
+def test_fetchd():
+    """Test "muddle fetchd"
+    """
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_A'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        with Directory('src/checkout1'):
+            old_head = get_stdout('git rev-parse HEAD', False).strip()
+
+    banner('Changing checkout1 in another build tree')
+    with NewDirectory('build_B'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        with Directory('src/checkout1'):
+            append('Makefile.muddle', '# A change\n')
+            git('commit -a -m "A change"')
+            new_head = get_stdout('git rev-parse HEAD', False).strip()
+        muddle(['push', 'checkout1'])
+
+    with Directory('build_A'):
+        banner('Fetching once')
+        muddle(['fetchd', '-once', '-jobs', '2'])
+        with Directory('src/checkout1'):
+            head = get_stdout('git rev-parse HEAD', False).strip()
+            fetched = get_stdout('git rev-parse origin/master', False).strip()
+        if head != old_head:
+            raise GiveUp('Expected HEAD to stay at %s, not %s'%(old_head, head))
+        if fetched != new_head:
+            raise GiveUp('Expected origin/master to be %s, not %s'%(new_head, fetched))
+
+        banner('Pulling does not fetch again')
+        text = captured_muddle(['pull', 'checkout1'])
+        if '++ Already fetched from' not in text or 'git fetch' in text:
+            raise GiveUp('Expected "muddle pull" not to fetch again, got:\n%s'%text)
+        with Directory('src/checkout1'):
+            head = get_stdout('git rev-parse HEAD', False).strip()
+        if head != new_head:
+            raise GiveUp('Expected "muddle pull" to move HEAD to %s, not %s'%(new_head, head))
+        text = captured_muddle(['pull', '-noprefetch', 'checkout2'])
+        if '++ Already fetched from' not in text:
+            raise GiveUp('Expected "muddle pull" not to fetch again, got:\n%s'%text)
+
+        banner('A pull that fails does not leave its fetch behind')
+        with Directory('src/twolevel/checkout2'):
+            append('Makefile.muddle', '# An uncommitted change\n')
+        environ = os.environ
+        saved = environ.copy()
+        failed = False
+        try:
+            run_muddle_directly(['pull', 'checkout2'])
+        except GiveUp:
+            failed = True
+        finally:
+            # Loading the build description replaces os.environ
+            os.environ = environ
+            environ.clear()
+            environ.update(saved)
+        if not failed:
+            raise GiveUp('Expected "muddle pull" to fail, because of local changes')
+        if git_vcs._prefetched:
+            raise GiveUp('Expected the prefetches to be forgotten, not %s'%git_vcs._prefetched)
+        with Directory('src/twolevel/checkout2'):
+            git('checkout Makefile.muddle')
+
+        banner('Starting and stopping the daemon')
+        text = captured_muddle(['fetchd', '-status'])
+        check_text_endswith(text, '"muddle fetchd" is not running\n')
+        muddle(['fetchd', '-interval', '1'])
+        text = captured_muddle(['fetchd', '-status'])
+        if '"muddle fetchd" is running' not in text:
+            raise GiveUp('Expected "muddle fetchd" to be running, got:\n%s'%text)
+        rc, text = captured_muddle2(['fetchd'])
+        if rc == 0 or 'already running' not in text:
+            raise GiveUp('Expected a second "muddle fetchd" to fail, got:\n%s'%text)
+        muddle(['pull', '_all'])
+        text = captured_muddle(['fetchd', '-stop'])
+        if 'Stopped "muddle fetchd"' not in text:
+            raise GiveUp('Expected "muddle fetchd" to stop, got:\n%s'%text)
+        text = captured_muddle(['fetchd', '-status'])
+        check_text_endswith(text, '"muddle fetchd" is not running\n')
+        with Directory('src/checkout1'):
+            head = get_stdout('git rev-parse HEAD', False).strip()
+        if head != new_head:
+            raise GiveUp('Expected "muddle pull" to move HEAD to %s, not %s'%(new_head, head))
+
+    banner('The daemon stops when its build tree is removed')
+    with NewDirectory('build_C'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        muddle(['fetchd', '-interval', '1'])
+        pid = int(open('.muddle/fetchd.pid').read())
+    shutil.rmtree('build_C')
+    for count in range(100):
+        if process_gone(pid):
+            break
+        time.sleep(0.1)
+    else:
+        raise GiveUp('Expected "muddle fetchd" (process %d) to stop when its'
+                     ' build tree was removed'%pid)
+
+FINGERPRINT_BUILD_DESC = """ \
+# Two packages, each built from its own checkout
+
+import muddled.pkgs.make
+
+def describe_to(builder):
+    builder.build_name = 'fingerprint_test'
+    muddled.pkgs.make.medium(builder, "first_pkg", ["x86"], "first_co")
+    muddled.pkgs.make.medium(builder, "second_pkg", ["x86"], "second_co")
+"""
+
+def check_changed_since_build(expected):
+    text = captured_muddle(['query', 'changed-since-build'])
+    if text.split() != expected:
+        raise GiveUp('Expected "muddle query changed-since-build" to report %s,'
+                     ' got:\n%s'%(expected, text))
+
+def test_changed_since_build():
+    """Test source fingerprints and "muddle query changed-since-build"
+    """
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    with NewDirectory('repo'):
+        for name in ('builds', 'first_co', 'second_co'):
+            with NewDirectory(name):
+                git('init --bare')
+
+    with NewDirectory('setup'):
+        with NewDirectory('builds'):
+            touch('01.py', FINGERPRINT_BUILD_DESC)
+            git('init')
+            git('add 01.py')
+            git('commit -m "Build description"')
+            git('push %s/builds HEAD:master'%root_repo)
+        for name in ('first_co', 'second_co'):
+            with NewDirectory(name):
+                touch('Makefile.muddle', MUDDLE_MAKEFILE)
+                git('init')
+                git('add Makefile.muddle')
+                git('commit -m "Add muddle makefile"')
+                git('push %s/%s HEAD:master'%(root_repo, name))
+
+    with NewDirectory('build') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        banner('Nothing has been built')
+        check_changed_since_build([])
+
+        banner('Building, which remembers the fingerprints')
+        muddle(['build', '_all'])
+        check_files([os.path.join(d.where, '.muddle', 'fingerprints',
+                                  'first_pkg', 'x86')])
+        check_changed_since_build([])
+
+        banner('Changing first_co')
+        with Directory('src/first_co'):
+            append('Makefile.muddle', '# Just a comment\n')
+        check_changed_since_build(['package:first_pkg{x86}/built'])
+        with Directory('src/first_co'):
+            git('commit -a -m "A simple change"')
+        check_changed_since_build(['package:first_pkg{x86}/built'])
+
+        banner('Adding a new file to second_co')
+        with Directory('src/second_co'):
+            touch('new.c', '// New\n')
+        check_changed_since_build(['package:first_pkg{x86}/built',
+                                   'package:second_pkg{x86}/built'])
+
+        banner('Rebuilding')
+        muddle(['changed', 'package:first_pkg{x86}', 'package:second_pkg{x86}'])
+        check_changed_since_build([])
+        muddle(['build', '_all'])
+        check_changed_since_build([])
+
+        banner('Ignored files do not count')
+        with Directory('src/first_co'):
+            touch('.gitignore', '*.o\n')
+            git('add .gitignore')
+            git('commit -m "Ignore object files"')
+        muddle(['changed', 'package:first_pkg{x86}'])
+        muddle(['build', '_all'])
+        check_changed_since_build([])
+        with Directory('src/first_co'):
+            touch('first.o', 'Not really an object file\n')
+        check_changed_since_build([])
+        with Directory('src/first_co'):
+            touch('first.c', '// Not ignored\n')
+        check_changed_since_build(['package:first_pkg{x86}/built'])
+
+def stamp_content(path):
+    """Return the lines of a stamp file, without its comments.
+    """
+    with open(path) as fd:
+        return [line for line in fd if not line.startswith('#')]
+
+def test_stamp_save_in_parallel():
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        banner('Stamp save, serially and in parallel')
+        muddle(['stamp', 'save', 'serial.stamp'])
+        muddle(['stamp', 'save', '-j', '4', 'parallel.stamp'])
+        check_files(['serial.stamp', 'parallel.stamp'])
+        # Ignore the comments, which say when each stamp file was written
+        if stamp_content('serial.stamp') != stamp_content('parallel.stamp'):
+            raise GiveUp('"stamp save" and "stamp save -j 4" differ')
+
+        banner('Stamp save in parallel, with a problem')
+        with Directory('src/twolevel/checkout2'):
+            # Leave HEAD on a branch with no commits, so it has no revision
+            git('symbolic-ref HEAD refs/heads/no-such-branch')
+        rc, text = captured_muddle2(['stamp', 'save', '-j', '4', 'problem.stamp'])
+        if 'MuddleBug' in text or 'Traceback' in text:
+            raise GiveUp('Expected "stamp save -j 4" to report a problem,'
+                         ' not a bug:\n%s'%text)
+        if 'Unable to work out revision ids for all the checkouts' not in text or \
+           'checkout2' not in text:
+            raise GiveUp('Expected "stamp save -j 4" to report a problem with'
+                         ' checkout2:\n%s'%text)
+        check_files(['problem.partial'])
+        check_nosuch_files(['problem.stamp'])
+
+def test_status_porcelain_v2():
+    """Test "muddle status", with and without -quick, against git's porcelain v2
+    """
+    root_dir = normalise_dir(os.getcwd())
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+
+    setup_git_checkout_repositories()
+    setup_new_build(root_repo, 'build_0')
+
+    with NewDirectory('build_B'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+    def check_status(expected):
+        """Check both forms of "muddle status checkout1" report 'expected'.
+
+        'expected' is a pair of strings, one for with -quick, and one for
+        without, or None if the checkout should be clean.
+        """
+        for args, what in ((['status', '-quick', 'checkout1'], expected and expected[0]),
+                           (['status', 'checkout1'], expected and expected[1])):
+            rc, text = captured_muddle2(args)
+            if what is None:
+                if rc != 0 or 'All checkouts seemed clean' not in text:
+                    raise GiveUp('Expected "muddle %s" to be clean, got:'
+                                 '\n%s'%(' '.join(args), text))
+            elif rc != 1 or what not in text:
+                raise GiveUp('Expected "muddle %s" to report "%s", got:'
+                             '\n%s'%(' '.join(args), what, text))
+
+    with NewDirectory('build_A'):
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        banner('Status of a clean checkout')
+        check_status(None)
+
+        banner('Status of a dirty checkout')
+        append('src/checkout1/Makefile.muddle', '# A change\n')
+        check_status((' M Makefile.muddle', ' M Makefile.muddle'))
+        with Directory('src/checkout1'):
+            git('checkout Makefile.muddle')
+
+        banner('Status of a checkout that is ahead')
+        with Directory('src/checkout1'):
+            append('Makefile.muddle', '# A change\n')
+            git('commit -a -m "A local change"')
+        check_status(('Local  is 1 commit ahead of, and 0 behind, last known origin/master',
+                      'Remote is'))
+        with Directory('src/checkout1'):
+            git('reset --hard HEAD~1')
+        check_status(None)
+
+        banner('Status of a checkout that is behind')
+        with Directory('../build_B/src/checkout1'):
+            append('Makefile.muddle', '# A remote change\n')
+            git('commit -a -m "A remote change"')
+            git('push origin master')
+        with Directory('src/checkout1'):
+            git('fetch')
+        check_status(('Local  is 0 commits ahead of, and 1 behind, last known origin/master',
+                      'Remote is'))
+
 def main(args):
 
     keep = False
@@ -417,6 +1211,46 @@ def main(args):
             banner('TEST _JUST_PULLED')
             test_just_pulled()
 
+        with NewDirectory('just_pulled_in_parallel'):
+            banner('TEST _JUST_PULLED, IN PARALLEL')
+            test_just_pulled_in_parallel()
+
+        with NewDirectory('revision_cache'):
+            banner('TEST REVISION CACHE')
+            test_revision_cache()
+
+        with NewDirectory('partial'):
+            banner('TEST PARTIAL CHECKOUT')
+            test_partial_checkout()
+
+        with NewDirectory('parallel_branching'):
+            banner('TEST PARALLEL BRANCH-TREE, SYNC AND REPARENT')
+            test_parallel_branching()
+
+        with NewDirectory('object_lookups'):
+            banner('TEST OBJECT LOOKUPS')
+            test_object_lookups()
+
+        with NewDirectory('parallel_push'):
+            banner('TEST PARALLEL PUSH')
+            test_parallel_push()
+
+        with NewDirectory('changed_since_build'):
+            banner('TEST CHANGED-SINCE-BUILD')
+            test_changed_since_build()
+
+        with NewDirectory('stamp_save_in_parallel'):
+            banner('TEST STAMP SAVE IN PARALLEL')
+            test_stamp_save_in_parallel()
+
+        with NewDirectory('fetchd'):
+            banner('TEST FETCHD')
+            test_fetchd()
+
+        with NewDirectory('status_porcelain_v2'):
+            banner('TEST STATUS WITH PORCELAIN V2')
+            test_status_porcelain_v2()
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     try:
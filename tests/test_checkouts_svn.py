@@ -269,6 +269,79 @@ def test_just_pulled():
         if not same_content(_just_pulled_file, ''):
             raise GiveUp('%s should be empty, but is not'%_just_pulled_file)
 
+def test_status_and_revisions():
+    """Test "muddle status" and "muddle query checkout-id" on several checkouts
+    """
+    root_dir = normalise_dir(os.getcwd())
+
+    with NewDirectory('repo'):
+        shell('svnadmin create main')
+
+    root_repo = 'file://' + os.path.join(root_dir, 'repo', 'main')
+    with NewDirectory('build_0'):
+        muddle(['bootstrap', 'svn+%s'%root_repo, 'test_build'])
+        with Directory('src'):
+            with Directory('builds'):
+                touch('01.py', CHECKOUT_BUILD_SVN_NO_REVISIONS)
+                os.remove('01.pyc')
+                svn('import . %s/builds -m "Initial import"'%root_repo)
+
+            with TransientDirectory('checkout1'):
+                touch('Makefile.muddle','# A comment\n')
+                svn('import . %s/checkout1 -m "Initial import"'%root_repo)
+
+    with NewDirectory('build_A'):
+        muddle(['init', 'svn+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        shell('svn propset svn:ignore "*.pyc" src/builds')
+        svn('commit -m "Ignore .pyc files" src/builds')
+        svn('update src/builds')
+
+        banner('Status of two clean checkouts')
+        text = captured_muddle(['status', '_all'])
+        if 'All checkouts seemed clean' not in text:
+            raise GiveUp('Expected all checkouts to be clean:\n%s'%text)
+
+        banner('Status of one changed checkout')
+        append('src/checkout1/Makefile.muddle', '# Another comment\n')
+        rc, text = captured_muddle2(['status', '_all'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle status" to fail')
+        check_text_endswith(text, 'The following checkouts need attention:\n'
+                                  '  checkout:checkout1/checked_out\n')
+        if 'M' not in text or 'Makefile.muddle' not in text:
+            raise GiveUp('Expected Makefile.muddle to be reported as modified:\n%s'%text)
+
+        banner('Remembered revisions notice local changes')
+        rc, text = captured_muddle2(['query', 'checkout-id', 'checkout1'])
+        if rc == 0:
+            raise GiveUp('Expected checkout-id of a changed checkout to fail:\n%s'%text)
+        svn('revert src/checkout1/Makefile.muddle')
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        revision = text.strip()
+        check_files([os.path.join('.muddle', 'revisions', 'checkout1')])
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != revision:
+            raise GiveUp('Expected checkout-id %s, got %s'%(revision, text.strip()))
+
+        banner('Unversioned files do not count')
+        cache_file = os.path.join('.muddle', 'revisions', 'checkout1')
+        with open(cache_file) as fd:
+            remembered = fd.read()
+        touch('src/checkout1/built.o', 'Not under version control\n')
+        text = captured_muddle(['query', 'checkout-id', 'checkout1'])
+        if text.strip() != revision:
+            raise GiveUp('Expected checkout-id %s, got %s'%(revision, text.strip()))
+        with open(cache_file) as fd:
+            if fd.read() != remembered:
+                raise GiveUp('Expected %s to be unchanged'%cache_file)
+
+        banner('But a change to a versioned file does')
+        append('src/checkout1/Makefile.muddle', '# Yet another comment\n')
+        rc, text = captured_muddle2(['query', 'checkout-id', 'checkout1'])
+        if rc == 0:
+            raise GiveUp('Expected checkout-id of a changed checkout to fail:\n%s'%text)
+
 def main(args):
 
     keep = False
@@ -296,6 +369,10 @@ def main(args):
             banner('TEST _JUST_PULLED')
             test_just_pulled()
 
+        with NewDirectory('status'):
+            banner('TEST STATUS AND REVISIONS')
+            test_status_and_revisions()
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     try:
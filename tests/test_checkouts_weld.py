@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+"""Test checkout support for "weld:" checkouts.
+
+    $ ./test_checkouts_weld.py [-keep]
+
+With -keep, do not delete the 'transient' directory used for the tests.
+"""
+
+import os
+import sys
+import traceback
+
+from support_for_tests import *
+
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.utils import GiveUp, normalise_dir
+from muddled.vcs import weld
+from muddled.withdir import Directory, NewDirectory, TransientDirectory
+
+BUILD_DESC = """ \
+# Three checkouts, all in the same weld
+
+import muddled.checkouts.simple
+
+def describe_to(builder):
+    builder.build_name = 'weld_test'
+    for name in ('first_co', 'second_co', 'third_co'):
+        muddled.checkouts.simple.relative(builder, co_name=name)
+"""
+
+def make_weld():
+    """Make our "remote" weld, and put something in it.
+    """
+    with NewDirectory('weld'):
+        git('init')
+        with NewDirectory('src'):
+            with NewDirectory('builds'):
+                touch('01.py', BUILD_DESC)
+            for name in ('first_co', 'second_co', 'third_co'):
+                with NewDirectory(name):
+                    touch('%s.txt'%name, 'Text for %s\n'%name)
+        git('add src')
+        git('commit -m "Initial weld"')
+
+def stamp_revisions(stamp_file):
+    """Return the set of checkout revisions in 'stamp_file'.
+    """
+    revisions = set()
+    with open(stamp_file) as fd:
+        for line in fd:
+            if line.startswith('repo_revision = '):
+                revisions.add(line.split('=')[1].strip())
+    return revisions
+
+def check_status(text, co_name, expected):
+    """Check that the status of 'co_name' reports just the 'expected' paths.
+    """
+    # Each checkout's report is a paragraph of its own
+    start = text.find('weld status for checkout:%s/'%co_name)
+    if start == -1:
+        raise GiveUp('Expected a status report for %s:\n%s'%(co_name, text))
+    end = text.find('\n\n', start)
+    report = text[start:end]
+    for name in ('first_co', 'second_co', 'third_co'):
+        for path in ('src/%s/%s.txt'%(name, name), 'src/%s/new.txt'%name):
+            if path in expected and path not in report:
+                raise GiveUp('Expected status of %s to mention %s:\n%s'%(co_name,
+                             path, report))
+            if path not in expected and path in report:
+                raise GiveUp('Expected status of %s not to mention %s:\n%s'%(co_name,
+                             path, report))
+
+def test_weld(root_dir):
+    weld_repo = 'file://' + os.path.join(root_dir, 'weld')
+
+    make_weld()
+
+    with NewDirectory('build') as d:
+        banner('Checking out')
+        muddle(['init', 'weld+%s'%weld_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_files(['src/first_co/first_co.txt', 'src/second_co/second_co.txt',
+                     'src/third_co/third_co.txt'])
+
+        banner('All the checkouts share the weld revision')
+        head = get_stdout('git rev-parse HEAD', False).strip()
+        muddle(['stamp', 'save', 'first.stamp'])
+        revisions = stamp_revisions('first.stamp')
+        if revisions != set([head]):
+            raise GiveUp('Expected all checkouts to be at %s, got %s'%(head,
+                         ', '.join(sorted(revisions))))
+
+        banner('Status is shared out amongst the checkouts')
+        append('src/first_co/first_co.txt', 'A change\n')
+        touch('src/second_co/new.txt', 'New\n')
+        # "muddle status" fails because some checkouts need attention
+        text = captured_muddle(['status', '_all'], error_fails=False)
+        check_status(text, 'first_co', ['src/first_co/first_co.txt'])
+        check_status(text, 'second_co', ['src/second_co/new.txt'])
+        if 'weld status for checkout:third_co/' in text:
+            raise GiveUp('Expected no status for third_co:\n%s'%text)
+
+        banner('The revision is worked out again for each command')
+        environ = os.environ
+        saved = environ.copy()
+        try:
+            run_muddle_directly(['stamp', 'save', 'second.stamp'])
+            if weld._weld_revisions:
+                raise GiveUp('Expected the weld revisions to be forgotten,'
+                             ' not %s'%weld._weld_revisions)
+            git('commit -a -m "Change first_co"')
+            new_head = get_stdout('git rev-parse HEAD', False).strip()
+            run_muddle_directly(['stamp', 'save', 'third.stamp'])
+        finally:
+            # Loading the build description replaces os.environ
+            os.environ = environ
+            environ.clear()
+            environ.update(saved)
+        if stamp_revisions('second.stamp') != set([head]):
+            raise GiveUp('Expected second.stamp to be at %s'%head)
+        if stamp_revisions('third.stamp') != set([new_head]):
+            raise GiveUp('Expected third.stamp to be at %s, got %s'%(new_head,
+                         ', '.join(sorted(stamp_revisions('third.stamp')))))
+
+def main(args):
+
+    keep = False
+    if args:
+        if len(args) == 1 and args[0] == '-keep':
+            keep = True
+        else:
+            print __doc__
+            return
+
+    root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
+
+    with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep) as root_d:
+        with NewDirectory('weld') as d:
+            banner('TEST WELD')
+            test_weld(d.where)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
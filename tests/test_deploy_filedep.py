@@ -26,6 +26,7 @@ except ImportError:
 from muddled.utils import GiveUp, normalise_dir, LabelType, DirTypeDict
 from muddled.withdir import Directory, NewDirectory, TransientDirectory
 from muddled.depend import Label, label_list_to_string
+from muddled.deployments import privileged
 
 DEPLOYMENT_BUILD_DESC_12 = """ \
 # A simple build description using filedep deployment
@@ -264,6 +265,14 @@ def make_old_build_tree():
                     if text != 'Program program2\n':
                         raise GiveUp('Wrong output from bin/program2: %s'%text)
 
+        # Instructions that don't need privilege are applied in-process,
+        # without re-running muddle
+        text = captured_muddle(['redeploy', 'everything'])
+        if 'Applying instructions for role role1' not in text:
+            raise GiveUp('Did not apply instructions for role1:\n%s'%text)
+        if 'buildlabel' in text or 'sudo' in text:
+            raise GiveUp('Unexpectedly re-ran muddle to apply instructions:\n%s'%text)
+
         # And the MUDDLE_TARGET_LOCATION environment variable should be set
         # for the packages in the appropriate roles
         text = captured_muddle(['query', 'env', 'package:*{role1}'])
@@ -295,6 +304,20 @@ def make_old_build_tree():
                     if text != 'Program program2\n':
                         raise GiveUp('Wrong output from bin/program2: %s'%text)
 
+def test_privileged_operations():
+    """Test the (de)serialisation used by the privileged instruction helper
+    """
+    ops = [['chmod', '0755', '/a/file'], ['chown', '0:0', '/a/file']]
+    privileged.write_operations(ops, 'ops.json')
+    if privileged.read_operations('ops.json') != ops:
+        raise GiveUp('Operations did not survive a round trip')
+    for bad in ([['rm', '-rf', '/']], [[]], ['chmod 0755 /a/file'], {}):
+        try:
+            privileged.check_operations(bad)
+            raise GiveUp('Operations %r were accepted, but should not be'%(bad,))
+        except privileged.OperationsError:
+            pass
+
 def main(args):
 
     keep = False
@@ -308,6 +331,9 @@ def main(args):
     root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
 
     with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep):
+        banner('TEST PRIVILEGED OPERATIONS')
+        test_privileged_operations()
+
         banner('MAKE OLD BUILD TREE')
         make_old_build_tree()
 
@@ -412,6 +412,28 @@ def check_checkout_files(d):
     with Directory(d.join('domains', 'subdomain2')):
         check_dot_muddle(is_subdomain=True)
 
+def check_git_objects_linked(src_root, tgt_root):
+    """Check the git objects in 'tgt_root' are hard links to those in 'src_root'
+
+    Distributing with VCS should link, rather than copy, the (never altered)
+    pack files and loose objects of each git checkout.
+    """
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(tgt_root):
+        parent, name = os.path.split(dirpath)
+        if not parent.endswith(os.path.join('.git', 'objects')):
+            continue
+        if name != 'pack' and len(name) != 2:
+            continue
+        for filename in filenames:
+            tgt_path = os.path.join(dirpath, filename)
+            src_path = os.path.join(src_root, os.path.relpath(tgt_path, tgt_root))
+            if os.stat(tgt_path).st_ino != os.stat(src_path).st_ino:
+                raise GiveUp('%s is not a link to %s'%(tgt_path, src_path))
+            count += 1
+    if not count:
+        raise GiveUp('Found no git objects in %s'%tgt_root)
+
 def add_some_instructions(d):
     """Add some instruction file by hand.
 
@@ -474,6 +496,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             # Issue 250
@@ -492,6 +516,8 @@ def main(args):
                                                '.muddle/instructions',
                                                '.muddle/tags/package',
                                                '.muddle/tags/deployment',
+                                               '.muddle/revisions',
+                                               '.muddle/fingerprints',
                                               ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VCS')
@@ -508,7 +534,10 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
+            check_git_objects_linked(d.where, target_dir)
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VERSIONS')
             target_dir = os.path.join(root_dir, 'source-with-versions')
@@ -523,6 +552,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH VCS AND VERSIONS')
@@ -538,6 +569,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE SOURCE RELEASE WITH "-no-muddle-makefile"')
@@ -555,6 +588,8 @@ def main(args):
                                            '.muddle/instructions',
                                            '.muddle/tags/package',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE')
@@ -571,6 +606,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITHOUT MUDDLE MAKEFILE')
@@ -587,6 +624,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITH VERSIONS')
@@ -602,6 +641,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE BINARY RELEASE WITH VERSIONS AND VCS')
@@ -618,6 +659,8 @@ def main(args):
                                            '.muddle/instructions/second_pkg/arm.xml',
                                            '.muddle/instructions/second_pkg/fred.xml',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                           ])
 
             banner('TESTING DISTRIBUTE "mixed"')
@@ -651,6 +694,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                            # but we're not transferring install/,
                                            # so we don't want [post]installed tags
                                            '.muddle/tags/package/second_pkg/*-*installed',
@@ -693,6 +738,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                            # but we're not transferring install/,
                                            # so we don't want [post]installed tags
                                            '.muddle/tags/package/second_pkg/*-*installed',
@@ -712,6 +759,8 @@ def main(args):
                                            'builds/01.pyc',
                                            'deploy',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                            'domains',   # we didn't ask for subdomains
                                            'versions',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -753,6 +802,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                            # -- etc
                                            '.muddle/instructions/first_pkg',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -796,6 +847,8 @@ def main(args):
                                            '.muddle/tags/package/main_pkg',
                                            '.muddle/tags/package/first_pkg',
                                            '.muddle/tags/deployment',
+                                           '.muddle/revisions',
+                                           '.muddle/fingerprints',
                                            # -- etc
                                            '.muddle/instructions/first_pkg',
                                            '.muddle/instructions/second_pkg/arm.xml',
@@ -261,6 +261,51 @@ def describe_to(builder):
     builder.by_default_deploy("everything")
 """
 
+INCLUDE_DOMAINS_BUILD_DESC = """ \
+# A build description that retrieves its two subdomains at the same time
+
+from muddled.mechanics import include_domains
+
+def describe_to(builder):
+    include_domains(builder,
+                    [("subdomain1", "git+file://{repo}/subdomain1", "builds/01.py"),
+                     ("subdomain2", "git+file://{repo}/subdomain2", "builds/01.py")])
+"""
+
+INCLUDE_NESTED_DOMAINS_BUILD_DESC = """ \
+# A build description that retrieves two subdomains at the same time, one of
+# which does the same in its turn
+
+from muddled.mechanics import include_domains
+
+def describe_to(builder):
+    include_domains(builder,
+                    [("subdomain1", "git+file://{repo}/subdomain1", "builds/01.py"),
+                     ("nested", "git+file://{repo}/nested", "builds/01.py")])
+"""
+
+NESTED_BUILD_DESC = """ \
+# A subdomain that retrieves its own two subdomains at the same time
+
+from muddled.mechanics import include_domains
+
+def describe_to(builder):
+    include_domains(builder,
+                    [("subdomain3", "git+file://{repo}/subdomain3", "builds/01.py"),
+                     ("subdomain4", "git+file://{repo}/subdomain4", "builds/01.py")])
+"""
+
+INCLUDE_BAD_DOMAINS_BUILD_DESC = """ \
+# A build description with a subdomain that cannot be retrieved
+
+from muddled.mechanics import include_domains
+
+def describe_to(builder):
+    include_domains(builder,
+                    [("subdomain1", "git+file://{repo}/subdomain1", "builds/01.py"),
+                     ("no_such_domain", "git+file://{repo}/no_such_domain", "builds/01.py")])
+"""
+
 GITIGNORE = """\
 *~
 *.pyc
@@ -436,6 +481,65 @@ def make_repos_with_subdomain(root_dir):
             with NewDirectory('second_co') as d:
                 make_standard_checkout(d.where, 'second', 'second')
 
+def test_include_domains(root_dir):
+    """Test retrieving several subdomains at once with include_domains()
+    """
+    repo = os.path.join(root_dir, 'repo')
+    with Directory('repo'):
+        with NewDirectory('parallel'):
+            with NewDirectory('builds') as d:
+                make_build_desc(d.where, INCLUDE_DOMAINS_BUILD_DESC.format(repo=repo))
+        with NewDirectory('parallel_bad'):
+            with NewDirectory('builds') as d:
+                make_build_desc(d.where, INCLUDE_BAD_DOMAINS_BUILD_DESC.format(repo=repo))
+        with NewDirectory('parallel_nested'):
+            with NewDirectory('builds') as d:
+                make_build_desc(d.where, INCLUDE_NESTED_DOMAINS_BUILD_DESC.format(repo=repo))
+        with NewDirectory('nested'):
+            with NewDirectory('builds') as d:
+                make_build_desc(d.where, NESTED_BUILD_DESC.format(repo=repo))
+
+    with NewDirectory('parallel') as d:
+        muddle(['init', 'git+file://{repo}/parallel'.format(repo=repo), 'builds/01.py'])
+        # Including the subdomains of our subdomains
+        check_files([d.join('domains', 'subdomain1', 'src', 'builds', '01.py'),
+                     d.join('domains', 'subdomain1', 'domains', 'subdomain3', 'src', 'builds', '01.py'),
+                     d.join('domains', 'subdomain2', 'src', 'builds', '01.py'),
+                     d.join('domains', 'subdomain2', 'domains', 'subdomain3', 'src', 'builds', '01.py'),
+                     d.join('domains', 'subdomain2', 'domains', 'subdomain4', 'src', 'builds', '01.py'),
+                    ])
+        text = captured_muddle(['query', 'checkouts'])
+        for label in ('(subdomain1)main_co',
+                      '(subdomain1(subdomain3))main_co',
+                      '(subdomain2(subdomain4))main_co'):
+            if label not in text.split():
+                raise GiveUp('Expected %s in "muddle query checkouts", got:\n%s'%(label, text))
+
+    with NewDirectory('parallel_nested') as d:
+        # The worker retrieving "nested" must retrieve its subdomains itself
+        muddle(['init', 'git+file://{repo}/parallel_nested'.format(repo=repo), 'builds/01.py'])
+        check_files([d.join('domains', 'subdomain1', 'src', 'builds', '01.py'),
+                     d.join('domains', 'nested', 'src', 'builds', '01.py'),
+                     d.join('domains', 'nested', 'domains', 'subdomain3', 'src', 'builds', '01.py'),
+                     d.join('domains', 'nested', 'domains', 'subdomain4', 'src', 'builds', '01.py'),
+                    ])
+        text = captured_muddle(['query', 'checkouts'])
+        for label in ('(subdomain1)main_co',
+                      '(nested(subdomain3))main_co',
+                      '(nested(subdomain4))main_co'):
+            if label not in text.split():
+                raise GiveUp('Expected %s in "muddle query checkouts", got:\n%s'%(label, text))
+
+    with NewDirectory('parallel_bad'):
+        rc, text = captured_muddle2(['init', 'git+file://{repo}/parallel_bad'.format(repo=repo),
+                                     'builds/01.py'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle init" to fail for no_such_domain')
+        if 'Unable to retrieve subdomain no_such_domain' not in text:
+            raise GiveUp('Expected no_such_domain to be reported, got:\n%s'%text)
+        if 'Unable to retrieve subdomain subdomain1' in text:
+            raise GiveUp('Expected subdomain1 to be retrieved, got:\n%s'%text)
+
 def checkout_build_descriptions(root_dir, d):
 
     repo = os.path.join(root_dir, 'repo')
@@ -915,6 +1019,78 @@ def check_some_specifics():
                     # NB: we get all the deployments that use this checkout...
                     check_cmd('deploy', 'deployment:everything/deployed deployment:(subdomain1)everything/deployed')
 
+def check_location_index(d):
+    """Check find_location_in_tree() gives the right answers from its index.
+    """
+    import muddled.mechanics as mechanics
+
+    # Loading a builder sets up environment variables (and may replace
+    # os.environ itself), which would confuse the muddle commands run by
+    # later tests
+    environ = os.environ
+    saved_environ = environ.copy()
+    try:
+        builder = mechanics.load_builder(d.where, MUDDLE_BINARY)
+        _check_location_index(builder, d)
+    finally:
+        os.environ = environ
+        environ.clear()
+        environ.update(saved_environ)
+
+def _check_location_index(builder, d):
+    from muddled.db import CheckoutData
+    from muddled.depend import Rule
+    from muddled.mechanics import normalise_checkout_label
+    from muddled.utils import DirType
+
+    def check(path, what, label, domain):
+        result = builder.find_location_in_tree(d.join(*path.split('/')))
+        if result != (what, label, domain):
+            raise GiveUp('Location %s: expected %s, got %s'%(path,
+                         (what, label, domain), result))
+
+    def package(text):
+        return Label.from_string(text)
+
+    def checkout(name, domain=None):
+        return normalise_checkout_label(
+                Label(LabelType.Checkout, name, domain=domain))
+
+    check('obj/main_pkg', DirType.Object, package('package:main_pkg{*}/*'), None)
+    check('obj/main_pkg/x86/a/b', DirType.Object, package('package:main_pkg{x86}/*'), None)
+    check('install/x86/bin', DirType.Install, package('package:*{x86}/*'), None)
+    check('deploy/everything/sub1', DirType.Deployed,
+          Label.from_string('deployment:everything/*'), None)
+    check('src/main_co/Makefile.muddle', DirType.Checkout, checkout('main_co'), None)
+    check('src', DirType.Checkout, None, None)
+
+    check('domains/subdomain1/src/first_co', DirType.Checkout,
+          checkout('first_co', 'subdomain1'), 'subdomain1')
+    check('domains/subdomain2/domains/subdomain4', DirType.DomainRoot,
+          None, 'subdomain2(subdomain4)')
+    check('domains/subdomain2/domains/subdomain4/obj/main_pkg/x86', DirType.Object,
+          package('package:(subdomain2(subdomain4))main_pkg{x86}/*'),
+          'subdomain2(subdomain4)')
+    check('domains/subdomain2/domains/subdomain4/install/x86', DirType.Install,
+          package('package:(subdomain2(subdomain4))*{x86}/*'),
+          'subdomain2(subdomain4)')
+    check('domains/subdomain1/deploy/everything', DirType.Deployed,
+          Label.from_string('deployment:(subdomain1)everything/*'), 'subdomain1')
+
+    # A package without a role has no role (or install) directory
+    builder.ruleset.add(Rule(package('package:no_role/postinstalled'), None))
+    check('obj/no_role', DirType.Object, package('package:no_role{*}/*'), None)
+    check('obj/no_role/extra', DirType.Object, package('package:no_role{extra}/*'), None)
+    check('install', DirType.Install, None, None)
+
+    # Moving a checkout doesn't change how many checkouts there are
+    main_co = checkout('main_co')
+    old = builder.db.get_checkout_data(main_co)
+    builder.db.set_checkout_data(main_co, CheckoutData(old.vcs_handler, old.repo,
+                                                       'moved', 'main_co'))
+    check('src/moved/main_co', DirType.Checkout, main_co, None)
+    check('src/main_co', DirType.Checkout, None, None)
+
 def build():
     muddle([])
 
@@ -1176,6 +1352,55 @@ def test_label_unification_1(root_dir, d):
     if 'checkout:(subdomain3)second_co/checked_out' not in lines:
         raise GiveUp('Unification [2] failed:\n{0}'.format(text))
 
+def test_label_unification_chained(root_dir, d):
+    """Test several unifications in a row, each building on the last.
+    """
+    repo = os.path.join(root_dir, 'repo')
+    muddle(['init', 'git+file://{repo}/subdomain1'.format(repo=repo), 'builds/01.py'])
+
+    build_description = d.join('src', 'builds', '01.py')
+    append(build_description,
+           """
+    builder.unify_labels(Label.from_string('checkout:second_co/checked_out'),
+                         Label.from_string('checkout:(subdomain3)second_co/checked_out'))
+    builder.unify_labels(Label.from_string('checkout:(subdomain3)second_co/checked_out'),
+                         Label.from_string('checkout:(subdomain3)first_co/checked_out'))
+    builder.unify_labels(Label.from_string('checkout:main_co/checked_out'),
+                         Label.from_string('checkout:(subdomain3)main_co/checked_out'))
+
+""")
+    os.remove(build_description+'c')
+
+    for package in ('package:second_pkg{{x86}}/preconfig',
+                    "'package:(subdomain3)second_pkg{{x86}}/preconfig'"):
+        text = muddle_stdout("{muddle} query needed-by %s"%package)
+        lines = text.split('\n')
+        if 'checkout:(subdomain3)first_co/checked_out' not in lines or \
+           'checkout:second_co/checked_out' in lines or \
+           'checkout:(subdomain3)second_co/checked_out' in lines:
+            raise GiveUp('Chained unification failed for %s:\n%s'%(package, text))
+
+    text = muddle_stdout("{muddle} query needed-by package:main_pkg{{x86}}/preconfig")
+    lines = text.split('\n')
+    if 'checkout:(subdomain3)main_co/checked_out' not in lines or \
+       'checkout:main_co/checked_out' in lines:
+        raise GiveUp('Unification of main_co failed:\n%s'%text)
+
+    # Once a label has been unified away, it cannot be unified again
+    append(build_description,
+           """
+    builder.unify_labels(Label.from_string('checkout:second_co/checked_out'),
+                         Label.from_string('checkout:first_co/checked_out'))
+
+""")
+    os.remove(build_description+'c')
+    rc, text = captured_muddle2(['query', 'checkouts'])
+    if rc == 0:
+        raise GiveUp('Expected unifying checkout:second_co/checked_out a second time to fail')
+    if 'Cannot unify source label checkout:second_co/checked_out which does not exist' not in text:
+        raise GiveUp('Expected unifying checkout:second_co/checked_out a second time'
+                     ' to be refused, got:\n%s'%text)
+
 def test_label_unification(root_dir, d):
     banner('CHECKOUT BUILD DESCRIPTIONS')
     checkout_build_descriptions(root_dir, d)
@@ -1293,12 +1518,21 @@ def main(args):
             banner('CHECK SOME SPECIFICS')
             check_some_specifics()
 
+            banner('CHECK LOCATION INDEX')
+            check_location_index(d)
+
+        banner('TESTING INCLUDE_DOMAINS')
+        test_include_domains(root_dir)
+
         banner('TESTING LABEL UNIFICATION')
 
         # This one I know works...
         with TransientDirectory('build2', keep_on_error=True) as d:
             test_label_unification_1(root_dir, d)
 
+        with TransientDirectory('build3', keep_on_error=True) as d:
+            test_label_unification_chained(root_dir, d)
+
         with NewDirectory('build2') as d:
             test_label_unification(root_dir, d)
             #banner('CHECKOUT BUILD DESCRIPTIONS')
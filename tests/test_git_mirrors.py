@@ -0,0 +1,274 @@
+#! /usr/bin/env python
+"""Test local git mirrors, "muddle mirror update", and shared stores
+
+    $ ./test_git_mirrors.py [-keep]
+
+With -keep, do not delete the 'transient' directory used for the tests.
+"""
+
+import os
+import sys
+import traceback
+
+from support_for_tests import *
+try:
+    import muddled.cmdline
+except ImportError:
+    # Try one level up
+    sys.path.insert(0, get_parent_dir(__file__))
+    import muddled.cmdline
+
+from muddled.utils import GiveUp, normalise_dir
+from muddled.withdir import Directory, NewDirectory, TransientDirectory
+from muddled.vcs import git_mirrors
+from muddled.vcs.git_mirrors import MIRRORS_ENV_VAR, mirror_path, all_mirrors, \
+        mirror_name
+
+BUILD_DESC = """ \
+# A very simple build description, with one checkout
+
+import muddled.checkouts.simple
+
+def describe_to(builder):
+    builder.build_name = 'mirror_test'
+    muddled.checkouts.simple.relative(builder, co_name='checkout1')
+"""
+
+SHARED_BUILD_DESC = """ \
+# Two checkouts from the same repository, on different branches
+
+from muddled.depend import checkout
+from muddled.version_control import checkout_from_repo
+
+def describe_to(builder):
+    builder.build_name = 'shared_test'
+    root_repo = builder.build_desc_repo
+    checkout_from_repo(builder, checkout('first'),
+                       root_repo.copy_with_changes('shared'))
+    checkout_from_repo(builder, checkout('second'),
+                       root_repo.copy_with_changes('shared', branch='second'))
+"""
+
+def make_repositories(root_repo):
+    """Make our "remote" repositories, and put something in them.
+    """
+    with NewDirectory('repo'):
+        for name in ('builds', 'checkout1'):
+            with NewDirectory(name):
+                git('init --bare')
+
+    with NewDirectory('setup'):
+        with NewDirectory('builds'):
+            touch('01.py', BUILD_DESC)
+            git('init')
+            git('add 01.py')
+            git('commit -m "Build description"')
+            git('push %s/builds HEAD:master'%root_repo)
+        with NewDirectory('checkout1'):
+            touch('fred.c', '// Fred\n')
+            git('init')
+            git('add fred.c')
+            git('commit -m "Fred"')
+            git('push %s/checkout1 HEAD:master'%root_repo)
+
+def head_of(path):
+    with Directory(path):
+        return get_stdout('git rev-parse HEAD', False).strip()
+
+def check_independent_of(checkout_dir, mirror):
+    """Check a checkout cloned using 'mirror' does not need it any more.
+    """
+    check_nosuch_files([os.path.join(checkout_dir, '.git', 'objects', 'info',
+                                     'alternates')])
+    # And it should still be a complete repository without the mirror
+    hidden = mirror + '.hidden'
+    os.rename(mirror, hidden)
+    try:
+        with Directory(checkout_dir):
+            git('fsck --no-dangling')
+    finally:
+        os.rename(hidden, mirror)
+
+def test_mirrors(root_dir):
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+    mirrors_dir = os.path.join(root_dir, 'mirrors')
+
+    make_repositories(root_repo)
+
+    os.environ[MIRRORS_ENV_VAR] = mirrors_dir
+
+    banner('Build A, creating the mirrors')
+    with NewDirectory('build_A') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        mirrors = all_mirrors(mirrors_dir)
+        if len(mirrors) != 2:
+            raise GiveUp('Expected 2 mirrors, got %s'%mirrors)
+        builds_mirror = mirror_path('%s/builds'%root_repo, mirrors_dir)
+        co1_mirror = mirror_path('%s/checkout1'%root_repo, mirrors_dir)
+        check_independent_of(os.path.join(d.where, 'src', 'builds'), builds_mirror)
+        check_independent_of(os.path.join(d.where, 'src', 'checkout1'), co1_mirror)
+
+    banner('Change checkout1 behind the mirror\'s back')
+    with Directory('setup/checkout1'):
+        append('fred.c', '// More Fred\n')
+        git('commit -a -m "More Fred"')
+        git('push %s/checkout1 HEAD:master'%root_repo)
+        new_head = head_of('.')
+
+    if head_of(co1_mirror) == new_head:
+        raise GiveUp('Mirror was updated before "muddle mirror update"')
+
+    banner('Build B, using the (out of date) mirrors')
+    with NewDirectory('build_B') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_independent_of(os.path.join(d.where, 'src', 'checkout1'), co1_mirror)
+        if head_of('src/checkout1') != new_head:
+            raise GiveUp('Build B checkout1 is not at the latest revision')
+
+    banner('Updating the mirrors')
+    muddle(['mirror', 'update', '-j', '2'])
+    if head_of(co1_mirror) != new_head:
+        raise GiveUp('Mirror was not updated by "muddle mirror update"')
+
+    banner('Not using mirrors')
+    del os.environ[MIRRORS_ENV_VAR]
+    with NewDirectory('build_C') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+        check_nosuch_files([os.path.join(d.where, 'src', 'checkout1', '.git',
+                                         'objects', 'info', 'alternates')])
+        rc, text = captured_muddle2(['mirror', 'update'])
+        if rc == 0:
+            raise GiveUp('Expected "muddle mirror update" to fail without %s'%MIRRORS_ENV_VAR)
+
+def make_shared_repositories(root_repo):
+    """Make a repository with two branches, and a build that uses both.
+    """
+    with NewDirectory('repo'):
+        for name in ('builds', 'shared'):
+            with NewDirectory(name):
+                git('init --bare')
+
+    with NewDirectory('setup'):
+        with NewDirectory('builds'):
+            touch('01.py', SHARED_BUILD_DESC)
+            touch('.gitignore', '*.pyc\n')
+            git('init')
+            git('add 01.py .gitignore')
+            git('commit -m "Build description"')
+            git('push %s/builds HEAD:master'%root_repo)
+        with NewDirectory('shared'):
+            touch('fred.c', '// Fred\n')
+            git('init')
+            git('add fred.c')
+            git('commit -m "Fred"')
+            git('push %s/shared HEAD:master'%root_repo)
+            git('checkout -b second')
+            append('fred.c', '// Second\n')
+            git('commit -a -m "Second"')
+            git('push %s/shared HEAD:second'%root_repo)
+
+def check_origin(checkout_dir, url):
+    with Directory(checkout_dir):
+        origin = get_stdout('git config remote.origin.url', False).strip()
+    if origin != url:
+        raise GiveUp('%s has origin "%s", not "%s"'%(checkout_dir, origin, url))
+
+def test_shared_stores(root_dir):
+    root_repo = 'file://' + os.path.join(root_dir, 'repo')
+    shared_url = '%s/shared'%root_repo
+
+    make_shared_repositories(root_repo)
+
+    banner('Checking out two checkouts from one repository')
+    with NewDirectory('build') as d:
+        muddle(['init', 'git+%s'%root_repo, 'builds/01.py'])
+        muddle(['checkout', '_all'])
+
+        store = os.path.join(d.where, '.muddle', 'git-shared',
+                             mirror_name(shared_url))
+        check_files([os.path.join(store, 'HEAD')])
+        for name in ('first', 'second'):
+            check_origin(os.path.join('src', name), shared_url)
+            check_nosuch_files([os.path.join('src', name, '.git', 'objects',
+                                             'info', 'alternates')])
+        if head_of('src/first') != head_of(store):
+            raise GiveUp('src/first is not at the head of master')
+        with Directory('src/second'):
+            branch = get_stdout('git rev-parse --abbrev-ref HEAD', False).strip()
+        if branch != 'second':
+            raise GiveUp('src/second is on branch %s, not second'%branch)
+
+    banner('Changing both branches')
+    with Directory('setup/shared'):
+        append('fred.c', '// More second\n')
+        git('commit -a -m "More second"')
+        git('push %s/shared HEAD:second'%root_repo)
+        new_second = head_of('.')
+        git('checkout master')
+        append('fred.c', '// More first\n')
+        git('commit -a -m "More first"')
+        git('push %s/shared HEAD:master'%root_repo)
+        new_first = head_of('.')
+
+    banner('Pulling two checkouts from one repository')
+    with Directory('build'):
+        text = captured_muddle(['pull', '_all'])
+        if 'Fetching %s once, for 2 checkouts'%shared_url not in text:
+            raise GiveUp('Expected the shared repository to be fetched once:\n%s'%text)
+        if head_of('src/first') != new_first:
+            raise GiveUp('src/first was not pulled')
+        if head_of('src/second') != new_second:
+            raise GiveUp('src/second was not pulled')
+        check_origin('src/first', shared_url)
+
+    banner('The shared store is forgotten after each command')
+    with Directory('build'):
+        environ = os.environ
+        saved = environ.copy()
+        try:
+            run_muddle_directly(['pull', '_all'])
+        finally:
+            # Loading the build description replaces os.environ
+            os.environ = environ
+            environ.clear()
+            environ.update(saved)
+        if git_mirrors.shared_store(shared_url) is not None:
+            raise GiveUp('Expected the shared store for %s to be forgotten,'
+                         ' not %s'%(shared_url, git_mirrors.shared_store(shared_url)))
+
+def main(args):
+
+    keep = False
+    if args:
+        if len(args) == 1 and args[0] == '-keep':
+            keep = True
+        else:
+            print __doc__
+            return
+
+    root_dir = normalise_dir(os.path.join(os.getcwd(), 'transient'))
+
+    with TransientDirectory(root_dir, keep_on_error=True, keep_anyway=keep) as root_d:
+        with NewDirectory('mirrors') as d:
+            banner('TEST GIT MIRRORS')
+            test_mirrors(d.where)
+        with NewDirectory('shared') as d:
+            banner('TEST SHARED STORES')
+            test_shared_stores(d.where)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        main(args)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -547,7 +547,8 @@ def test_guess_version_number(d, repo):
             check_specific_files_in_this_dir(['.git', 'simple_v0.0.release'])
 
         touch('versions/simple_v0.01.release', '')
-        muddle(['stamp', 'release', 'simple', '-next'])
+        # The revisions may be worked out several checkouts at a time
+        muddle(['stamp', 'release', 'simple', '-next', '-j', '2'])
         with Directory('versions'):
             check_specific_files_in_this_dir(['.git',
                                              'simple_v0.0.release',
@@ -752,6 +752,32 @@ Failure pushing checkout:co_repo1/checked_out in src/co_repo1:
   file://{root_dir}/repo/main/repo1.2 does not allow "push"
 """.format(root_dir=root_dir))
 
+    # Doing several at once, we get as far as we can, and report problems at the end
+    err, text = captured_muddle2(['pull-upstream', '-j', '2', 'package:package1', 'builds', '-u', 'rhubarb', 'wombat'])
+    assert err == 1
+    check_text_endswith(text, """\
+
+The following problems occurred:
+
+checkout:co_repo1/checked_out from file://{root_dir}/repo/main/repo1.3:
+  Failure pulling checkout:co_repo1/checked_out in src/co_repo1:
+    file://{root_dir}/repo/main/repo1.3 does not allow "pull"
+
+Unable to pull 1 of 3 checkout/upstream pairs
+""".format(root_dir=root_dir))
+    err, text = captured_muddle2(['push-upstream', '-j', '2', 'package:package1', 'builds', '-u', 'rhubarb', 'wombat'])
+    assert err == 1
+    check_text_endswith(text, """\
+
+The following problems occurred:
+
+checkout:co_repo1/checked_out to file://{root_dir}/repo/main/repo1.2:
+  Failure pushing checkout:co_repo1/checked_out in src/co_repo1:
+    file://{root_dir}/repo/main/repo1.2 does not allow "push"
+
+Unable to push 1 of 3 checkout/upstream pairs
+""".format(root_dir=root_dir))
+
     err, text = captured_muddle2(['-n', 'pull-upstream', 'package:package1', 'builds', '-u', 'rhubarb', 'wombat'])
     assert err == 0
     check_text(text, """\